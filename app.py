@@ -288,6 +288,53 @@ def embed_file(file_name: str) -> tuple[bool, str]:
         return False, str(e)
 
 
+def upload_archive(uploaded_file, on_progress) -> tuple[bool, str]:
+    """Upload a zip / tar archive to the server, which extracts and embeds all its files.
+    Args:
+        uploaded_file: The archive file object uploaded by the user.
+        on_progress: Callback called with the progress dict of each file as it completes.
+    Returns:
+        tuple: A tuple containing:
+            - bool: True if all the files were embedded successfully, False otherwise.
+            - str: Summary message or error message.
+    """
+
+    try:
+        files = {"file": (uploaded_file.name, uploaded_file.getvalue())}
+        data = {"user_id": user_id}
+        response = requests.post(f"{server_ip}/upload_archive", files=files, data=data, stream=True)
+
+        if response.status_code != 200:
+            return False, response.json().get("error", "Unknown error")
+
+        for line in response.iter_lines():
+            if not line:
+                continue
+            decoded = json.loads(line.decode("utf-8"))
+
+            if decoded["type"] == "progress":
+                on_progress(decoded["data"])
+            elif decoded["type"] == "summary":
+                summary = decoded["data"]
+                message = (
+                    f"{summary['ok']}/{summary['files']} files, {summary['chunks']} chunks "
+                    f"in {summary['seconds']}s ({summary['files_per_sec']} files/s)"
+                )
+                return summary["failed"] == 0 and summary["saved"], message
+            elif decoded["type"] == "error":
+                return False, decoded["data"]
+
+        return False, "Archive processing ended unexpectedly."
+
+    except Exception as e:
+        return False, str(e)
+
+
+def is_archive(file_name: str) -> bool:
+    """Check if the uploaded file is a zip / tar archive."""
+    return file_name.lower().endswith((".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz"))
+
+
 def handle_uploaded_files(uploaded_files) -> bool:
     """Handle the uploaded files by uploading them to the server and embedding their content."""
     progress_status = ""
@@ -323,20 +370,37 @@ def handle_uploaded_files(uploaded_files) -> bool:
                     progress_status += f"\n📂 Processing file {i+1} of {len(uploaded_files)}...\n"
                     # log.info(f"Processing file: {file.name}")
 
-                    # Upload file:
-                    with write_progress("Uploading file..."):
-                        status, message = upload_file(file)
-                        if not status:
-                            raise RuntimeError(f"Upload failed for file: {file.name}")
-                        server_file_name = message
-                        time.sleep(st.secrets.llm.per_step_delay)
-
-                    # Embed the file:
-                    with write_progress("Embedding content..."):
-                        status, message = embed_file(server_file_name)
-                        if not status:
-                            raise RuntimeError(f"Embedding failed for file: {file.name}")
-                        time.sleep(st.secrets.llm.per_step_delay)
+                    # Archives are extracted and embedded on server in one go:
+                    if is_archive(file.name):
+                        with write_progress("Uploading and embedding archive files..."):
+                            def show_member(data: dict):
+                                icon = "✅" if data["status"] else "❌"
+                                container.container(border=True).markdown(
+                                    progress_status + f"- ⏳ [{data['done']}/{data['total']}] "
+                                    f"{icon} `{data['file']}` ({data['chunks']} chunks)\n"
+                                )
+
+                            status, message = upload_archive(file, on_progress=show_member)
+                            if not status:
+                                raise RuntimeError(f"Archive processing failed for {file.name}: {message}")
+                            progress_status += f"\n- 📦 {message}\n"
+                            time.sleep(st.secrets.llm.per_step_delay)
+
+                    else:
+                        # Upload file:
+                        with write_progress("Uploading file..."):
+                            status, message = upload_file(file)
+                            if not status:
+                                raise RuntimeError(f"Upload failed for file: {file.name}")
+                            server_file_name = message
+                            time.sleep(st.secrets.llm.per_step_delay)
+
+                        # Embed the file:
+                        with write_progress("Embedding content..."):
+                            status, message = embed_file(server_file_name)
+                            if not status:
+                                raise RuntimeError(f"Embedding failed for file: {file.name}")
+                            time.sleep(st.secrets.llm.per_step_delay)
 
                     # Any last steps like finalizing or cleanup:
                     with write_progress("Finalizing the process..."):
@@ -527,10 +591,10 @@ for ind, message in enumerate(st.session_state.chat_history):
 
 
 if user_message := st.chat_input(
-    placeholder="Enter any queries here... You can also attach [pdf, txt, md] files.",
+    placeholder="Enter any queries here... You can also attach [pdf, txt, md] files or [zip, tar] of them.",
     max_chars=1000,
     accept_file='multiple',
-    file_type=['pdf', 'txt', 'md'],
+    file_type=['pdf', 'txt', 'md', 'zip', 'tar', 'gz', 'tgz', 'bz2', 'xz'],
     # on_submit=submit_handler
 ):
     # Create Message object from the user input:
@@ -601,22 +665,43 @@ if user_message := st.chat_input(
                 )
 
                 documents = []
+                file_records = {}       # File level metadata, shared by the context documents
                 resp_holder = st.container(border=True)
                 document_holder = resp_holder.empty()
                 reply_holder = resp_holder.empty()
 
-                for chunk in response.iter_content(chunk_size=None):
+                chunks = response.iter_content(chunk_size=None)
+                # Server busy, the request was not queued:
+                if response.status_code == 429:
+                    retry_after = response.headers.get("Retry-After", "a few")
+                    full = f"Server is busy, please retry in {retry_after} seconds."
+                    reply_holder.warning(full, icon="⏳")
+                    chunks = []
+
+                for chunk in chunks:
                     if chunk:
                         decoded = chunk.decode("utf-8")
                         decoded = json.loads(decoded)
 
                         if decoded["type"] == "metadata":
-                            # Skip metadata for now
+                            # Keep the file records, sent once before the context documents:
+                            file_records.update(decoded['data'].get("file_records", {}))
                             continue
                             # full += f"```json\n{json.dumps(decoded['data'], indent=2)}\n```\n\n\n"
 
+                        elif decoded["type"] == "queued":
+                            # Waiting for a free generation slot:
+                            reply_holder.info(f"Waiting in queue, position {decoded['data']['position']}...", icon="⏳")
+                            continue
+
                         elif decoded["type"] == "context":
-                            documents.append(decoded['data'])
+                            # Empty when the turn needed no retrieval:
+                            if decoded['data']:
+                                doc = decoded['data']
+                                # Merge back the file level fields (title, total_pages, file_path, ...):
+                                metadata = dict(doc['metadata'])
+                                record = file_records.get(metadata.pop("file_ref", None), {})
+                                documents.append({**doc, "metadata": {**record, **metadata}})
 
                         elif decoded["type"] == "content":
                             full += decoded["data"]
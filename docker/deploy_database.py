@@ -4,23 +4,33 @@
 """ Database Module for LLM System
 - Contains the `VectorDB` class to manage a vector database using FAISS and Ollama embeddings.
 - Provides methods to initialize the database, retrieve embeddings, and perform similarity searches.
+- Keeps a BM25 lexical index of the same chunks, for hybrid (lexical + vector) search.
 """
 
 import os
-from typing import Tuple, Optional
+import json
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Set, Tuple, Optional
 from langchain_core.documents import Document
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_core.runnables import ConfigurableField
 
+from llm_system.core.scheduler import PriorityScheduler, ScheduledEmbeddings
+from llm_system.core.lexical import LexicalIndex
+from llm_system.core.retriever import VectorDBRetriever, RetrieverState, RetrievalCache
+
 # For type hinting
 from langchain_core.embeddings import Embeddings
 from langchain_core.vectorstores import VectorStore
-from langchain_core.vectorstores import VectorStoreRetriever
+from langchain_core.retrievers import BaseRetriever
 
 # config:
-from llm_system.config import VECTOR_DB_PERSIST_DIR, VECTOR_DB_INDEX_NAME
+from llm_system.config import VECTOR_DB_PERSIST_DIR, VECTOR_DB_INDEX_NAME, FILE_RECORDS_NAME, LEXICAL_INDEX_DIR
+from llm_system.config import RETRIEVAL_CACHE_SIZE, MMR_FETCH_K, MMR_LAMBDA
+from llm_system.utils.mmr import mmr_search
 
+from metrics import VECTORDB_SECONDS
 from logger import get_logger
 log = get_logger(name="core_database")
 
@@ -34,11 +44,20 @@ class VectorDB:
         verify_connection (bool): Whether to verify the connection to the embeddings model.
         persist_path (str, optional): Path to the persisted FAISS database. If None, a new DB is created.
         index_name (str, optional): Name of the FAISS index file. Defaults to "index.faiss".
+        scheduler (PriorityScheduler, optional): Scheduler to prioritize query embeddings over ingestion.
+        embeddings (Embeddings, optional): Use this embeddings model instead of the Ollama one (benchmarks).
 
     ## Functions:
         + `get_embeddings()`: Returns the Ollama embeddings model.
         + `get_vector_store()`: Returns the FAISS vector store.
-        + `get_retriever()`: Returns the retriever configured for similarity search.
+        + `get_retriever()`: Returns the retriever configured for similarity / mmr / hybrid search.
+        + `mmr_search()`: Vectorised MMR search over the vectors stored in the FAISS index.
+        + `get_retrieval_stats()`: Returns the latency of each search leg, and the result cache hit rate.
+        + `index_chunks()`: Adds chunks (already in the vector store) to the lexical index, bumps corpus version.
+        + `delete_documents()`: Deletes chunks from both the vector store and the lexical index.
+        + `corpus_version(users)`: Version stamp of the chunks visible to the users (for caches).
+        + `add_corpus_listener(fn)`: Calls `fn(user_id)` whenever the chunks of a user change.
+        + `add_file_record()` / `get_file_records()`: File level metadata shared by the chunks of a file.
     """
 
     def __init__(
@@ -46,11 +65,17 @@ class VectorDB:
         retriever_num_docs: int = 5,
         verify_connection: bool = False,
         persist_path: Optional[str] = VECTOR_DB_PERSIST_DIR,
-        index_name: Optional[str] = VECTOR_DB_INDEX_NAME
+        index_name: Optional[str] = VECTOR_DB_INDEX_NAME,
+        scheduler: Optional[PriorityScheduler] = None,
+        embeddings: Optional[Embeddings] = None
     ):
         self.persist_path: Optional[str] = persist_path
         self.index_name: Optional[str] = index_name
 
+        # FAISS index and docstore are not thread safe for writes.
+        # Hold this lock while adding / deleting / saving from worker threads.
+        self.write_lock = threading.RLock()
+
         log.info(
             f"Initializing VectorDB with embeddings='{embed_model}', path='{persist_path}', k={retriever_num_docs} docs."
         )
@@ -58,7 +83,14 @@ class VectorDB:
         # Here, I have configured the model to be loaded on CPU completely.
         # Reason: Ollama keeps alternately loading and unloading the LLM/Emb model on GPU.
         # Solution: Load the LLM on GPU and the Embedding model on CPU 100%.
-        self.embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004",)
+        if embeddings is None:
+            self.embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004",)
+        else:
+            self.embeddings = embeddings
+
+        # Wrap before FAISS gets it, so both ingestion and retrieval go through the scheduler:
+        if scheduler is not None:
+            self.embeddings = ScheduledEmbeddings(self.embeddings, scheduler)
 
         if verify_connection:
             try:
@@ -95,6 +127,23 @@ class VectorDB:
             self.db = FAISS.from_documents([dummy_doc], embedding=self.embeddings)
             log.info("Created a new FAISS vector store in memory with a dummy document.")
 
+        # File level metadata, referenced by `file_ref` in chunk metadata:
+        self.file_records: Dict[str, Dict[str, Any]] = {}
+        if persist_path and os.path.exists(os.path.join(persist_path, FILE_RECORDS_NAME)):
+            with open(os.path.join(persist_path, FILE_RECORDS_NAME), encoding="utf-8") as f:
+                self.file_records = json.load(f)
+            log.info(f"Loaded {len(self.file_records)} file records from disk.")
+
+        # BM25 index of the same chunks, built from the docstore if not persisted yet:
+        self.lexical = LexicalIndex(os.path.join(persist_path, LEXICAL_INDEX_DIR) if persist_path else None)
+        if not self.lexical.load():
+            self.lexical.rebuild(self.db.docstore._dict.items())  # type: ignore[attr-defined]
+            self.lexical.save()
+
+        # In memory version of each user's chunks, caches keyed by it go stale on any change:
+        self._corpus_versions: Dict[str, int] = {}
+        self._corpus_listeners: List[Callable[[str], None]] = []
+
         # self.retriever = self.db.as_retriever(
         #     search_type="similarity",
         #     search_kwargs={"k": retriever_num_docs, "filter":{"user_id": "public"}},
@@ -105,7 +154,16 @@ class VectorDB:
         # Basically no way to pass args at runtime
         # Hence, using configurable retriever:
         # https://github.com/langchain-ai/langchain/issues/9195#issuecomment-2095196865
-        retriever = self.db.as_retriever()
+        # Custom retriever, as `VectorStoreRetriever` ignores `search_type` in search kwargs:
+        # Search results are cached per corpus version, and dropped eagerly when a user's chunks change:
+        cache = RetrievalCache(version_fn=self.corpus_version) if RETRIEVAL_CACHE_SIZE else None
+        if cache is not None:
+            self.add_corpus_listener(cache.invalidate_user)
+        self._retriever_state = RetrieverState(cache=cache)
+        retriever = VectorDBRetriever(
+            vector_store=self.db, lexical=self.lexical,
+            search_kwargs={"k": retriever_num_docs}, state=self._retriever_state,
+        )
         configurable_retriever = retriever.configurable_fields(
             search_kwargs=ConfigurableField(
                 id="search_kwargs",
@@ -120,7 +178,7 @@ class VectorDB:
         #     config={"configurable": {
         #         "search_kwargs": {
         #             "k": 5,
-        #             "search_type": "similarity",
+        #             "search_type": "similarity",  # or "mmr" / "hybrid"
         #             # And here comes the main thing:
         #             "filter": {
         #                 "$or": [
@@ -143,10 +201,85 @@ class VectorDB:
         log.info("Returning the FAISS vector store instance.")
         return self.db
 
-    def get_retriever(self) -> VectorStoreRetriever:
+    def get_retriever(self) -> BaseRetriever:
         log.info("Returning the retriever for similarity search.")
         return self.retriever # type: ignore[return-value]
 
+    def mmr_search(self, query: str, k: int = 4, fetch_k: int = MMR_FETCH_K, lambda_mult: float = MMR_LAMBDA,
+                   filter: Optional[Dict[str, Any]] = None) -> List[Document]:
+        """Docs relevant to the query but diverse among themselves, the candidates are not re-embedded.
+        - Same as `search_type: "mmr"` in the retriever's `search_kwargs`.
+        """
+        embedding = self.embeddings.embed_query(query)
+        return [doc for doc, _ in mmr_search(self.db, embedding, k, fetch_k, lambda_mult, filter)]
+
+    def count_vectors(self) -> int:
+        """Returns the num of vectors (chunks) in the FAISS index."""
+        return self.db.index.ntotal
+
+    def get_retrieval_stats(self) -> Dict[str, Any]:
+        """Returns the latency of the dense / mmr / lexical / hybrid searches, and the result cache stats."""
+        return self._retriever_state.get_stats()
+
+    def index_chunks(self, user_id: str, doc_ids: List[str], texts: List[str]):
+        """Add the chunks just added to the vector store to the lexical index (call under `write_lock`)."""
+        self.lexical.add(user_id, doc_ids, texts)
+        self._bump_corpus({user_id})
+
+    def delete_documents(self, ids: List[str]) -> Optional[bool]:
+        """Delete chunks by their ids from the vector store and the lexical index (not saved to disk)."""
+        with self.write_lock:
+            resp = self.db.delete(ids)
+            users = self.lexical.delete(ids)
+        self._bump_corpus(users)
+        return resp
+
+    def _bump_corpus(self, users: Set[str]):
+        with self.write_lock:
+            for user_id in users:
+                self._corpus_versions[user_id] = self._corpus_versions.get(user_id, 0) + 1
+        for user_id in users:
+            for listener in self._corpus_listeners:
+                try:
+                    listener(user_id)
+                except Exception as e:
+                    log.error(f"Corpus listener failed for user '{user_id}': {e}")
+
+    def corpus_version(self, users: Optional[Iterable[str]] = None) -> str:
+        """Version stamp of the chunks visible to the users (all users if None), like `public:0|u1:3`.
+        - Users without any chunk are left out, so that all of them share the same stamp.
+        """
+        visible = self.lexical.users() if users is None else [u for u in users if self.lexical.doc_count(u)]
+        return "|".join(f"{u}:{self._corpus_versions.get(u, 0)}" for u in sorted(visible))
+
+    def add_corpus_listener(self, listener: Callable[[str], None]):
+        """Register `listener(user_id)`, called after the chunks of a user are added or deleted."""
+        self._corpus_listeners.append(listener)
+
+    def add_file_record(self, file_ref: str, record: Dict[str, Any]):
+        """Store the file level metadata shared by all chunks having `file_ref` (saved with the DB)."""
+        with self.write_lock:
+            self.file_records[file_ref] = record
+
+    def get_file_records(self, file_refs: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Returns the file records for the given refs, unknown refs are skipped."""
+        return {ref: self.file_records[ref] for ref in file_refs if ref in self.file_records}
+
+    def prune_file_records(self) -> int:
+        """Drop the file records no longer referenced by any chunk. Returns the number dropped."""
+        with self.write_lock:
+            in_use = {
+                doc.metadata.get("file_ref")
+                for doc in self.db.docstore._dict.values()  # type: ignore[attr-defined]
+            }
+            unused = [ref for ref in self.file_records if ref not in in_use]
+            for ref in unused:
+                del self.file_records[ref]
+
+        if unused:
+            log.info(f"Pruned {len(unused)} unused file records.")
+        return len(unused)
+
     def save_db_to_disk(self) -> bool:
         """Saves the current vector store to disk if a persist path is set.
         Returns:
@@ -162,7 +295,14 @@ class VectorDB:
                 else:
                     index_base_name = self.index_name
 
-                self.db.save_local(self.persist_path, index_name=index_base_name)
+                with self.write_lock, VECTORDB_SECONDS.time(op="save"):
+                    self.db.save_local(self.persist_path, index_name=index_base_name)
+                    self.lexical.save()
+
+                    records_path = os.path.join(self.persist_path, FILE_RECORDS_NAME)
+                    with open(f"{records_path}.tmp", "w", encoding="utf-8") as f:
+                        json.dump(self.file_records, f, ensure_ascii=False, separators=(",", ":"), default=str)
+                    os.replace(f"{records_path}.tmp", records_path)
                 log.info(f"Vector store saved to disk at '{self.persist_path}/{self.index_name}'.")
                 return True
             except Exception as e:
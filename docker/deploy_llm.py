@@ -3,23 +3,31 @@
 
 """LLM system module for managing language model interactions.
 This module provides functions to initialize and manage LLM models, and Parsers
+Also contains the `ModelRouter`, which assigns models to the chain stages (condense, answer, simple).
 Also contains dummy response generators for testing purposes.
 """
 
-from time import sleep
+from time import sleep, perf_counter
 from random import choice
-from typing import Generator
+from threading import Lock
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Generator, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
 from langchain_core.language_models.chat_models import BaseChatModel as T_LLM
 
+from llm_system.config import LLM_STAGES, LLM_FALLBACK_WAIT_MS
+
 from logger import get_logger
 log = get_logger(name="core_llm")
 
 
 def get_llm(model_name: str, context_size: int,
-            temperature: float, verify_connection: bool = False) -> T_LLM:
+            temperature: float, verify_connection: bool = False,
+            keep_alive: Union[int, str] = -1) -> T_LLM:
     """Get the LLM model with the specified parameters.
 
     Args:
@@ -27,12 +35,13 @@ def get_llm(model_name: str, context_size: int,
         context_size (int): The maximum context size for the model.
         temperature (float): The temperature setting for the model.
         verify_connection (bool): Whether to verify the connection to the model.
+        keep_alive (int | str): How long the model stays loaded after a request (-1: forever, "5m", ...).
 
     Returns:
         BaseChatModel: An instance of the LLM model configured with the specified parameters.
     """
 
-    log.info(f"Initializing LLM(model={model_name}, ctx_size={context_size}, temp={temperature})")
+    log.info(f"Initializing LLM(model={model_name}, ctx_size={context_size}, temp={temperature}, keep_alive={keep_alive})")
     # model = ChatGoogleGenerativeAI(model="gemma-3-27b-it", temperature=temperature)
     model = ChatGoogleGenerativeAI(model="gemini-2.0-flash-lite", temperature=temperature)
 
@@ -60,6 +69,191 @@ def get_output_parser():
     return StrOutputParser()
 
 
+# ------------------------------------------------------------------------------
+# Model routing per chain stage
+# ------------------------------------------------------------------------------
+
+class _ModelStats:
+    """In flight calls and latency of one model, or of one stage."""
+
+    def __init__(self, window: int = 200):
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.fallbacks = 0
+        self.avg_seconds = 0.0                  # EWMA of the call duration
+        self.durations: Deque[float] = deque(maxlen=window)
+        self.first_tokens: Deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float, first_token: Optional[float]):
+        self.calls += 1
+        self.avg_seconds = seconds if self.calls == 1 else 0.8 * self.avg_seconds + 0.2 * seconds
+        self.durations.append(seconds)
+        if first_token is not None:
+            self.first_tokens.append(first_token)
+
+    def to_dict(self) -> Dict[str, Any]:
+        def _ms(values: Deque[float], q: float) -> float:
+            return round(1000 * float(np.percentile(values, q)), 1) if values else 0.0
+        return {
+            "calls": self.calls, "errors": self.errors, "fallbacks": self.fallbacks, "in_flight": self.in_flight,
+            "p50_ms": _ms(self.durations, 50), "p95_ms": _ms(self.durations, 95),
+            "first_token_p50_ms": _ms(self.first_tokens, 50),
+        }
+
+
+class ModelRouter:
+    """Assigns a model to each chain stage, with a fallback model when the primary one is congested.
+    - Expected wait of a model = its in flight calls x its avg call duration.
+    - A call goes to the stage's fallback if the primary's expected wait exceeds `fallback_wait_ms`
+      and the fallback's is lower, or if the primary fails before its first token.
+    - Each model is loaded once per (temperature, keep-alive), with the largest context size of the stages
+      using it, since Ollama reloads a model whenever its context size changes.
+
+    Args:
+        stages (dict): Stage > `{"model", "fallback", "context_size", "temperature", "keep_alive"}`.
+        fallback_wait_ms (int): Expected wait of the primary model from which the fallback is used.
+        verify_connection (bool): Whether to verify the connection to each model.
+        factory (Callable): Builds a model, same signature as `get_llm` (tests, benchmarks).
+
+    ## Functions:
+        + `get(stage)`: Returns the routed (streaming) chat model runnable of the stage.
+        + `choose(stage)`: Returns the model name a call of the stage would go to now.
+        + `get_stats()`: Returns the calls, fallbacks and latency per stage and per model.
+    """
+
+    def __init__(self, stages: Dict[str, Dict[str, Any]] = LLM_STAGES,
+                 fallback_wait_ms: int = LLM_FALLBACK_WAIT_MS, verify_connection: bool = False,
+                 factory: Callable[..., T_LLM] = get_llm):
+        self.stages = stages
+        self.fallback_wait = fallback_wait_ms / 1000
+
+        # Context size of each model, the largest one of the stages using it:
+        context_sizes: Dict[str, int] = {}
+        for spec in stages.values():
+            for name in (spec["model"], spec.get("fallback")):
+                if name:
+                    context_sizes[name] = max(context_sizes.get(name, 0), spec["context_size"])
+
+        # (stage, model name) > model instance, shared between stages with the same settings:
+        self._models: Dict[Tuple[str, str], T_LLM] = {}
+        instances: Dict[Tuple[str, float, Any], T_LLM] = {}
+        verified = set()
+        for stage, spec in stages.items():
+            for name in (spec["model"], spec.get("fallback")):
+                if not name:
+                    continue
+                key = (name, spec["temperature"], spec["keep_alive"])
+                if key not in instances:
+                    instances[key] = factory(
+                        model_name=name, context_size=context_sizes[name], temperature=spec["temperature"],
+                        verify_connection=verify_connection and name not in verified, keep_alive=spec["keep_alive"])
+                    verified.add(name)
+                self._models[(stage, name)] = instances[key]
+
+        self._lock = Lock()
+        self._model_stats: Dict[str, _ModelStats] = {name: _ModelStats() for name in context_sizes}
+        self._stage_stats: Dict[str, _ModelStats] = {stage: _ModelStats() for stage in stages}
+        log.info(f"Initialized ModelRouter for stages {list(stages)} over models {list(context_sizes)}.")
+
+    def _wait(self, name: str) -> float:
+        stats = self._model_stats[name]
+        return stats.in_flight * stats.avg_seconds
+
+    def choose(self, stage: str) -> str:
+        """Model name for the next call of the stage, by the expected wait of its primary / fallback models."""
+        spec = self.stages[stage]
+        primary, fallback = spec["model"], spec.get("fallback")
+        with self._lock:
+            if fallback and self._wait(primary) > self.fallback_wait and self._wait(fallback) < self._wait(primary):
+                return fallback
+        return primary
+
+    def _candidates(self, stage: str) -> List[str]:
+        """Chosen model first, then the other one (used if the first fails before its first token)."""
+        spec = self.stages[stage]
+        chosen = self.choose(stage)
+        others = [n for n in (spec["model"], spec.get("fallback")) if n and n != chosen]
+        return [chosen, *others]
+
+    def _begin(self, stage: str, name: str):
+        with self._lock:
+            self._model_stats[name].in_flight += 1
+            self._stage_stats[stage].in_flight += 1
+            if name != self.stages[stage]["model"]:
+                self._stage_stats[stage].fallbacks += 1
+
+    def _end(self, stage: str, name: str, start: float, first_token: Optional[float], failed: bool):
+        seconds = perf_counter() - start
+        with self._lock:
+            for stats in (self._model_stats[name], self._stage_stats[stage]):
+                stats.in_flight -= 1
+                if failed:
+                    stats.errors += 1
+                else:
+                    stats.record(seconds, first_token)
+
+    def get(self, stage: str) -> Runnable:
+        """Returns the chat model runnable of the stage, streaming from the model chosen per call."""
+
+        if stage not in self.stages:
+            raise ValueError(f"Unknown LLM stage '{stage}', expected one of {list(self.stages)}")
+
+        def _stream(messages: Any, config: RunnableConfig) -> Iterator[Any]:
+            candidates = self._candidates(stage)
+            for i, name in enumerate(candidates):
+                start, first_token, failed = perf_counter(), None, False
+                self._begin(stage, name)
+                try:
+                    for chunk in self._models[(stage, name)].stream(messages, config):
+                        if first_token is None:
+                            first_token = perf_counter() - start
+                        yield chunk
+                except Exception as e:
+                    failed = True
+                    if first_token is not None or i == len(candidates) - 1:
+                        raise
+                    log.warning(f"LLM '{name}' failed for stage '{stage}', falling back: {e}")
+                finally:
+                    # Also when the consumer stops early (client disconnected):
+                    self._end(stage, name, start, first_token, failed)
+                if not failed:
+                    return
+
+        async def _astream(messages: Any, config: RunnableConfig) -> AsyncIterator[Any]:
+            candidates = self._candidates(stage)
+            for i, name in enumerate(candidates):
+                start, first_token, failed = perf_counter(), None, False
+                self._begin(stage, name)
+                try:
+                    async for chunk in self._models[(stage, name)].astream(messages, config):
+                        if first_token is None:
+                            first_token = perf_counter() - start
+                        yield chunk
+                except Exception as e:
+                    failed = True
+                    if first_token is not None or i == len(candidates) - 1:
+                        raise
+                    log.warning(f"LLM '{name}' failed for stage '{stage}', falling back: {e}")
+                finally:
+                    # Also when the consumer stops early (client disconnected):
+                    self._end(stage, name, start, first_token, failed)
+                if not failed:
+                    return
+
+        return RunnableLambda(_stream, afunc=_astream, name=f"llm_{stage}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns `{"stages": {stage: {...}}, "models": {name: {...}}}` with calls, errors, fallbacks,
+        in flight calls and p50 / p95 / first token latency."""
+        with self._lock:
+            return {
+                "stages": {stage: {"model": self.stages[stage]["model"], **stats.to_dict()}
+                           for stage, stats in self._stage_stats.items()},
+                "models": {name: stats.to_dict() for name, stats in self._model_stats.items()},
+            }
+
+
 # ------------------------------------------------------------------------------
 # Dummy responses of LLM
 # ------------------------------------------------------------------------------
@@ -0,0 +1,6 @@
+"""Benchmarks for the LLM system, run them from `server` folder as modules:
+- Ingestion throughput: `python -m benchmarks.ingestion --help`
+- Prompt prefix reuse: `python -m benchmarks.prefix_reuse --help`
+- MMR search latency: `python -m benchmarks.mmr --help`
+- RAG chain executor overhead: `python -m benchmarks.executor --help`
+"""
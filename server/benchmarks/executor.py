@@ -0,0 +1,149 @@
+"""RAG chain executor overhead benchmark.
+- Runs the same conversations through both executors of `build_rag_chain` (`runnable`, `native`),
+  with fake chat / embedding models streaming instantly, so only the executor overhead is timed.
+- Per executor, times the requests with a short and a long answer:
+    - `per_request_ms`: Avg time of a request with a `--short-tokens` answer (history, condense, retrieval, ...).
+    - `per_token_us`: Extra time per answer token, from the difference between long and short answers.
+- Also checks that both executors stream the same answers and context docs.
+
+## Usage (from `server` folder):
+- `python -m benchmarks.executor --sessions 20 --turns 2`
+- `python -m benchmarks.executor --long-tokens 2000 --json executor.json`
+"""
+
+import json
+import random
+import asyncio
+import argparse
+import tempfile
+import itertools
+from time import perf_counter
+from typing import Any, Dict, List, Tuple
+
+from langchain_core.messages import AIMessage
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+
+from llm_system.core.database import VectorDB
+from llm_system.core.history import HistoryStore
+from llm_system.chains.rag import build_rag_chain
+
+EXECUTORS = ("runnable", "native")
+
+_WORDS = (
+    "retrieval augmented generation model context document vector index query answer token "
+    "embedding chunk page user server stream latency throughput memory cache error code part"
+).split()
+
+
+def _build_db(work_dir: str, chunks: int, seed: int) -> VectorDB:
+    """Vector DB with `chunks` synthetic chunks of ~600 chars."""
+    rng = random.Random(seed)
+    vector_db = VectorDB(embed_model="fake", persist_path=work_dir, embeddings=DeterministicFakeEmbedding(size=64))
+    texts = [" ".join(rng.choices(_WORDS, k=100)) for _ in range(chunks)]
+    metadatas = [{"source": f"synthetic_{i % 3}.pdf", "page": i // 3, "user_id": "benchmark"} for i in range(chunks)]
+    with vector_db.write_lock:
+        doc_ids = vector_db.db.add_texts(texts, metadatas=metadatas)
+        vector_db.index_chunks("benchmark", doc_ids, texts)
+    return vector_db
+
+
+def _fake_llm(responses: List[str]) -> GenericFakeChatModel:
+    return GenericFakeChatModel(messages=iter(itertools.cycle([AIMessage(content=r) for r in responses])))
+
+
+async def run_executor(executor: str, vector_db: VectorDB, questions: List[str], answer: str,
+                       sessions: int, k: int) -> Tuple[float, int, List[Tuple[str, List[str]]]]:
+    """Run `sessions` conversations of all `questions`, returns the total seconds, tokens and outputs."""
+
+    chain = build_rag_chain(
+        llm_chat=_fake_llm([answer]),
+        llm_summary=_fake_llm(questions),
+        retriever=vector_db.get_retriever(),
+        get_history_fn=HistoryStore().get_prompt_history,
+        executor=executor,
+    )
+
+    tokens, outputs = 0, []
+    start = perf_counter()
+    for session in range(sessions):
+        config = {"configurable": {
+            "session_id": f"bench_{executor}_{session}",
+            "search_kwargs": {"k": k, "search_type": "similarity", "filter": {"user_id": "benchmark"}},
+        }}
+        for question in questions:
+            parts, docs = [], []
+            async for chunk in chain.astream({"input": question}, config=config):
+                if "answer" in chunk:
+                    parts.append(chunk["answer"])
+                    tokens += 1
+                elif "context" in chunk:
+                    docs = [doc.page_content for doc in chunk["context"]]
+            outputs.append(("".join(parts), docs))
+    return perf_counter() - start, tokens, outputs
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    """Time both executors with short / long answers, and return the report."""
+
+    rng = random.Random(args.seed)
+    vector_db = _build_db(tempfile.mkdtemp(prefix="executor_bench_"), args.chunks, args.seed)
+    questions = [f"What does {' and '.join(rng.sample(_WORDS, 2))} mean here?" for _ in range(args.turns)]
+    answers = {
+        length: " ".join(rng.choices(_WORDS, k=length)) for length in (args.short_tokens, args.long_tokens)
+    }
+    requests = args.sessions * args.turns
+
+    report: Dict[str, Any] = {"config": {k: v for k, v in vars(args).items() if k != "json"}, "executors": {}}
+    outputs = {}
+    for executor in EXECUTORS:
+        await run_executor(executor, vector_db, questions, answers[args.short_tokens], 1, args.k)  # Warm up
+        short_seconds, short_tokens, outputs[executor] = await run_executor(
+            executor, vector_db, questions, answers[args.short_tokens], args.sessions, args.k)
+        long_seconds, long_tokens, _ = await run_executor(
+            executor, vector_db, questions, answers[args.long_tokens], args.sessions, args.k)
+        report["executors"][executor] = {
+            "per_request_ms": round(1000 * short_seconds / requests, 3),
+            "per_token_us": round(1e6 * (long_seconds - short_seconds) / max(long_tokens - short_tokens, 1), 3),
+            "long_request_ms": round(1000 * long_seconds / requests, 3),
+        }
+
+    report["same_outputs"] = outputs["runnable"] == outputs["native"]
+    runnable, native = report["executors"]["runnable"], report["executors"]["native"]
+    report["speedup"] = {
+        metric: round(runnable[metric] / max(native[metric], 1e-9), 2)
+        for metric in ("per_request_ms", "per_token_us", "long_request_ms")
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG chain executor overhead benchmark.")
+    parser.add_argument("--sessions", type=int, default=20, help="Conversations per run.")
+    parser.add_argument("--turns", type=int, default=2, help="Turns per conversation (later ones condense).")
+    parser.add_argument("--k", type=int, default=4, help="Docs retrieved per turn.")
+    parser.add_argument("--chunks", type=int, default=60, help="Chunks in the synthetic corpus.")
+    parser.add_argument("--short-tokens", type=int, default=1, help="Words of the short fake answer.")
+    parser.add_argument("--long-tokens", type=int, default=500, help="Words of the long fake answer.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", default=None, help="Write the report to this JSON file.")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_benchmark(args))
+
+    print(f"{'executor':<12}{'per request ms':>16}{'per token us':>16}{'long request ms':>18}")
+    for executor, stats in report["executors"].items():
+        print(f"{executor:<12}{stats['per_request_ms']:>16}{stats['per_token_us']:>16}{stats['long_request_ms']:>18}")
+    speedup = report["speedup"]
+    print(f"{'speedup':<12}{'x' + str(speedup['per_request_ms']):>16}{'x' + str(speedup['per_token_us']):>16}"
+          f"{'x' + str(speedup['long_request_ms']):>18}")
+    print(f"Same answers and context: {report['same_outputs']}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""Ingestion throughput benchmark.
+- Generates a synthetic corpus of PDF / TXT / MD files of configurable size.
+- Runs every stage of ingestion on it: `load_file` > `split_text` > embed + add > `save_db_to_disk`,
+  followed by an end to end `ingest_file` pass on a fresh vector DB.
+- Reports pages/sec, chunks/sec, embedding time, index save time and peak RSS of each stage.
+- The embedder is pluggable, `fake` needs no network / Ollama at all.
+
+## Usage (from `server` folder):
+- `python -m benchmarks.ingestion --files 4 --pages 20 --types pdf,txt --embedder fake`
+- `python -m benchmarks.ingestion --embedder ollama:mxbai-embed-large:latest --json run_1.json`
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
+
+import fitz  # PyMuPDF
+from langchain_core.embeddings import Embeddings, DeterministicFakeEmbedding
+
+from llm_system.utils import parse_cache
+from llm_system.utils.loader import load_file
+from llm_system.utils.splitter import split_text
+from llm_system.core.database import VectorDB
+from llm_system.core.ingestion import ingest_file
+
+_WORDS = (
+    "retrieval augmented generation model context document vector index query answer token "
+    "embedding chunk page user server stream latency throughput memory cache error code part "
+    "number contract policy refund section table figure result method dataset training"
+).split()
+
+
+# ------------------------------------------------------------------------------
+# Corpus generation:
+# ------------------------------------------------------------------------------
+
+def _page_text(rng: random.Random, chars: int) -> str:
+    """Random sentences of known vocabulary, with some ids / numbers in between."""
+    sentences, size = [], 0
+    while size < chars:
+        words = rng.choices(_WORDS, k=rng.randint(8, 20))
+        if rng.random() < 0.2:
+            words.append(f"XJ-{rng.randint(1000, 9999)}")
+        sentence = " ".join(words).capitalize() + "."
+        sentences.append(sentence)
+        size += len(sentence) + 1
+    return " ".join(sentences)
+
+
+def generate_corpus(out_dir: str, files: int, pages: int, chars_per_page: int,
+                    types: List[str], seed: int = 42) -> List[str]:
+    """Write `files` files per type into `out_dir`, each having `pages` pages of text.
+
+    Returns:
+        List[str]: Absolute paths of the generated files.
+    """
+
+    rng = random.Random(seed)
+    paths = []
+
+    for ext in types:
+        for i in range(files):
+            path = os.path.join(out_dir, f"synthetic_{i}.{ext}")
+            texts = [_page_text(rng, chars_per_page) for _ in range(pages)]
+
+            if ext == "pdf":
+                doc = fitz.open()
+                for text in texts:
+                    page = doc.new_page()
+                    page.insert_textbox(page.rect + (36, 36, -36, -36), text, fontsize=8)
+                doc.set_metadata({"title": f"Synthetic {i}", "author": "benchmark", "producer": "fitz"})
+                doc.save(path)
+                doc.close()
+
+            elif ext == "md":
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write("\n\n".join(f"## Section {p}\n\n{text}" for p, text in enumerate(texts)))
+
+            else:
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write("\n\n".join(texts))
+
+            paths.append(os.path.abspath(path))
+
+    return paths
+
+
+# ------------------------------------------------------------------------------
+# Measurement helpers:
+# ------------------------------------------------------------------------------
+
+def _rss_bytes() -> int:
+    """Current resident set size of this process (Linux), else the peak so far."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StageMeter:
+    """Times stages and samples RSS in a background thread to find the peak of each stage."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self._peak = 0
+        self._running = False
+
+    def _sample(self):
+        while self._running:
+            self._peak = max(self._peak, _rss_bytes())
+            threading.Event().wait(self.interval)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Dict[str, float]]:
+        """Measure one run of a stage, runs of same stage are accumulated."""
+        extra: Dict[str, float] = {}
+        self._peak = _rss_bytes()
+        self._running = True
+        sampler = threading.Thread(target=self._sample, daemon=True)
+        sampler.start()
+        start = perf_counter()
+        try:
+            yield extra
+        finally:
+            elapsed = perf_counter() - start
+            self._running = False
+            sampler.join()
+            self._peak = max(self._peak, _rss_bytes())
+
+            stats = self.stages.setdefault(name, {"seconds": 0.0, "peak_rss_mb": 0.0})
+            stats["seconds"] += elapsed
+            stats["peak_rss_mb"] = max(stats["peak_rss_mb"], self._peak / (1024 * 1024))
+            for key, value in extra.items():
+                stats[key] = stats.get(key, 0) + value
+
+
+def get_embedder(spec: str, size: int) -> Embeddings:
+    """Build the embedder from its spec: `fake` or `ollama:<model_name>`."""
+    if spec == "fake":
+        return DeterministicFakeEmbedding(size=size)
+    if spec.startswith("ollama:"):
+        from langchain_ollama import OllamaEmbeddings
+        return OllamaEmbeddings(model=spec[len("ollama:"):], num_gpu=0, keep_alive=-1)
+    raise ValueError(f"Unknown embedder '{spec}', use 'fake' or 'ollama:<model>'.")
+
+
+# ------------------------------------------------------------------------------
+# Benchmark:
+# ------------------------------------------------------------------------------
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    """Generate the corpus, run all stages and the end to end pass, and return the report.
+    - Everything is written to a temp dir (removed afterwards), the real parse cache is restored.
+    """
+
+    cache_dir = parse_cache.PARSE_CACHE_DIR
+    try:
+        with tempfile.TemporaryDirectory(prefix="ingest_bench_") as work_dir:
+            return _run_stages(args, work_dir)
+    finally:
+        parse_cache.PARSE_CACHE_DIR = cache_dir
+
+
+def _run_stages(args: argparse.Namespace, work_dir: str) -> Dict[str, Any]:
+    """Run the benchmark inside `work_dir`."""
+
+    corpus_dir = os.path.join(work_dir, "corpus")
+    os.makedirs(corpus_dir)
+
+    # Keep the parse cache of the benchmark away from the real one:
+    parse_cache.PARSE_CACHE_DIR = os.path.join(work_dir, "parse_cache")
+
+    types = [t.strip().lower() for t in args.types.split(",") if t.strip()]
+    paths = generate_corpus(corpus_dir, args.files, args.pages, args.chars_per_page, types, args.seed)
+    corpus_bytes = sum(os.path.getsize(p) for p in paths)
+
+    embedder = get_embedder(args.embedder, args.embed_size)
+    meter = StageMeter()
+    vector_db = VectorDB(
+        embed_model=args.embedder, persist_path=os.path.join(work_dir, "faiss_stages"), embeddings=embedder)
+    totals = {"pages": 0, "chunks": 0}
+    errors: List[str] = []
+    loaded: List[str] = []
+
+    for path in paths:
+        with meter.stage("load") as extra:
+            try:
+                status, pages, message = load_file("benchmark", path)
+            except Exception as e:
+                status, pages, message = False, [], repr(e)
+            extra["pages"] = len(pages)
+        if not status:
+            errors.append(f"{os.path.basename(path)}: {message}")
+            continue
+
+        with meter.stage("split") as extra:
+            _, chunks, _ = split_text(pages)
+            extra["chunks"] = len(chunks)
+
+        with meter.stage("embed"):
+            vectors = embedder.embed_documents([c.page_content for c in chunks])
+
+        with meter.stage("index_add"):
+            vector_db.db.add_embeddings(
+                text_embeddings=list(zip([c.page_content for c in chunks], vectors)),
+                metadatas=[c.metadata for c in chunks],
+            )
+
+        with meter.stage("index_save"):
+            vector_db.save_db_to_disk()
+
+        loaded.append(path)
+        totals["pages"] += len(pages)
+        totals["chunks"] += len(chunks)
+
+    # Second load pass, served from the parse cache:
+    if args.warm_cache:
+        for path in loaded:
+            with meter.stage("load_cached") as extra:
+                _, pages, _ = load_file("benchmark", path)
+                extra["pages"] = len(pages)
+
+    # End to end, on a fresh DB:
+    e2e: Dict[str, Any] = {}
+    if not args.skip_e2e:
+        # Cold parse cache, so that it measures the parsing too:
+        parse_cache.PARSE_CACHE_DIR = os.path.join(work_dir, "parse_cache_e2e")
+        e2e_db = VectorDB(
+            embed_model=args.embedder, persist_path=os.path.join(work_dir, "faiss_e2e"), embeddings=embedder)
+        for path in loaded:
+            with meter.stage("ingest_file") as extra:
+                status, doc_ids, _ = ingest_file("benchmark", path, e2e_db, embedder)
+                extra["chunks"] = len(doc_ids)
+
+    # Derived rates:
+    stages = meter.stages
+    for name, stats in stages.items():
+        stats["seconds"] = round(stats["seconds"], 4)
+        stats["peak_rss_mb"] = round(stats["peak_rss_mb"], 1)
+        for unit in ("pages", "chunks"):
+            if unit in stats and stats["seconds"] > 0:
+                stats[f"{unit}_per_sec"] = round(stats[unit] / stats["seconds"], 2)
+
+    if "ingest_file" in stages:
+        e2e = {
+            "seconds": stages["ingest_file"]["seconds"],
+            "chunks_per_sec": stages["ingest_file"].get("chunks_per_sec", 0.0),
+            "pages_per_sec": round(totals["pages"] / max(stages["ingest_file"]["seconds"], 1e-9), 2),
+        }
+
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "json"},
+        "corpus": {"files": len(paths), "bytes": corpus_bytes, **totals},
+        "stages": stages,
+        "summary": {
+            "pages_per_sec": stages.get("load", {}).get("pages_per_sec", 0.0),
+            "chunks_per_sec": stages.get("split", {}).get("chunks_per_sec", 0.0),
+            "embed_seconds": stages.get("embed", {}).get("seconds", 0.0),
+            "index_save_seconds": stages.get("index_save", {}).get("seconds", 0.0),
+            "peak_rss_mb": max((s["peak_rss_mb"] for s in stages.values()), default=0.0),
+            "end_to_end": e2e,
+        },
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingestion throughput benchmark.")
+    parser.add_argument("--files", type=int, default=4, help="Files per type.")
+    parser.add_argument("--pages", type=int, default=20, help="Pages per file.")
+    parser.add_argument("--chars-per-page", type=int, default=3000, help="Approx chars per page.")
+    parser.add_argument("--types", default="pdf,txt", help="Comma separated: pdf,txt,md.")
+    parser.add_argument("--embedder", default="fake", help="'fake' or 'ollama:<model>'.")
+    parser.add_argument("--embed-size", type=int, default=1024, help="Vector size of the fake embedder.")
+    parser.add_argument("--warm-cache", action="store_true", help="Also time loads served from parse cache.")
+    parser.add_argument("--skip-e2e", action="store_true", help="Skip the end to end ingest_file pass.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", default=None, help="Write the report to this JSON file.")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+
+    print(f"Corpus: {report['corpus']}")
+    print(f"{'stage':<14}{'seconds':>10}{'pages/s':>12}{'chunks/s':>12}{'peak MB':>10}")
+    for name, stats in report["stages"].items():
+        print(f"{name:<14}{stats['seconds']:>10}{stats.get('pages_per_sec', '-'):>12}"
+              f"{stats.get('chunks_per_sec', '-'):>12}{stats['peak_rss_mb']:>10}")
+    for error in report["errors"]:
+        print(f"Error: {error}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""MMR search latency benchmark.
+- Builds a FAISS store of synthetic chunk vectors, where the chunks of a page are near duplicates of
+  each other (like the `DOC_OVERLAP_NO` overlapping chunks of real pages).
+- Times, for the same query vectors:
+    - `similarity`: Plain FAISS similarity search.
+    - `mmr_langchain`: langchain's `max_marginal_relevance_search_by_vector` (per vector reconstruction).
+    - `mmr_vectorised`: `llm_system.utils.mmr.mmr_search` (batch reconstruction, vectorised selection).
+- Also reports the avg num of distinct pages in the results, i.e. how much MMR diversifies them.
+
+## Usage (from `server` folder):
+- `python -m benchmarks.mmr --vectors 20000 --dim 1024 --fetch-k 20,50,100`
+- `python -m benchmarks.mmr --filter --json mmr.json`
+"""
+
+import json
+import argparse
+from time import perf_counter
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+
+from llm_system.utils.mmr import mmr_search
+
+
+def build_store(vectors: int, dim: int, chunks_per_page: int, seed: int) -> FAISS:
+    """FAISS store of `vectors` chunk vectors, `chunks_per_page` near duplicates per page, 2 users."""
+    rng = np.random.default_rng(seed)
+    pages = -(-vectors // chunks_per_page)
+    centers = rng.normal(size=(pages, dim)).astype(np.float32)
+    matrix = np.repeat(centers, chunks_per_page, axis=0)[:vectors]
+    matrix += 0.3 * rng.normal(size=matrix.shape).astype(np.float32)
+
+    texts = [f"chunk {i}" for i in range(vectors)]
+    metadatas = [{"page": i // chunks_per_page, "user_id": f"user_{(i // chunks_per_page) % 2}"}
+                 for i in range(vectors)]
+    return FAISS.from_embeddings(
+        list(zip(texts, matrix.tolist())), embedding=DeterministicFakeEmbedding(size=dim), metadatas=metadatas)
+
+
+def _time(search: Callable[[np.ndarray], List[Document]], queries: np.ndarray) -> Dict[str, Any]:
+    search(queries[0])  # Warm up
+    timings, pages = [], []
+    for query in queries:
+        start = perf_counter()
+        docs = search(query)
+        timings.append(perf_counter() - start)
+        pages.append(len({doc.metadata["page"] for doc in docs}))
+    timings_ms = 1000 * np.asarray(timings)
+    return {
+        "avg_ms": round(float(timings_ms.mean()), 3),
+        "p95_ms": round(float(np.percentile(timings_ms, 95)), 3),
+        "distinct_pages": round(float(np.mean(pages)), 2),
+    }
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    """Build the store, and time every search type for every `fetch_k`."""
+
+    store = build_store(args.vectors, args.dim, args.chunks_per_page, args.seed)
+    rng = np.random.default_rng(args.seed + 1)
+    # Queries near random chunks, so that the near duplicates of their page rank first:
+    rows = rng.integers(0, args.vectors, size=args.queries)
+    queries = np.vstack([store.index.reconstruct(int(row)) for row in rows])
+    queries += 0.1 * rng.normal(size=queries.shape).astype(np.float32)
+    search_filter = {"user_id": "user_0"} if args.filter else None
+
+    report: Dict[str, Any] = {"config": {k: v for k, v in vars(args).items() if k != "json"}, "runs": []}
+    report["similarity"] = _time(
+        lambda q: store.similarity_search_by_vector(q.tolist(), k=args.k, filter=search_filter), queries)
+
+    for fetch_k in [int(f) for f in args.fetch_k.split(",")]:
+        run = {"fetch_k": fetch_k}
+        run["mmr_langchain"] = _time(lambda q: store.max_marginal_relevance_search_by_vector(
+            q.tolist(), k=args.k, fetch_k=fetch_k, lambda_mult=args.lambda_mult, filter=search_filter), queries)
+        run["mmr_vectorised"] = _time(lambda q: [doc for doc, _ in mmr_search(
+            store, q.tolist(), k=args.k, fetch_k=fetch_k, lambda_mult=args.lambda_mult, filter=search_filter)],
+            queries)
+        run["speedup"] = round(run["mmr_langchain"]["avg_ms"] / max(run["mmr_vectorised"]["avg_ms"], 1e-9), 2)
+        report["runs"].append(run)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MMR search latency benchmark.")
+    parser.add_argument("--vectors", type=int, default=20000, help="Chunk vectors in the index.")
+    parser.add_argument("--dim", type=int, default=1024, help="Vector size (mxbai-embed-large: 1024).")
+    parser.add_argument("--chunks-per-page", type=int, default=4, help="Near duplicate chunks per page.")
+    parser.add_argument("--queries", type=int, default=50, help="Queries timed per search type.")
+    parser.add_argument("--k", type=int, default=5, help="Docs returned per query.")
+    parser.add_argument("--fetch-k", default="20,50,100", help="Comma separated MMR candidate counts.")
+    parser.add_argument("--lambda-mult", type=float, default=0.5, help="MMR relevance / diversity balance.")
+    parser.add_argument("--filter", action="store_true", help="Search with a user_id filter (half the docs).")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", default=None, help="Write the report to this JSON file.")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+
+    similarity = report["similarity"]
+    print(f"{'search':<28}{'avg ms':>10}{'p95 ms':>10}{'pages/result':>14}")
+    print(f"{'similarity':<28}{similarity['avg_ms']:>10}{similarity['p95_ms']:>10}{similarity['distinct_pages']:>14}")
+    for run in report["runs"]:
+        for name in ("mmr_langchain", "mmr_vectorised"):
+            stats = run[name]
+            label = f"{name} (fetch_k={run['fetch_k']})"
+            print(f"{label:<28}{stats['avg_ms']:>10}{stats['p95_ms']:>10}{stats['distinct_pages']:>14}")
+        print(f"{'':<28}speedup x{run['speedup']}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
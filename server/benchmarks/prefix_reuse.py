@@ -0,0 +1,147 @@
+"""Prompt prefix reuse benchmark.
+- Runs the same multi turn conversation through the RAG chain once per prompt layout
+  (`legacy`, `cache_friendly`), with fake chat / embedding models, so no Ollama is needed.
+- For every turn, reports the prompt size and the prefix shared with the previous prompt of the session,
+  i.e. the tokens the backend can serve from its KV cache instead of prefilling them again.
+- The prefill time saved is estimated from `--prefill-tps` (prompt tokens per second of the real model).
+
+## Usage (from `server` folder):
+- `python -m benchmarks.prefix_reuse --turns 8 --k 4`
+- `python -m benchmarks.prefix_reuse --prefill-tps 300 --json prefix_reuse.json`
+"""
+
+import json
+import random
+import argparse
+import tempfile
+import itertools
+from typing import Any, Dict, List
+
+from langchain_core.messages import AIMessage
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+
+from llm_system.core.database import VectorDB
+from llm_system.core.history import HistoryStore
+from llm_system.chains.rag import build_rag_chain
+from llm_system.chains.prefix import PrefixTracker
+
+LAYOUTS = ("legacy", "cache_friendly")
+
+_WORDS = (
+    "retrieval augmented generation model context document vector index query answer token "
+    "embedding chunk page user server stream latency throughput memory cache error code part "
+    "number contract policy refund section table figure result method dataset training"
+).split()
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choices(_WORDS, k=words)).capitalize() + "."
+
+
+def _build_db(work_dir: str, chunks: int, seed: int) -> VectorDB:
+    """Vector DB with `chunks` synthetic chunks of ~1k chars, over a few sources / pages."""
+    rng = random.Random(seed)
+    vector_db = VectorDB(embed_model="fake", persist_path=work_dir, embeddings=DeterministicFakeEmbedding(size=64))
+
+    texts = [" ".join(_text(rng, 15) for _ in range(10)) for _ in range(chunks)]
+    metadatas = [
+        {"source": f"synthetic_{i % 3}.pdf", "page": i // 3, "start_index": 0, "user_id": "benchmark"}
+        for i in range(chunks)
+    ]
+    with vector_db.write_lock:
+        doc_ids = vector_db.db.add_texts(texts, metadatas=metadatas)
+        vector_db.index_chunks("benchmark", doc_ids, texts)
+    return vector_db
+
+
+def run_layout(layout: str, vector_db: VectorDB, questions: List[str], answers: List[str],
+               k: int) -> List[Dict[str, Any]]:
+    """Run the conversation with one prompt layout, and return the per turn reuse metrics."""
+
+    def _fake_llm(responses: List[str]) -> GenericFakeChatModel:
+        return GenericFakeChatModel(messages=iter(itertools.cycle([AIMessage(content=r) for r in responses])))
+
+    tracker = PrefixTracker()
+    history = HistoryStore()
+    chain = build_rag_chain(
+        llm_chat=_fake_llm(answers),
+        # Standalone question = the raw question (first turn has no history, so no summarization):
+        llm_summary=_fake_llm(questions[1:] + questions[:1]),
+        retriever=vector_db.get_retriever(),
+        get_history_fn=history.get_prompt_history,
+        prefix_tracker=tracker,
+        prompt_layout=layout,
+    )
+    config = {"configurable": {
+        "session_id": f"bench_{layout}",
+        "search_kwargs": {"k": k, "search_type": "similarity", "filter": {"user_id": "benchmark"}},
+    }}
+
+    turns = []
+    for question in questions:
+        before = tracker.get_stats()
+        chain.invoke({"input": question}, config=config)
+        after = tracker.get_stats()
+        prompt_tokens = after["prompt_tokens"] - before["prompt_tokens"]
+        prefix_tokens = after["prefix_tokens"] - before["prefix_tokens"]
+        turns.append({
+            "prompt_tokens": prompt_tokens,
+            "prefix_tokens": prefix_tokens,
+            "prefill_tokens": prompt_tokens - prefix_tokens,
+        })
+    return turns
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    """Build the corpus and conversation, run it with every layout, and return the report."""
+
+    rng = random.Random(args.seed)
+    vector_db = _build_db(tempfile.mkdtemp(prefix="prefix_bench_"), args.chunks, args.seed)
+    questions = [f"What does {' and '.join(rng.sample(_WORDS, 2))} mean here?" for _ in range(args.turns)]
+    answers = [" ".join(_text(rng, 20) for _ in range(args.answer_sentences)) for _ in range(args.turns)]
+
+    report: Dict[str, Any] = {"config": {k: v for k, v in vars(args).items() if k != "json"}, "layouts": {}}
+    for layout in LAYOUTS:
+        turns = run_layout(layout, vector_db, questions, answers, args.k)
+        prompt = sum(t["prompt_tokens"] for t in turns)
+        prefix = sum(t["prefix_tokens"] for t in turns)
+        report["layouts"][layout] = {
+            "turns": turns,
+            "prompt_tokens": prompt,
+            "prefix_tokens": prefix,
+            "reuse": round(prefix / max(prompt, 1), 3),
+            "prefill_seconds": round((prompt - prefix) / args.prefill_tps, 2),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prompt prefix reuse benchmark.")
+    parser.add_argument("--turns", type=int, default=8, help="Turns of the conversation.")
+    parser.add_argument("--k", type=int, default=4, help="Docs retrieved per turn.")
+    parser.add_argument("--chunks", type=int, default=60, help="Chunks in the synthetic corpus.")
+    parser.add_argument("--answer-sentences", type=int, default=6, help="Sentences per fake answer.")
+    parser.add_argument("--prefill-tps", type=float, default=400.0, help="Prefill tokens/sec of the model.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", default=None, help="Write the report to this JSON file.")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+
+    print(f"{'turn':<6}" + "".join(f"{layout + ' prompt/reused':>30}" for layout in LAYOUTS))
+    for i in range(args.turns):
+        cells = [report["layouts"][layout]["turns"][i] for layout in LAYOUTS]
+        print(f"{i + 1:<6}" + "".join(f"{c['prompt_tokens']:>22} / {c['prefix_tokens']:<5}" for c in cells))
+    for layout, stats in report["layouts"].items():
+        print(f"{layout:<16} reuse {stats['reuse']:.1%}, prefill {stats['prompt_tokens'] - stats['prefix_tokens']} "
+              f"tokens (~{stats['prefill_seconds']} s at {args.prefill_tps:g} tok/s)")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,15 +8,39 @@ import os
 import time
 import shutil
 import base64
+import hashlib
+import tarfile
+import zipfile
+import tempfile
 import fitz  # PyMuPDF
 from io import BytesIO
-from typing import Tuple
+from threading import RLock
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple, Union
+
+from llm_system.utils import parse_cache
 
 from logger import get_logger
 log = get_logger(name="FILES", log_to_console=False)
 
 UPLOADS_PATH = os.path.abspath("./user_uploads/")
 
+# Bulk (archive) uploads:
+SUPPORTED_EXTENSIONS: Tuple[str, ...] = (".pdf", ".txt", ".md")
+ARCHIVE_EXTENSIONS: Tuple[str, ...] = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+ARCHIVE_MAX_MEMBERS: int = 200                      # Max supported files in one archive
+ARCHIVE_MAX_BYTES: int = 512 * 1024 * 1024          # Max total uncompressed size (512 MB)
+
+# Single file uploads, streamed to disk:
+UPLOAD_CHUNK_BYTES: int = 1024 * 1024               # Read / hash / write chunk size (1 MB)
+UPLOAD_MAX_BYTES: int = 100 * 1024 * 1024           # Max size of one uploaded file (100 MB)
+USER_QUOTA_BYTES: int = 1024 * 1024 * 1024          # Max disk usage of all files of a user (1 GB)
+PARTIAL_SUFFIX: str = ".part"                       # Uploads in progress, renamed on completion
+
+# Quota reserved by the uploads / extractions in progress, per user, so that concurrent ones can't
+# together exceed `USER_QUOTA_BYTES` (reserved per chunk, turned into usage when the file is renamed):
+_quota_lock = RLock()
+_reserved: Dict[str, int] = {}
+
 
 def check_create_uploads_folder() -> str:
     """Check and create the uploads directory if it doesn't exist."""
@@ -43,6 +67,66 @@ def delete_empty_user_folders() -> None:
         log.error(f"Error deleting empty user folders: {repr(e)}")
         
 
+def delete_partial_uploads() -> None:
+    """Delete the partial uploads left behind by a crash / restart, in all user folders."""
+
+    try:
+        for user_folder in os.listdir(UPLOADS_PATH):
+            user_path = os.path.join(UPLOADS_PATH, user_folder)
+            if not os.path.isdir(user_path):
+                continue
+            for name in os.listdir(user_path):
+                if name.startswith(".") and name.endswith(PARTIAL_SUFFIX):
+                    os.remove(os.path.join(user_path, name))
+                    log.info(f"Deleted partial upload: {user_folder}/{name}")
+
+    except Exception as e:
+        log.error(f"Error deleting partial uploads: {repr(e)}")
+
+
+def get_user_usage(user_id: str) -> int:
+    """Bytes used on disk by the user's files, and reserved by their uploads in progress."""
+
+    user_path = os.path.join(UPLOADS_PATH, user_id)
+    with _quota_lock:
+        reserved = _reserved.get(user_id, 0)
+        if not os.path.isdir(user_path):
+            return reserved
+        return reserved + sum(
+            entry.stat().st_size for entry in os.scandir(user_path)
+            if entry.is_file() and not (entry.name.startswith(".") and entry.name.endswith(PARTIAL_SUFFIX))
+        )
+
+
+def _reserve(user_id: str, nbytes: int) -> bool:
+    """Reserve quota for bytes about to be written, False if the user's quota would be exceeded."""
+    with _quota_lock:
+        if get_user_usage(user_id) + nbytes > USER_QUOTA_BYTES:
+            return False
+        _reserved[user_id] = _reserved.get(user_id, 0) + nbytes
+        return True
+
+
+def _unreserve(user_id: str, nbytes: int):
+    """Return reserved quota (the written bytes were discarded, or are now a file)."""
+    with _quota_lock:
+        left = _reserved.get(user_id, 0) - nbytes
+        if left > 0:
+            _reserved[user_id] = left
+        else:
+            _reserved.pop(user_id, None)
+
+
+def _commit(user_id: str, part_path: str, file_name: str, nbytes: int) -> str:
+    """Rename a completed partial file into place with a unique name, its reservation becomes usage.
+    Returns the new file name."""
+    with _quota_lock:
+        new_file_name = _unique_file_name(user_id, file_name)
+        os.replace(part_path, os.path.join(UPLOADS_PATH, user_id, new_file_name))
+        _unreserve(user_id, nbytes)
+    return new_file_name
+
+
 def create_user_uploads_folder(user_id: str) -> bool:
     """Create a user-specific uploads directory if it doesn't exist."""
 
@@ -61,7 +145,7 @@ def create_user_uploads_folder(user_id: str) -> bool:
 
 
 def delete_file(user_id: str, file_name: str) -> bool:
-    """Delete a user file from the uploads directory.
+    """Delete a user file from the uploads directory, along with its parsed-text cache entry.
     Args:
         user_id (str): The name of the user whose file is to be deleted.
         file_name (str): The name of the file to be deleted.
@@ -72,6 +156,7 @@ def delete_file(user_id: str, file_name: str) -> bool:
     file_path = os.path.join(UPLOADS_PATH, user_id, file_name)
     if os.path.isfile(file_path):
         try:
+            parse_cache.evict_file(file_path)
             os.remove(file_path)
             log.info(f"User {user_id} - File deleted: {file_name}")
             return True
@@ -94,14 +179,8 @@ def save_file(user_id: str, file_value_binary: bytes, file_name: str) -> Tuple[b
     """
 
     try:
-        base_name = file_name[:file_name.rfind(".")]
-        ext = file_name[file_name.rfind("."):]
-        new_file_name = base_name.replace(" ", "_").replace(".", "_") + ext
-
-        # check if same name already exists:
+        new_file_name = _unique_file_name(user_id, file_name)
         user_upload_path = os.path.join(UPLOADS_PATH, user_id)
-        while os.path.exists(os.path.join(user_upload_path, new_file_name)):
-            new_file_name = "n_" + new_file_name
 
         # Save the file
         file_path = os.path.join(user_upload_path, new_file_name)
@@ -117,6 +196,243 @@ def save_file(user_id: str, file_value_binary: bytes, file_name: str) -> Tuple[b
         return False, "Error saving file!"
 
 
+def save_upload(user_id: str, source: BinaryIO, file_name: str,
+                find_duplicate: Optional[Callable[[str], Optional[str]]] = None
+                ) -> Tuple[bool, str, Dict[str, Any]]:
+    """Stream an uploaded file to the user's uploads directory, in `UPLOAD_CHUNK_BYTES` chunks.
+    - The SHA-256 and size are computed while writing, the file / quota limits are checked per chunk.
+    - Quota is reserved per chunk, so concurrent uploads of the user can't together exceed it.
+    - Written to a hidden `.part` temp file first, then renamed into place atomically,
+      so readers (embedding, previews) never see a partial file.
+    - If `find_duplicate` returns the name of an identical file of the user, the copy is discarded.
+
+    Args:
+        user_id (str): The name of the user uploading the file.
+        source (BinaryIO): Binary file object of the upload (e.g. the spooled `UploadFile.file`).
+        file_name (str): The original name of the uploaded file.
+        find_duplicate (Callable[[str], Optional[str]]): Returns the user's file name with the given SHA-256, if any.
+    Returns:
+        Tuple[bool, str, Dict[str, Any]]: A success flag, the saved (or duplicate) file name or failure message,
+            and `{"sha256", "size", "duplicate"}` on success / `{"too_large": bool}` on failure.
+    """
+
+    user_upload_path = os.path.join(UPLOADS_PATH, user_id)
+    part_path: Optional[str] = None
+    reserved = 0
+
+    try:
+        fd, part_path = tempfile.mkstemp(prefix=".upload_", suffix=PARTIAL_SUFFIX, dir=user_upload_path)
+        sha256, size = hashlib.sha256(), 0
+        with os.fdopen(fd, "wb") as f:
+            while chunk := source.read(UPLOAD_CHUNK_BYTES):
+                size += len(chunk)
+                too_large = size > UPLOAD_MAX_BYTES
+                if too_large or not _reserve(user_id, len(chunk)):
+                    reason = "File is too large!" if too_large else "Storage quota exceeded!"
+                    log.warning(f"User {user_id} - Upload {file_name} rejected after {size} bytes: {reason}")
+                    return False, (f"{reason} (max {UPLOAD_MAX_BYTES // (1024 * 1024)} MB per file, "
+                                   f"{USER_QUOTA_BYTES // (1024 * 1024)} MB per user)"), {"too_large": True}
+                reserved += len(chunk)
+                sha256.update(chunk)
+                f.write(chunk)
+        digest = sha256.hexdigest()
+
+        duplicate = find_duplicate(digest) if find_duplicate is not None else None
+        if duplicate is not None and os.path.isfile(os.path.join(user_upload_path, duplicate)):
+            log.info(f"User {user_id} - Upload {file_name} is identical to {duplicate}, not saved again")
+            return True, duplicate, {"sha256": digest, "size": size, "duplicate": True}
+
+        new_file_name = _commit(user_id, part_path, file_name, reserved)
+        part_path, reserved = None, 0
+        log.info(f"User {user_id} - File saved: {new_file_name} ({size} bytes)")
+        return True, new_file_name, {"sha256": digest, "size": size, "duplicate": False}
+
+    except Exception as e:
+        log.error(f"User {user_id} - Error saving file {file_name}: {repr(e)}")
+        return False, "Error saving file!", {"too_large": False}
+
+    finally:
+        # Rejected, duplicate or failed upload:
+        if part_path is not None and os.path.exists(part_path):
+            os.remove(part_path)
+        _unreserve(user_id, reserved)
+
+
+def _unique_file_name(user_id: str, file_name: str) -> str:
+    """Sanitize the file name and prefix it with `n_` until it does not clash with user's files."""
+
+    base_name = file_name[:file_name.rfind(".")]
+    ext = file_name[file_name.rfind("."):]
+    new_file_name = base_name.replace(" ", "_").replace(".", "_") + ext
+
+    # check if same name already exists:
+    user_upload_path = os.path.join(UPLOADS_PATH, user_id)
+    while os.path.exists(os.path.join(user_upload_path, new_file_name)):
+        new_file_name = "n_" + new_file_name
+
+    return new_file_name
+
+
+def is_archive(file_name: str) -> bool:
+    """Check if the file name is of a supported archive (zip / tar) type."""
+    return file_name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+class _ArchiveTooLarge(Exception):
+    """Raised while extracting, once the bytes written exceed `ARCHIVE_MAX_BYTES`."""
+
+
+class _QuotaExceeded(Exception):
+    """Raised while extracting, once the user's storage quota is used up."""
+
+
+def extract_archive(user_id: str, archive_file: BinaryIO, archive_name: str,
+                    find_duplicate: Optional[Callable[[str], Optional[str]]] = None
+                    ) -> Tuple[bool, Union[List[Dict[str, Any]], str]]:
+    """Extract the supported files from a zip / tar archive into the user's uploads directory.
+    - Folder structure inside the archive is flattened, only the member file names are kept.
+    - Unsupported members, links and hidden files (like `__MACOSX/`) are skipped.
+    - Member count and total uncompressed size are capped to guard against archive bombs.
+      The declared sizes are only a pre-check, the bytes actually written are counted while copying.
+    - Members are hashed while copying (same as `save_upload`): a member identical to an earlier one, or to
+      a file of the user (`find_duplicate`), is not saved again, and the existing file is returned instead.
+
+    Args:
+        user_id (str): The name of the user uploading the archive.
+        archive_file (BinaryIO): Seekable binary file object of the archive.
+        archive_name (str): The original name of the uploaded archive.
+        find_duplicate (Callable[[str], Optional[str]]): Returns the user's file name with the given SHA-256, if any.
+    Returns:
+        Tuple[bool, Union[List[Dict[str, Any]], str]]: A success flag, and the files as
+            `{"name", "sha256", "size", "duplicate"}` or the failure message.
+    """
+
+    user_upload_path = os.path.join(UPLOADS_PATH, user_id)
+    saved: List[str] = []
+    extracted: List[Dict[str, Any]] = []
+    part_path: Optional[str] = None
+    reserved = 0
+
+    try:
+        # Collect (name, size, opener) for the members to be extracted:
+        if archive_name.lower().endswith(".zip"):
+            archive = zipfile.ZipFile(archive_file)
+            members = [
+                (info.filename, info.file_size, lambda info=info: archive.open(info))
+                for info in archive.infolist() if not info.is_dir()
+            ]
+        else:
+            archive = tarfile.open(fileobj=archive_file, mode="r:*")
+            members = [
+                (info.name, info.size, lambda info=info: archive.extractfile(info))
+                for info in archive.getmembers() if info.isfile()
+            ]
+
+        with archive:
+            members = [
+                (os.path.basename(name), size, opener) for name, size, opener in members
+                if not os.path.basename(name).startswith((".", "_"))
+                and "__MACOSX" not in name
+                and name.lower().endswith(SUPPORTED_EXTENSIONS)
+            ]
+
+            if not members:
+                log.warning(f"User {user_id} - No supported files in archive: {archive_name}")
+                return False, "No supported files (pdf, txt, md) found in the archive!"
+
+            if len(members) > ARCHIVE_MAX_MEMBERS:
+                log.warning(f"User {user_id} - Archive {archive_name} has {len(members)} files")
+                return False, f"Archive has too many files! (max {ARCHIVE_MAX_MEMBERS})"
+
+            if sum(size for _, size, _ in members) > ARCHIVE_MAX_BYTES:
+                log.warning(f"User {user_id} - Archive {archive_name} is too large when extracted")
+                return False, f"Archive is too large! (max {ARCHIVE_MAX_BYTES // (1024 * 1024)} MB extracted)"
+
+            if sum(size for _, size, _ in members) > USER_QUOTA_BYTES - get_user_usage(user_id):
+                raise _QuotaExceeded()
+
+            written = 0
+            seen: Dict[str, str] = {}
+            for name, _, opener in members:
+                source = opener()
+                if source is None:
+                    continue
+
+                fd, part_path = tempfile.mkstemp(prefix=".extract_", suffix=PARTIAL_SUFFIX, dir=user_upload_path)
+                sha256, size = hashlib.sha256(), 0
+                with source, os.fdopen(fd, "wb") as f:
+                    while chunk := source.read(UPLOAD_CHUNK_BYTES):
+                        written += len(chunk)
+                        if written > ARCHIVE_MAX_BYTES:
+                            raise _ArchiveTooLarge()
+                        if not _reserve(user_id, len(chunk)):
+                            raise _QuotaExceeded()
+                        reserved += len(chunk)
+                        size += len(chunk)
+                        sha256.update(chunk)
+                        f.write(chunk)
+                digest = sha256.hexdigest()
+
+                # Same content as an earlier member, or as a file the user already has:
+                duplicate = seen.get(digest)
+                if duplicate is None and find_duplicate is not None:
+                    duplicate = find_duplicate(digest)
+                    if duplicate is not None and not os.path.isfile(os.path.join(user_upload_path, duplicate)):
+                        duplicate = None
+                if duplicate is not None:
+                    os.remove(part_path)
+                    part_path = None
+                    _unreserve(user_id, size)
+                    reserved -= size
+                    log.info(f"User {user_id} - Archive member {name} is identical to {duplicate}, not saved again")
+                    if duplicate not in seen.values():
+                        seen[digest] = duplicate
+                        extracted.append({"name": duplicate, "sha256": digest, "size": size, "duplicate": True})
+                    continue
+
+                new_file_name = _commit(user_id, part_path, name, size)
+                part_path = None
+                reserved -= size
+                saved.append(new_file_name)
+                seen[digest] = new_file_name
+                extracted.append({"name": new_file_name, "sha256": digest, "size": size, "duplicate": False})
+
+        log.info(f"User {user_id} - Extracted {len(saved)} files "
+                 f"({len(extracted) - len(saved)} duplicates) from archive: {archive_name}")
+        return True, extracted
+
+    except _ArchiveTooLarge:
+        log.warning(f"User {user_id} - Archive {archive_name} exceeded {ARCHIVE_MAX_BYTES} bytes while extracting")
+        for name in saved:
+            delete_file(user_id=user_id, file_name=name)
+        return False, f"Archive is too large! (max {ARCHIVE_MAX_BYTES // (1024 * 1024)} MB extracted)"
+
+    except _QuotaExceeded:
+        log.warning(f"User {user_id} - Archive {archive_name} exceeds the storage quota")
+        for name in saved:
+            delete_file(user_id=user_id, file_name=name)
+        return False, f"Storage quota exceeded! (max {USER_QUOTA_BYTES // (1024 * 1024)} MB per user)"
+
+    except (zipfile.BadZipFile, tarfile.TarError) as e:
+        log.error(f"User {user_id} - Invalid archive {archive_name}: {repr(e)}")
+        for name in saved:
+            delete_file(user_id=user_id, file_name=name)
+        return False, "Invalid or corrupt archive!"
+
+    except Exception as e:
+        log.error(f"User {user_id} - Error extracting archive {archive_name}: {repr(e)}")
+        # Do not leave half extracted archive behind:
+        for name in saved:
+            delete_file(user_id=user_id, file_name=name)
+        return False, "Error extracting archive!"
+
+    finally:
+        # The member being copied when it failed:
+        if part_path is not None and os.path.exists(part_path):
+            os.remove(part_path)
+        _unreserve(user_id, reserved)
+
+
 def get_pdf_iframe(user_id: str, file_name: str, num_pages: int = 5) -> Tuple[bool, str]:
     """Return first n pages of asked pdf in an iframe.
 
@@ -200,6 +516,28 @@ if __name__ == "__main__":
     sample_file_content = b"This is a sample file content."
     print(save_file(user, sample_file_content, "sample.a.b c.d.pdf"))
 
+    # Stream a sample upload, the second identical one is found as duplicate:
+    saved = {}
+    for _ in range(2):
+        status, name, info = save_upload(user, BytesIO(sample_file_content), "sample.txt", find_duplicate=saved.get)
+        saved[info["sha256"]] = name
+        print(status, name, info)
+    assert info["duplicate"] and info["sha256"] == hashlib.sha256(sample_file_content).hexdigest()
+    assert not any(n.endswith(PARTIAL_SUFFIX) for n in os.listdir(os.path.join(UPLOADS_PATH, user)))
+    assert save_upload("no_such_user", BytesIO(b"x"), "x.txt")[0] is False, "Saved without user folder"
+
+    # Archive members are deduplicated against each other and the user's files:
+    archive_bytes = BytesIO()
+    with zipfile.ZipFile(archive_bytes, "w") as zf:
+        zf.writestr("a.txt", sample_file_content)
+        zf.writestr("docs/b.txt", sample_file_content)
+        zf.writestr("c.txt", b"Another file.")
+    status, members = extract_archive(user, archive_bytes, "test.zip", find_duplicate=saved.get)
+    print(status, members)
+    assert [m["duplicate"] for m in members] == [True, False], "Archive members not deduplicated"
+    assert not _reserved, "Quota reservation leaked"
+    delete_file(user, members[1]["name"])
+
     # Get PDF iframe:
     file = input(f"Paste one file here, `{UPLOADS_PATH}/{user}/` and paste just the file name: ")
     print(get_pdf_iframe(user, file, num_pages=1))
@@ -0,0 +1,208 @@
+"""Contains the semantic answer cache of the RAG chain.
+- Near identical questions over the same docs get the same answer, without retrieval and generation.
+- Entries are keyed by the standalone question embedding (cosine similarity threshold), within a bucket
+  per user scope of the request filter and version stamp of the docs visible to it (`VectorDB.corpus_version`).
+- Only turns without chat history are looked up and stored, as the answer also depends on the history.
+- A hit replays the stored answer and context through the normal stream, a miss stores the new answer.
+- Buckets depending on a user are dropped as soon as that user's docs change.
+"""
+
+from threading import Lock
+from time import monotonic
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+
+from llm_system.core.retriever import filter_users, stamp_users
+from llm_system.config import (
+    ANSWER_CACHE_MIN_SIM, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SEC
+)
+
+from logger import get_logger
+log = get_logger(name="chains_answer_cache")
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    context: List[Document]
+    created: float = field(default_factory=monotonic)
+
+
+@dataclass
+class CacheLookup:
+    """Result of one lookup, carried through the chain so that a miss can be stored after generation."""
+    scope: str
+    stamp: str
+    vector: np.ndarray
+    question: str
+    entry: Optional[CachedAnswer] = None
+
+    @property
+    def hit(self) -> bool:
+        return self.entry is not None
+
+    @property
+    def bucket(self) -> Tuple[str, str]:
+        return self.scope, self.stamp
+
+
+def _normalize(vector: List[float]) -> np.ndarray:
+    array = np.asarray(vector, dtype=np.float32)
+    return array / (np.linalg.norm(array) + 1e-12)
+
+
+class AnswerCache:
+    """Semantic cache of answers, per version of the docs visible to the user.
+
+    Args:
+        embeddings (Embeddings): Embeddings model for the standalone questions.
+        version_fn (Callable): Returns the version stamp of the docs visible to the given users.
+        min_similarity (float): Min cosine similarity of two questions to share an answer.
+        max_entries (int): Max cached answers in total, least recently used are evicted.
+        ttl (int): Max age of an answer in seconds.
+
+    ## Functions:
+        + `lookup()` / `alookup()`: Returns the lookup result of a standalone question.
+        + `put(lookup, answer, context)`: Stores the answer of a missed lookup.
+        + `invalidate_user(user_id)`: Drops all buckets depending on the user's docs.
+        + `as_answer_stage(qa_chain)`: Returns the answer stage, replaying hits and storing misses.
+        + `get_stats()`: Returns hits, misses, hit rate and size.
+    """
+
+    def __init__(self, embeddings: Embeddings, version_fn: Callable[[Optional[Any]], str],
+                 min_similarity: float = ANSWER_CACHE_MIN_SIM,
+                 max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl: int = ANSWER_CACHE_TTL_SEC):
+        self.embeddings = embeddings
+        self.version_fn = version_fn
+        self.min_similarity = min_similarity
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._lock = Lock()
+        # (scope, stamp) > [(vector, entry)], and the LRU order of ((scope, stamp), entry id):
+        self._buckets: Dict[Tuple[str, str], List[Tuple[np.ndarray, CachedAnswer]]] = {}
+        self._lru: "OrderedDict[Tuple[Tuple[str, str], int], None]" = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "stored": 0, "invalidated": 0}
+        log.info(f"Initialized AnswerCache(min_similarity={min_similarity}, max_entries={max_entries}).")
+
+    def _key(self, config: RunnableConfig) -> Tuple[str, str]:
+        """The users allowed by the request filter (`*` if unrestricted), and the version stamp of their docs."""
+        search_kwargs = config.get("configurable", {}).get("search_kwargs") or {}
+        users = filter_users(search_kwargs.get("filter"))
+        scope = "|".join(sorted(users)) if users is not None else "*"
+        return scope, self.version_fn(users)
+
+    def _find(self, key: Tuple[str, str], vector: np.ndarray, question: str) -> CacheLookup:
+        lookup = CacheLookup(scope=key[0], stamp=key[1], vector=vector, question=question)
+        with self._lock:
+            bucket = self._buckets.get(key, [])
+            now = monotonic()
+            expired = [e for _, e in bucket if now - e.created > self.ttl]
+            if expired:
+                bucket[:] = [(v, e) for v, e in bucket if now - e.created <= self.ttl]
+                for entry in expired:
+                    self._lru.pop((key, id(entry)), None)
+            if bucket:
+                similarities = np.stack([v for v, _ in bucket]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.min_similarity:
+                    lookup.entry = bucket[best][1]
+                    self._lru.move_to_end((key, id(lookup.entry)), last=True)
+
+            self._stats["hits" if lookup.hit else "misses"] += 1
+            hits, total = self._stats["hits"], self._stats["hits"] + self._stats["misses"]
+
+        if lookup.hit:
+            log.info(f"Answer cache hit for '{question[:60]}', hit rate {hits / total:.1%}.")
+        return lookup
+
+    def lookup(self, question: str, config: RunnableConfig) -> CacheLookup:
+        """Find a cached answer for the standalone question, over the docs visible to the request."""
+        return self._find(self._key(config), _normalize(self.embeddings.embed_query(question)), question)
+
+    async def alookup(self, question: str, config: RunnableConfig) -> CacheLookup:
+        """Async version of `lookup`."""
+        vector = _normalize(await self.embeddings.aembed_query(question))
+        return self._find(self._key(config), vector, question)
+
+    def put(self, lookup: CacheLookup, answer: str, context: List[Document]):
+        """Store the generated answer of a missed lookup."""
+        if lookup.hit or not answer.strip():
+            return
+
+        entry = CachedAnswer(question=lookup.question, answer=answer, context=list(context))
+        with self._lock:
+            self._buckets.setdefault(lookup.bucket, []).append((lookup.vector, entry))
+            self._lru[(lookup.bucket, id(entry))] = None
+            self._stats["stored"] += 1
+
+            while len(self._lru) > self.max_entries:
+                (key, entry_id), _ = self._lru.popitem(last=False)
+                bucket = [(v, e) for v, e in self._buckets.get(key, []) if id(e) != entry_id]
+                if bucket:
+                    self._buckets[key] = bucket
+                else:
+                    self._buckets.pop(key, None)
+
+    def invalidate_user(self, user_id: str):
+        """Drop the buckets whose scope or stamp includes the user (their docs changed)."""
+        with self._lock:
+            stale = [
+                key for key in self._buckets
+                if user_id in key[0].split("|") or user_id in stamp_users(key[1])
+            ]
+            for key in stale:
+                for _, entry in self._buckets.pop(key):
+                    self._lru.pop((key, id(entry)), None)
+                    self._stats["invalidated"] += 1
+        if stale:
+            log.info(f"Invalidated {len(stale)} answer cache buckets of user '{user_id}'.")
+
+    def as_answer_stage(self, qa_chain: Runnable) -> Runnable:
+        """Wrap the QA chain: replay the cached answer on a hit, else stream and store the new answer.
+        - Expects the `cache` key (a `CacheLookup` or None) in the chain inputs.
+        """
+
+        def _answer(inputs: Dict[str, Any], config: RunnableConfig) -> Iterator[str]:
+            lookup: Optional[CacheLookup] = inputs.get("cache")
+            if lookup is not None and lookup.entry is not None:
+                yield lookup.entry.answer
+                return
+            parts = []
+            for chunk in qa_chain.stream(inputs, config):
+                parts.append(chunk)
+                yield chunk
+            if lookup is not None:
+                self.put(lookup, "".join(parts), inputs.get("context") or [])
+
+        async def _aanswer(inputs: Dict[str, Any], config: RunnableConfig) -> AsyncIterator[str]:
+            lookup: Optional[CacheLookup] = inputs.get("cache")
+            if lookup is not None and lookup.entry is not None:
+                yield lookup.entry.answer
+                return
+            parts = []
+            async for chunk in qa_chain.astream(inputs, config):
+                parts.append(chunk)
+                yield chunk
+            if lookup is not None:
+                self.put(lookup, "".join(parts), inputs.get("context") or [])
+
+        return RunnableLambda(_answer, afunc=_aanswer, name="cached_answer")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns the hits, misses, stores, invalidations, hit rate and num of cached answers."""
+        with self._lock:
+            total = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "hit_rate": self._stats["hits"] / total if total else 0.0,
+                "entries": len(self._lru),
+                "buckets": len(self._buckets),
+            }
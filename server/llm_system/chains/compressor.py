@@ -0,0 +1,295 @@
+"""Contains the sentence level compression stage of the RAG chain.
+- Each retrieved chunk (up to `DOC_CHAR_LIMIT` chars) is split into sentences.
+- All sentences are scored in one matrix product against the standalone question embedding.
+- The best sentences, with their neighbours for coherence, are kept up to `COMPRESS_TOKEN_BUDGET` tokens.
+- Only the LLM gets the compressed text (`compressed_context`), the original chunks stay in `context`
+  and are streamed to the client as is.
+- Sentence vectors are cached (LRU), as the same chunks are retrieved again and again.
+
+## For testing:
+- Run this file from `server` folder as:
+- `python -m llm_system.chains.compressor`
+"""
+
+import re
+from threading import Lock
+from time import perf_counter
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import Runnable, RunnableLambda
+
+from .packer import count_tokens
+from llm_system.config import (
+    COMPRESS_TOKEN_BUDGET, COMPRESS_NEIGHBOURS, COMPRESS_MIN_SENTENCE_CHARS, COMPRESS_CACHE_SIZE
+)
+
+from metrics import STAGE_SECONDS
+from logger import get_logger
+log = get_logger(name="chains_compressor")
+
+# Sentence ends, or blank lines (headings, list items, table rows):
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9\"'(\[])|\n\s*\n")
+# Between the kept sentences of a chunk, where some were dropped:
+GAP_MARKER: str = " ... "
+
+
+def split_sentences(text: str, min_chars: int = COMPRESS_MIN_SENTENCE_CHARS) -> List[str]:
+    """Split into sentences, merging the too short ones (numbers, abbreviations) into the next one."""
+    sentences, carry = [], ""
+    for part in _SENTENCE_RE.split(text):
+        part = part.strip()
+        if not part:
+            continue
+        carry = f"{carry} {part}" if carry else part
+        if len(carry) >= min_chars:
+            sentences.append(carry)
+            carry = ""
+    if carry:
+        if sentences:
+            sentences[-1] = f"{sentences[-1]} {carry}"
+        else:
+            sentences.append(carry)
+    return sentences
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    return matrix / (np.linalg.norm(matrix, axis=-1, keepdims=True) + 1e-12)
+
+
+class SentenceCompressor:
+    """Keeps the sentences of the retrieved docs most similar to the question, within a token budget.
+
+    Args:
+        embeddings (Embeddings): Embeddings model for the question and the sentences.
+        token_budget (int): Max tokens of the compressed context, in total over all docs.
+        neighbours (int): Sentences kept before / after each selected sentence.
+        cache_size (int): Max cached sentence vectors (LRU).
+
+    ## Functions:
+        + `select(docs, sentences, vectors, query_vector)`: Returns the compressed docs and the report.
+        + `compress()` / `acompress()`: Returns the compressed docs for the question.
+        + `as_runnable()`: Returns the stage as a runnable, to be used in the RAG chain.
+        + `get_stats()`: Returns the compression ratio and the time spent.
+    """
+
+    def __init__(self, embeddings: Embeddings, token_budget: int = COMPRESS_TOKEN_BUDGET,
+                 neighbours: int = COMPRESS_NEIGHBOURS, cache_size: int = COMPRESS_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.token_budget = token_budget
+        self.neighbours = neighbours
+        self.cache_size = cache_size
+
+        self._lock = Lock()
+        self._vectors: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._stats = {"requests": 0, "skipped": 0, "tokens_in": 0, "tokens_out": 0,
+                       "cache_hits": 0, "seconds": 0.0}
+        log.info(f"Initialized SentenceCompressor(token_budget={token_budget}, neighbours={neighbours}).")
+
+    # --------------------------------------------------------------------------
+    # Sentence vectors, cached:
+    # --------------------------------------------------------------------------
+
+    def _cached(self, sentences: List[str]) -> Tuple[List[Optional[np.ndarray]], List[str]]:
+        with self._lock:
+            vectors = [self._vectors.get(s) for s in sentences]
+            for sentence, vector in zip(sentences, vectors):
+                if vector is not None:
+                    self._vectors.move_to_end(sentence)
+            self._stats["cache_hits"] += sum(v is not None for v in vectors)
+        missing = list(dict.fromkeys(s for s, v in zip(sentences, vectors) if v is None))
+        return vectors, missing
+
+    def _store(self, sentences: List[str], vectors: List[Optional[np.ndarray]],
+               missing: List[str], embedded: List[List[float]]) -> np.ndarray:
+        new = dict(zip(missing, _normalize(np.asarray(embedded, dtype=np.float32)))) if missing else {}
+        with self._lock:
+            for sentence, vector in new.items():
+                self._vectors[sentence] = vector
+            while len(self._vectors) > self.cache_size:
+                self._vectors.popitem(last=False)
+        return np.stack([v if v is not None else new[s] for s, v in zip(sentences, vectors)])
+
+    # --------------------------------------------------------------------------
+    # Selection:
+    # --------------------------------------------------------------------------
+
+    def select(self, docs: List[Document], sentences: List[List[str]], matrix: np.ndarray,
+               query_vector: np.ndarray) -> Tuple[List[Document], Dict[str, Any]]:
+        """Pick the best sentences (+ neighbours) of all docs within the budget.
+
+        Args:
+            docs (List[Document]): The retrieved docs.
+            sentences (List[List[str]]): The sentences of each doc.
+            matrix (np.ndarray): Normalized vectors of all sentences, doc after doc.
+            query_vector (np.ndarray): Normalized vector of the question.
+
+        Returns:
+            Tuple[List[Document], Dict[str, Any]]: The compressed docs (same order, docs left without
+            sentences dropped) and the report.
+        """
+
+        # Flat index > (doc, sentence), and the token count of each sentence:
+        owners = np.repeat(np.arange(len(docs)), [len(s) for s in sentences])
+        positions = np.concatenate([np.arange(len(s)) for s in sentences])
+        tokens = np.array([count_tokens(s) + 1 for doc_sentences in sentences for s in doc_sentences])
+        scores = matrix @ query_vector
+
+        kept = np.zeros(len(scores), dtype=bool)
+        used = 0
+        for best in np.argsort(-scores, kind="stable"):
+            # The sentence with its neighbours in the same doc, whatever is not kept yet:
+            window = np.flatnonzero(
+                (owners == owners[best]) & (np.abs(positions - positions[best]) <= self.neighbours) & ~kept)
+            cost = int(tokens[window].sum())
+            if used + cost > self.token_budget:
+                if kept.any():
+                    continue
+                window, cost = np.array([best]), int(tokens[best])  # At least the best sentence
+            kept[window] = True
+            used += cost
+            if used >= self.token_budget:
+                break
+
+        compressed = []
+        for i, doc in enumerate(docs):
+            picked = positions[kept & (owners == i)]
+            if not len(picked):
+                continue
+            parts = [sentences[i][picked[0]]]
+            for previous, current in zip(picked, picked[1:]):
+                parts.append((" " if current == previous + 1 else GAP_MARKER) + sentences[i][current])
+            compressed.append(Document(
+                id=doc.id, page_content="".join(parts), metadata={**doc.metadata, "compressed": True}))
+
+        report = {
+            "sentences": int(len(scores)),
+            "kept": int(kept.sum()),
+            "tokens_in": int(tokens.sum()),
+            "tokens_out": used,
+            "docs_dropped": len(docs) - len(compressed),
+        }
+        return compressed, report
+
+    def _prepare(self, docs: List[Document]) -> Optional[Tuple[List[List[str]], List[str]]]:
+        """Sentences of each doc, and all of them flat. None if the docs already fit the budget."""
+        if sum(count_tokens(doc.page_content) for doc in docs) <= self.token_budget:
+            return None
+        sentences = [split_sentences(doc.page_content) or [doc.page_content] for doc in docs]
+        return sentences, [s for doc_sentences in sentences for s in doc_sentences]
+
+    def _finish(self, docs: List[Document], compressed: List[Document], report: Dict[str, Any],
+                start: float) -> List[Document]:
+        seconds = perf_counter() - start
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["tokens_in"] += report["tokens_in"]
+            self._stats["tokens_out"] += report["tokens_out"]
+            self._stats["seconds"] += seconds
+        log.info(
+            f"Compressed {len(docs)} docs: {report['kept']}/{report['sentences']} sentences, "
+            f"{report['tokens_in']} > {report['tokens_out']} tokens in {1000 * seconds:.1f} ms."
+        )
+        return compressed
+
+    def _skip(self, docs: List[Document]) -> List[Document]:
+        with self._lock:
+            self._stats["skipped"] += 1
+        return docs
+
+    @STAGE_SECONDS.timed(stage="compress")
+    def compress(self, question: str, docs: List[Document]) -> List[Document]:
+        """Returns the docs compressed to the sentences relevant to the question."""
+
+        prepared = self._prepare(docs)
+        if prepared is None:
+            return self._skip(docs)
+        start = perf_counter()
+        sentences, flat = prepared
+
+        vectors, missing = self._cached(flat)
+        embedded = self.embeddings.embed_documents(missing) if missing else []
+        matrix = self._store(flat, vectors, missing, embedded)
+        query_vector = _normalize(np.asarray(self.embeddings.embed_query(question), dtype=np.float32))
+
+        compressed, report = self.select(docs, sentences, matrix, query_vector)
+        return self._finish(docs, compressed, report, start)
+
+    @STAGE_SECONDS.timed(stage="compress")
+    async def acompress(self, question: str, docs: List[Document]) -> List[Document]:
+        """Async version of `compress`."""
+
+        prepared = self._prepare(docs)
+        if prepared is None:
+            return self._skip(docs)
+        start = perf_counter()
+        sentences, flat = prepared
+
+        vectors, missing = self._cached(flat)
+        embedded = await self.embeddings.aembed_documents(missing) if missing else []
+        matrix = self._store(flat, vectors, missing, embedded)
+        query_vector = _normalize(np.asarray(await self.embeddings.aembed_query(question), dtype=np.float32))
+
+        compressed, report = self.select(docs, sentences, matrix, query_vector)
+        return self._finish(docs, compressed, report, start)
+
+    def as_runnable(self) -> Runnable:
+        """Returns the stage as runnable, adding `compressed_context` to the chain inputs.
+        - Skipped on answer cache hits, as no answer is generated then.
+        """
+
+        def _needed(inputs: Dict[str, Any]) -> bool:
+            lookup = inputs.get("cache")
+            return bool(inputs.get("context")) and not (lookup is not None and lookup.hit)
+
+        def _question(inputs: Dict[str, Any]) -> str:
+            return inputs.get("standalone_question") or inputs["input"]
+
+        def _stage(inputs: Dict[str, Any]) -> Dict[str, Any]:
+            if not _needed(inputs):
+                return {**inputs, "compressed_context": inputs.get("context") or []}
+            return {**inputs, "compressed_context": self.compress(_question(inputs), inputs["context"])}
+
+        async def _astage(inputs: Dict[str, Any]) -> Dict[str, Any]:
+            if not _needed(inputs):
+                return {**inputs, "compressed_context": inputs.get("context") or []}
+            return {**inputs, "compressed_context": await self.acompress(_question(inputs), inputs["context"])}
+
+        return RunnableLambda(_stage, afunc=_astage, name="compress_context")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns the num of compressed / skipped requests, tokens in / out, their ratio and avg time."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached_sentences"] = len(self._vectors)
+        requests, seconds = stats["requests"], stats.pop("seconds")
+        stats["ratio"] = round(stats["tokens_out"] / stats["tokens_in"], 3) if stats["tokens_in"] else 1.0
+        stats["avg_ms"] = round(1000 * seconds / requests, 2) if requests else 0.0
+        return stats
+
+
+if __name__ == "__main__":
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    text = ("The sun is a star. " * 3 + "Refunds are paid within 30 days of the request. " +
+            "Unrelated filler sentence about nothing in particular. " * 20)
+    docs = [Document(id=str(i), page_content=text, metadata={"source": "x.pdf", "page": i}) for i in range(3)]
+
+    assert split_sentences("Dr. A. Smith went home. He slept all night.", min_chars=10) == [
+        "Dr. A. Smith went home.", "He slept all night."], "Bad sentence split"
+
+    compressor = SentenceCompressor(DeterministicFakeEmbedding(size=32), token_budget=60, neighbours=1)
+    assert "seconds" not in compressor.get_stats(), "Raw seconds in stats before any request"
+    compressed = compressor.compress("Refunds are paid within 30 days of the request.", docs)
+    tokens = sum(count_tokens(d.page_content) for d in compressed)
+    print([d.page_content for d in compressed], compressor.get_stats())
+    assert tokens <= 60 + len(compressed), "Over budget"
+    assert "Refunds are paid" in compressed[0].page_content, "Best sentence not kept"
+    assert "compressed" not in docs[0].metadata, "Original doc mutated"
+
+    compressor.compress("Refunds are paid within 30 days of the request.", docs)
+    assert compressor.get_stats()["cache_hits"] > 0, "Sentence vectors not cached"
+    print("All compressor checks passed.")
@@ -0,0 +1,242 @@
+"""Contains the intent router, used to skip retrieval for turns which only need the conversation.
+- Chit-chat ("thanks!", "hi there", "ok got it") needs no documents at all.
+- Meta requests about the previous answer ("rewrite that shorter", "make it a table") need the history only.
+- Everything else is retrieved for, as before.
+- Routing uses cheap rules, plus optional embedding similarity with prototype phrases for short inputs.
+- Every decision is logged with its reason, for tuning the rules.
+"""
+
+import re
+from threading import Lock
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import Runnable, RunnableLambda
+
+from llm_system.config import INTENT_EMB_CHECK, INTENT_EMB_MIN_SIM, INTENT_MAX_WORDS
+
+from metrics import STAGE_SECONDS
+from logger import get_logger
+log = get_logger(name="chains_intent")
+
+# Intents:
+RETRIEVE = "retrieve"       # Needs documents (default).
+CHITCHAT = "chitchat"       # Greetings, thanks, acknowledgements.
+META = "meta"               # Rework of the previous answer, needs the history only.
+
+_WORD_RE = re.compile(r"[\w']+")
+
+# Inputs made only of these words are chit-chat ("ok thanks a lot", "great, got it!"):
+_CHITCHAT_WORDS = frozenset({
+    "hi", "hello", "hey", "hiya", "yo", "good", "morning", "afternoon", "evening", "night",
+    "thanks", "thank", "thx", "ty", "cheers", "you", "so", "very", "much", "a", "lot", "again",
+    "ok", "okay", "k", "cool", "great", "nice", "perfect", "awesome", "amazing", "excellent", "wow",
+    "got", "it", "understood", "alright", "sure", "fine", "yes", "yeah", "yep", "no", "nope",
+    "bye", "goodbye", "see", "later", "that's", "thats", "helps", "helpful", "makes", "sense", "there",
+})
+# Which are replies to a question of the previous answer, when there is one ("Want the details?" > "yes"):
+_REPLY_WORDS = frozenset({"yes", "yeah", "yep", "no", "nope", "sure"})
+# Whole input (without trailing punctuation) only, "how are you calculating ..." is a question:
+_CHITCHAT_RE = re.compile(
+    r"(how are you( doing)?( today)?|who are you|what can you do|what are you|are you (there|a bot|an ai))")
+_TRAILING = "?!.,;: "
+
+# Requests to rework the previous answer, only if they also refer back to it:
+_META_VERB_RE = re.compile(
+    r"^(please |can you |could you |now )*(rewrite|rephrase|reword|shorten|simplify|summari[sz]e|translate|"
+    r"reformat|format|condense|paraphrase|make|put|turn|convert)\b")
+_META_REF_RE = re.compile(
+    r"\b(that|this|it|above|previous|last (answer|response|reply|one)|"
+    r"your (answer|response|reply)|the (answer|response|reply))\b")
+# Inputs naming a document, a part of it or an amount need the documents, whatever else they say:
+_SPECIFIC_RE = re.compile(
+    r"\b(document|doc|file|pdf|report|contract|policy|section|clause|article|chapter|paragraph|page|"
+    r"appendix|annex|amount|rate|price|cost|fee|total)s?\b|\.(pdf|docx?|txt|md)\b|\d|[$€£¥%]")
+
+# Prototype phrases for the optional embedding check:
+PROTOTYPES: Dict[str, List[str]] = {
+    CHITCHAT: [
+        "thanks, that was helpful", "hello, how are you?", "okay, got it", "great, thank you very much",
+        "goodbye, see you later", "who are you?", "nice, that makes sense",
+    ],
+    META: [
+        "rewrite your answer in fewer words", "make the previous answer shorter", "translate that to French",
+        "put the answer above in bullet points", "format the last response as a table", "explain it more simply",
+    ],
+}
+
+
+class IntentRouter:
+    """Classifies each turn as needing retrieval or not.
+
+    Args:
+        embeddings (Embeddings, optional): Embeddings model for the prototype similarity check.
+            The check only runs if given and `INTENT_EMB_CHECK` is enabled.
+        min_similarity (float): Min cosine similarity with a prototype phrase to take its intent.
+        max_words (int): Longer inputs are always retrieved for.
+
+    ## Functions:
+        + `route(question, chat_history)` / `aroute()`: Returns the intent and the reason of the decision.
+        + `as_runnable()`: Returns the routing stage, adding `intent` to the chain inputs.
+        + `get_stats()`: Returns the counts per intent and per reason.
+    """
+
+    def __init__(self, embeddings: Optional[Embeddings] = None,
+                 min_similarity: float = INTENT_EMB_MIN_SIM, max_words: int = INTENT_MAX_WORDS):
+        self.embeddings = embeddings if INTENT_EMB_CHECK else None
+        self.min_similarity = min_similarity
+        self.max_words = max_words
+
+        self._lock = Lock()
+        self._prototypes: Optional[Tuple[np.ndarray, List[str]]] = None
+        self._intents: Counter = Counter()
+        self._reasons: Counter = Counter()
+        log.info(
+            f"Initialized IntentRouter(emb_check={self.embeddings is not None}, "
+            f"min_similarity={min_similarity}, max_words={max_words})."
+        )
+
+    def _rules(self, question: str, has_history: bool) -> Tuple[Optional[str], str]:
+        """Rule verdict: the intent, or None if the prototypes should decide."""
+        text = question.strip().lower().rstrip(_TRAILING)
+        words = _WORD_RE.findall(text)
+
+        if not words:
+            return CHITCHAT, "empty"
+        if len(words) > self.max_words:
+            return RETRIEVE, "long"
+        if all(word in _CHITCHAT_WORDS for word in words):
+            if not (has_history and any(word in _REPLY_WORDS for word in words)):
+                return CHITCHAT, "rule"
+            return RETRIEVE, "reply"
+        if _CHITCHAT_RE.fullmatch(text):
+            return CHITCHAT, "rule"
+        if _SPECIFIC_RE.search(text):
+            return RETRIEVE, "specific"
+        if has_history and _META_VERB_RE.match(text) and _META_REF_RE.search(text):
+            return META, "rule"
+        return None, "no_rule"
+
+    def _closest(self, vectors: np.ndarray, has_history: bool) -> Tuple[str, str]:
+        """Intent of the most similar prototype, if similar enough (first row is the question)."""
+        matrix = vectors / (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+        prototypes, intents = self._prototypes  # type: ignore[misc]
+        similarities = prototypes @ matrix[0]
+        best = int(np.argmax(similarities))
+        intent = intents[best]
+        if similarities[best] < self.min_similarity or (intent == META and not has_history):
+            return RETRIEVE, "default"
+        return intent, f"prototype:{similarities[best]:.2f}"
+
+    def _decide(self, question: str, intent: str, reason: str) -> Tuple[str, str]:
+        with self._lock:
+            self._intents[intent] += 1
+            self._reasons[reason.split(":")[0]] += 1
+        log.info(f"Routed '{question[:60]}' to '{intent}' ({reason}).")
+        return intent, reason
+
+    @STAGE_SECONDS.timed(stage="route")
+    def route(self, question: str, chat_history: List[BaseMessage]) -> Tuple[str, str]:
+        """Decide whether the turn needs retrieval.
+
+        Args:
+            question (str): The latest user input.
+            chat_history (List[BaseMessage]): The conversation so far.
+
+        Returns:
+            Tuple[str, str]: The intent (`retrieve`, `chitchat` or `meta`) and the reason of the decision.
+        """
+
+        intent, reason = self._rules(question, bool(chat_history))
+        if intent is None and self.embeddings is not None:
+            try:
+                if self._prototypes is None:
+                    self._load_prototypes(self.embeddings.embed_documents(self._phrases()))
+                intent, reason = self._closest(
+                    np.asarray([self.embeddings.embed_query(question)], dtype=np.float32), bool(chat_history))
+            except Exception as e:
+                log.error(f"Prototype check failed, retrieving: {e}")
+        return self._decide(question, intent or RETRIEVE, reason if intent else "default")
+
+    @STAGE_SECONDS.timed(stage="route")
+    async def aroute(self, question: str, chat_history: List[BaseMessage]) -> Tuple[str, str]:
+        """Async version of `route`."""
+
+        intent, reason = self._rules(question, bool(chat_history))
+        if intent is None and self.embeddings is not None:
+            try:
+                if self._prototypes is None:
+                    self._load_prototypes(await self.embeddings.aembed_documents(self._phrases()))
+                intent, reason = self._closest(
+                    np.asarray([await self.embeddings.aembed_query(question)], dtype=np.float32), bool(chat_history))
+            except Exception as e:
+                log.error(f"Prototype check failed, retrieving: {e}")
+        return self._decide(question, intent or RETRIEVE, reason if intent else "default")
+
+    @staticmethod
+    def _phrases() -> List[str]:
+        return [phrase for phrases in PROTOTYPES.values() for phrase in phrases]
+
+    def _load_prototypes(self, vectors: List[List[float]]):
+        matrix = np.asarray(vectors, dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12
+        intents = [intent for intent, phrases in PROTOTYPES.items() for _ in phrases]
+        self._prototypes = (matrix, intents)
+
+    def as_runnable(self) -> Runnable:
+        """Returns the stage as runnable, taking `{input, chat_history}` and adding `intent` to it."""
+
+        def _stage(inputs: Dict[str, Any]) -> Dict[str, Any]:
+            intent, _ = self.route(inputs["input"], inputs.get("chat_history") or [])
+            return {**inputs, "intent": intent}
+
+        async def _astage(inputs: Dict[str, Any]) -> Dict[str, Any]:
+            intent, _ = await self.aroute(inputs["input"], inputs.get("chat_history") or [])
+            return {**inputs, "intent": intent}
+
+        return RunnableLambda(_stage, afunc=_astage, name="route_intent")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns the num of turns per intent, per reason, and the share which skipped retrieval."""
+        with self._lock:
+            total = sum(self._intents.values())
+            skipped = total - self._intents[RETRIEVE]
+            return {
+                "intents": dict(self._intents),
+                "reasons": dict(self._reasons),
+                "skip_rate": skipped / total if total else 0.0,
+            }
+
+
+if __name__ == "__main__":
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    router = IntentRouter()
+    history = [HumanMessage("What is the refund policy?"), AIMessage("Refunds are paid within 30 days.")]
+    cases = {
+        "Thanks!": CHITCHAT,
+        "ok, got it. thank you so much": CHITCHAT,
+        "How are you doing?": CHITCHAT,
+        "rewrite that shorter": META,
+        "Can you translate your answer to German?": META,
+        "Summarize the contract in contract.pdf": RETRIEVE,
+        "What does it say about refunds?": RETRIEVE,
+        "format the last response as a table": META,
+        # Not chit-chat / meta, although they start alike:
+        "How are you calculating the refund?": RETRIEVE,
+        "What can you do about late refunds?": RETRIEVE,
+        "Who are you required to notify under clause 4?": RETRIEVE,
+        "yes": RETRIEVE,
+        "Make it clear what section 3 says about this": RETRIEVE,
+        "Convert that amount to euros using the rate in the report": RETRIEVE,
+    }
+    for question, expected in cases.items():
+        intent, reason = router.route(question, history)
+        assert intent == expected, f"'{question}' routed to {intent} ({reason}), expected {expected}"
+    assert router.route("rewrite that shorter", [])[0] == RETRIEVE, "Meta without history"
+    assert router.route("No", [])[0] == CHITCHAT, "Reply word without history"
+    print(router.get_stats())
+    print("All intent checks passed.")
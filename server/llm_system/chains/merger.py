@@ -0,0 +1,172 @@
+"""Contains the chunk merging stage of the RAG chain, run on the retrieved docs before packing.
+- Chunks of a page overlap by `DOC_OVERLAP_NO` chars, so consecutive chunks retrieved together
+  would send their shared text to the LLM twice.
+- Retrieved chunks are grouped by user / source / page, and contiguous ones (by `start_index`)
+  are stitched into one doc, without the duplicated overlap.
+- The merged doc takes the place of its best ranked chunk, the order of the others is unchanged.
+- Chunks without `start_index` (ingested before it was recorded) are passed through as they are.
+
+## For testing:
+- Run this file from `server` folder as:
+- `python -m llm_system.chains.merger`
+"""
+
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.runnables import Runnable, RunnableLambda
+
+from .packer import count_tokens, DOC_SEPARATOR
+
+from metrics import STAGE_SECONDS
+from logger import get_logger
+log = get_logger(name="chains_merger")
+
+
+def _group(doc: Document) -> Optional[Tuple[str, str, Any]]:
+    """Key of the page the chunk was split from, or None if it can't be placed."""
+    if not isinstance(doc.metadata.get("start_index"), int):
+        return None
+    metadata = doc.metadata
+    return str(metadata.get("user_id", "")), str(metadata.get("source", "")), metadata.get("page")
+
+
+def _stitch(first: Document, second: Document) -> Optional[Document]:
+    """The two chunks (in page order) as one doc, or None if they are not contiguous."""
+    start, end = first.metadata["start_index"], first.metadata["start_index"] + len(first.page_content)
+    next_start = second.metadata["start_index"]
+    if next_start > end:
+        return None
+
+    overlap = end - next_start
+    if overlap > len(second.page_content):
+        # Second chunk lies within the first one:
+        overlap = len(second.page_content)
+    if first.page_content[len(first.page_content) - overlap:] != second.page_content[:overlap]:
+        # Offsets don't match the text (e.g. chunks of another version of the file):
+        return None
+
+    return Document(
+        id=first.id,
+        page_content=first.page_content + second.page_content[overlap:],
+        metadata={
+            **first.metadata,
+            "start_index": start,
+            "merged": first.metadata.get("merged", 1) + second.metadata.get("merged", 1),
+        },
+    )
+
+
+class ChunkMerger:
+    """Stitches the contiguous chunks of each page among the retrieved docs.
+
+    ## Functions:
+        + `merge(docs)`: Returns the docs with the contiguous chunks merged, and the merge report.
+        + `as_runnable()`: Returns the stage as runnable, replacing `context` and adding `merging` to the inputs.
+        + `get_stats()`: Returns the num of chunks merged and prompt tokens saved so far.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._stats = {"requests": 0, "merged_requests": 0, "chunks_in": 0, "docs_out": 0, "tokens_saved": 0}
+        log.info("Initialized ChunkMerger.")
+
+    @STAGE_SECONDS.timed(stage="merge")
+    def merge(self, docs: List[Document]) -> Tuple[List[Document], Dict[str, int]]:
+        """Merge the contiguous chunks of the same page.
+
+        Args:
+            docs (List[Document]): The retrieved docs, best first.
+
+        Returns:
+            Tuple[List[Document], Dict[str, int]]: The docs (merged ones at the rank of their best chunk),
+                and the report with `chunks_in`, `docs_out` and `tokens_saved`.
+        """
+
+        groups: Dict[Tuple[str, str, Any], List[int]] = {}
+        for rank, doc in enumerate(docs):
+            key = _group(doc)
+            if key is not None:
+                groups.setdefault(key, []).append(rank)
+
+        # Rank of the best chunk > doc in that slot, other slots of merged chunks are left empty:
+        slots: List[Optional[Document]] = list(docs)
+        for ranks in groups.values():
+            if len(ranks) < 2:
+                continue
+            ranks.sort(key=lambda rank: docs[rank].metadata["start_index"])
+            current, current_ranks = docs[ranks[0]], [ranks[0]]
+            for rank in ranks[1:] + [-1]:
+                stitched = _stitch(current, docs[rank]) if rank != -1 else None
+                if stitched is not None:
+                    current, current_ranks = stitched, current_ranks + [rank]
+                    continue
+                if len(current_ranks) > 1:
+                    for merged_rank in current_ranks:
+                        slots[merged_rank] = None
+                    slots[min(current_ranks)] = current
+                if rank != -1:
+                    current, current_ranks = docs[rank], [rank]
+
+        merged = [doc for doc in slots if doc is not None]
+        tokens_in = sum(count_tokens(doc.page_content + DOC_SEPARATOR) for doc in docs)
+        tokens_out = sum(count_tokens(doc.page_content + DOC_SEPARATOR) for doc in merged)
+        report = {"chunks_in": len(docs), "docs_out": len(merged), "tokens_saved": tokens_in - tokens_out}
+
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["merged_requests"] += len(merged) < len(docs)
+            self._stats["chunks_in"] += len(docs)
+            self._stats["docs_out"] += len(merged)
+            self._stats["tokens_saved"] += report["tokens_saved"]
+        if len(merged) < len(docs):
+            log.info(f"Merged {len(docs)} chunks into {len(merged)} docs, saved {report['tokens_saved']} tokens.")
+        return merged, report
+
+    def as_runnable(self) -> Runnable:
+        """Returns the stage as runnable, taking and returning the chain inputs."""
+
+        def _stage(inputs: Dict[str, Any]) -> Dict[str, Any]:
+            docs, report = self.merge(inputs.get("context") or [])
+            return {**inputs, "context": docs, "merging": report}
+
+        return RunnableLambda(_stage, name="merge_chunks")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns the num of requests (with a merge), chunks in, docs out, and prompt tokens saved."""
+        with self._lock:
+            stats = dict(self._stats)
+        requests = stats["requests"]
+        stats["avg_tokens_saved"] = round(stats["tokens_saved"] / requests, 2) if requests else 0.0
+        return stats
+
+
+if __name__ == "__main__":
+    from llm_system.utils.splitter import split_text
+
+    page = " ".join(f"Sentence number {i} of the test page." for i in range(60))
+    source = Document(page_content=page, metadata={"source": "x.pdf", "page": 1, "user_id": "u"})
+    _, chunks, _ = split_text([source], chunk_size=300, chunk_overlap=80)
+    other = Document(page_content="Unrelated chunk.", metadata={"source": "y.pdf", "page": 0, "start_index": 0})
+
+    merger = ChunkMerger()
+    # Chunks 3, 2 and 5 of the page (by score), 3 and 2 are contiguous, 5 is not:
+    docs, report = merger.merge([chunks[3], other, chunks[2], chunks[5]])
+    print(report)
+    assert len(docs) == 3, f"Expected 3 docs, got {len(docs)}"
+    assert docs[0].metadata["merged"] == 2 and docs[0].metadata["start_index"] == chunks[2].metadata["start_index"]
+    start = docs[0].metadata["start_index"]
+    assert docs[0].page_content == page[start:start + len(docs[0].page_content)], "Stitched text differs from page"
+    assert docs[1] is other and docs[2] is chunks[5], "Order of the other docs changed"
+    assert report["tokens_saved"] > 0, "No tokens saved"
+
+    # A whole run of chunks, in any order, gives back the page:
+    docs, _ = merger.merge(chunks[::-1])
+    assert len(docs) == 1 and docs[0].page_content == page[docs[0].metadata["start_index"]:], "Page not restored"
+
+    # Chunks without offsets (old ingestions) are left alone:
+    legacy = [Document(page_content=c.page_content, metadata={"source": "x.pdf", "page": 1}) for c in chunks[:2]]
+    assert merger.merge(legacy)[0] == legacy, "Chunks without offsets merged"
+    print(merger.get_stats())
+    print("All merger checks passed.")
@@ -0,0 +1,155 @@
+"""Contains the native async executor of the RAG chain, an alternative to the runnable stack of `build_rag_chain`.
+- Same stages, same components and same streamed chunks as the runnable chain:
+  History load > Route > Condense + Retrieve > Merge > Pack > Compress > Stuff > Stream > History save
+- The stages are awaited in plain Python, so the answer tokens skip the runnable dispatch, callback managers
+  and dict merging of `RunnableWithMessageHistory` > `RunnableSequence` > `assign` > stuff chain > parser.
+- The retriever and LLM calls themselves are unchanged (and still traced with the given config).
+- Async streaming only (`astream` / `ainvoke`), as used by the `/rag` endpoint.
+"""
+
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.vectorstores import VectorStoreRetriever
+
+from .prompts import template_chat, template_chat_cached
+from .prompts import template_summarize as summary_prompt
+from .retrieval import ContextRetriever
+from .packer import ContextPacker, DOC_SEPARATOR
+from .standalone import StandaloneDetector
+from .speculative import SpeculativeRetrieval
+from .reranker import Reranker
+from .answer_cache import AnswerCache
+from .prefix import PrefixTracker, render_prompt
+from .compressor import SentenceCompressor
+from .intent import IntentRouter
+from .merger import ChunkMerger
+from llm_system.config import PROMPT_LAYOUT
+
+from logger import get_logger
+log = get_logger(name="chains_native")
+
+
+def _text(chunk: Any) -> str:
+    """Text of a streamed LLM chunk, same as `StrOutputParser`."""
+    return chunk.text() if isinstance(chunk, BaseMessage) else str(chunk)
+
+
+class NativeRagChain:
+    """Conversational RAG chain as one async generator, see `build_rag_chain` for the args.
+
+    ## Functions:
+        + `astream(input, config)`: Streams the chain inputs (one dict, with `context`), then `{"answer": token}`s.
+        + `ainvoke(input, config)`: Returns the final dict, with the whole `answer`.
+    """
+
+    def __init__(
+            self, llm_chat: Runnable, llm_summary: Runnable,
+            retriever: VectorStoreRetriever, get_history_fn: Callable,
+            detector: Optional[StandaloneDetector] = None,
+            speculation: Optional[SpeculativeRetrieval] = None,
+            reranker: Optional[Reranker] = None,
+            answer_cache: Optional[AnswerCache] = None,
+            prefix_tracker: Optional[PrefixTracker] = None,
+            compressor: Optional[SentenceCompressor] = None,
+            intent_router: Optional[IntentRouter] = None,
+            merger: Optional[ChunkMerger] = None,
+            prompt_layout: str = PROMPT_LAYOUT):
+        cache_friendly = prompt_layout == "cache_friendly"
+        self.llm_chat = llm_chat
+        self.get_history_fn = get_history_fn
+        self.answer_cache = answer_cache
+        self.prefix_tracker = prefix_tracker
+        self.compressor = compressor
+        self.intent_router = intent_router
+        self.merger = merger
+        self.chat_prompt = template_chat_cached if cache_friendly else template_chat
+        self.retriever = ContextRetriever(
+            llm_summary, retriever, summary_prompt, detector, speculation, reranker, answer_cache)
+        self.packer = ContextPacker(self.chat_prompt, stable_order=cache_friendly)
+        log.info(f"Initialized NativeRagChain with '{prompt_layout}' prompt layout.")
+
+    async def _prepare(self, inputs: Dict[str, Any], config: RunnableConfig) -> Dict[str, Any]:
+        """Runs every stage before generation, returns the chain inputs as the runnable chain streams them."""
+
+        if self.intent_router is not None:
+            intent, _ = await self.intent_router.aroute(inputs["input"], inputs["chat_history"])
+            inputs = {**inputs, "intent": intent}
+
+        inputs = {**inputs, **await self.retriever.aresolve(inputs, config)}
+        if self.merger is not None:
+            docs, report = self.merger.merge(inputs["context"])
+            inputs = {**inputs, "context": docs, "merging": report}
+        inputs = self.packer.pack(inputs)
+
+        if self.compressor is not None:
+            lookup = inputs.get("cache")
+            compressed = inputs["context"]
+            if compressed and not (lookup is not None and lookup.hit):
+                question = inputs.get("standalone_question") or inputs["input"]
+                compressed = await self.compressor.acompress(question, inputs["context"])
+            inputs = {**inputs, "compressed_context": compressed}
+        return inputs
+
+    async def _agenerate(self, inputs: Dict[str, Any], session_id: str,
+                         config: RunnableConfig) -> AsyncIterator[str]:
+        """Stuffs the docs into the chat prompt, and streams the answer tokens."""
+
+        docs: List[Document] = inputs["compressed_context" if self.compressor is not None else "context"]
+        prompt = self.chat_prompt.format_prompt(
+            context=DOC_SEPARATOR.join(doc.page_content for doc in docs),
+            chat_history=inputs["chat_history"],
+            input=inputs["input"],
+        )
+        if self.prefix_tracker is not None:
+            self.prefix_tracker.observe(session_id, render_prompt(prompt))
+
+        async for chunk in self.llm_chat.astream(prompt, config):
+            yield _text(chunk)
+
+    async def astream(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None
+                      ) -> AsyncIterator[Dict[str, Any]]:
+        """Streams the RAG chain for the input, same chunks as `build_rag_chain(...).astream()`.
+
+        Args:
+            input (Dict[str, Any]): `{"input": user input}`.
+            config (RunnableConfig): With `configurable.session_id` and the retriever's `search_kwargs`.
+
+        Yields:
+            Dict[str, Any]: The chain inputs once (`chat_history`, `context`, `packing`, ...),
+                then `{"answer": token}` per token.
+        """
+
+        config = config or {}
+        session_id = config.get("configurable", {}).get("session_id", "unknown_session")
+        history = self.get_history_fn(session_id)
+        inputs = await self._prepare({**input, "chat_history": list(history.messages)}, config)
+        yield inputs
+
+        lookup = inputs.get("cache")
+        if lookup is not None and lookup.entry is not None:
+            parts = [lookup.entry.answer]
+            yield {"answer": lookup.entry.answer}
+        else:
+            parts = []
+            async for token in self._agenerate(inputs, session_id, config):
+                parts.append(token)
+                yield {"answer": token}
+            if lookup is not None:
+                self.answer_cache.put(lookup, "".join(parts), inputs["context"])  # type: ignore[union-attr]
+
+        # Saved once the answer is complete, same as `RunnableWithMessageHistory` (in memory, no I/O):
+        history.add_messages([HumanMessage(content=input["input"]), AIMessage(content="".join(parts))])
+
+    async def ainvoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None) -> Dict[str, Any]:
+        """Runs the RAG chain for the input, returns the chain inputs with the whole `answer`."""
+        result: Dict[str, Any] = {}
+        parts = []
+        async for chunk in self.astream(input, config):
+            if "answer" in chunk:
+                parts.append(chunk["answer"])
+            else:
+                result.update(chunk)
+        return {**result, "answer": "".join(parts)}
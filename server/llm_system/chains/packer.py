@@ -0,0 +1,203 @@
+"""Contains the context packing stage of the RAG chain, which enforces `MAX_CONTENT_SIZE`.
+- The system prompt and the user input are always kept.
+- Chat history is trimmed oldest first, to at most `HISTORY_TOKEN_SHARE` of the free tokens.
+- Retrieved docs (best first) fill the rest, the last one that fits partially is truncated.
+- `ANSWER_TOKEN_RESERVE` tokens are always left free for the answer.
+- Optionally, the kept docs are put in a stable (source, page, offset) order, for prefix caching.
+
+## For testing:
+- Run this file from `server` folder as:
+- `python -m llm_system.chains.packer`
+"""
+
+import math
+from typing import Any, Dict, List, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage
+from langchain_core.prompts import BasePromptTemplate
+from langchain_core.runnables import Runnable, RunnableLambda
+
+from llm_system.config import (
+    MAX_CONTENT_SIZE, ANSWER_TOKEN_RESERVE, HISTORY_TOKEN_SHARE, MIN_DOC_TOKENS
+)
+
+from metrics import STAGE_SECONDS
+from logger import get_logger
+log = get_logger(name="chains_packer")
+
+# Approx chars per token, same as used for `DOC_TOKEN_SIZE`:
+CHARS_PER_TOKEN: int = 4
+# Approx tokens of the role / separators around each message or doc:
+MESSAGE_OVERHEAD: int = 4
+DOC_SEPARATOR: str = "\n\n"
+
+
+def count_tokens(text: str) -> int:
+    """Approx number of tokens in the text."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _message_tokens(message: BaseMessage) -> int:
+    return count_tokens(message.text()) + MESSAGE_OVERHEAD
+
+
+def _doc_tokens(doc: Document) -> int:
+    return count_tokens(doc.page_content + DOC_SEPARATOR)
+
+
+def _source(doc: Document) -> str:
+    return f"{doc.metadata.get('source', 'unknown')}#{doc.metadata.get('page', '-')}"
+
+
+def _position(doc: Document) -> Tuple[str, int, int]:
+    """Sort key of a doc by its place in the source file."""
+    page, start = doc.metadata.get("page"), doc.metadata.get("start_index")
+    return (
+        str(doc.metadata.get("source", "")),
+        page if isinstance(page, int) else -1,
+        start if isinstance(start, int) else -1,
+    )
+
+
+class ContextPacker:
+    """Fits the system prompt, trimmed history and best docs of a request into the token budget.
+
+    Args:
+        prompt (BasePromptTemplate): The chat prompt, with `context`, `chat_history` and `input` variables.
+        max_tokens (int): The context size of the chat model.
+        answer_reserve (int): Tokens left free for the answer.
+        history_share (float): Max share of the free tokens (after prompt + input) for the history.
+        min_doc_tokens (int): A doc is truncated only if at least this many tokens of it fit.
+        stable_order (bool): Put the kept docs in source / page / offset order instead of score order.
+
+    ## Functions:
+        + `pack(inputs)`: Returns the inputs with packed `chat_history` / `context`, and the `packing` report.
+        + `as_runnable()`: Returns the stage as a runnable, to be used in the RAG chain.
+    """
+
+    def __init__(self, prompt: BasePromptTemplate, max_tokens: int = MAX_CONTENT_SIZE,
+                 answer_reserve: int = ANSWER_TOKEN_RESERVE, history_share: float = HISTORY_TOKEN_SHARE,
+                 min_doc_tokens: int = MIN_DOC_TOKENS, stable_order: bool = False):
+        self.max_tokens = max_tokens
+        self.answer_reserve = answer_reserve
+        self.history_share = history_share
+        self.min_doc_tokens = min_doc_tokens
+        self.stable_order = stable_order
+
+        # Fixed part of the prompt, with everything variable left empty:
+        empty = prompt.format_messages(context="", chat_history=[], input="")
+        self.prompt_tokens = sum(_message_tokens(m) for m in empty)
+        log.info(
+            f"Initialized ContextPacker(max_tokens={max_tokens}, answer_reserve={answer_reserve}, "
+            f"prompt_tokens={self.prompt_tokens})."
+        )
+
+    def _trim_history(self, history: List[BaseMessage], budget: int) -> Tuple[List[BaseMessage], int]:
+        """Keep the most recent messages within budget, starting at a human (or summary) message if possible."""
+        kept, used = [], 0
+        for message in reversed(history):
+            tokens = _message_tokens(message)
+            if used + tokens > budget:
+                break
+            kept.append(message)
+            used += tokens
+        kept.reverse()
+
+        # Don't start the conversation with an orphan AI reply:
+        while kept and kept[0].type not in ("human", "system") and len(kept) > 1:
+            used -= _message_tokens(kept.pop(0))
+        return kept, used
+
+    def _fit_docs(self, docs: List[Document], budget: int) -> Tuple[List[Document], int, Dict[str, Any]]:
+        """Keep docs in their (score) order within budget, truncating the first one which does not fit."""
+        kept, used = [], 0
+        dropped, truncated = [], None
+
+        for doc in docs:
+            tokens = _doc_tokens(doc)
+            left = budget - used
+            if tokens <= left:
+                kept.append(doc)
+                used += tokens
+            elif truncated is None and left >= self.min_doc_tokens:
+                # Copy, as retrieved docs are the ones stored in the vector DB:
+                chars = (left * CHARS_PER_TOKEN) - len(DOC_SEPARATOR)
+                kept.append(Document(
+                    id=doc.id, page_content=doc.page_content[:chars],
+                    metadata={**doc.metadata, "truncated": True},
+                ))
+                used += left
+                truncated = {"source": _source(doc), "tokens": tokens, "kept_tokens": left}
+            else:
+                dropped.append(_source(doc))
+
+        return kept, used, {"dropped": dropped, "truncated": truncated}
+
+    @STAGE_SECONDS.timed(stage="pack")
+    def pack(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """Pack the history and docs of the request within the token budget.
+
+        Args:
+            inputs (Dict[str, Any]): Chain inputs with `input`, `chat_history` and `context` (docs).
+
+        Returns:
+            Dict[str, Any]: Same inputs with packed `chat_history` and `context`, plus the `packing` report.
+        """
+
+        history = inputs.get("chat_history") or []
+        docs = inputs.get("context") or []
+        input_tokens = count_tokens(inputs["input"])
+
+        free = self.max_tokens - self.answer_reserve - self.prompt_tokens - input_tokens
+        if free <= 0:
+            log.warning(f"Input alone fills the context ({input_tokens} tokens), dropping history and docs.")
+            free = 0
+
+        # History gets its share first, whatever it leaves goes to the docs:
+        kept_history, history_tokens = self._trim_history(history, int(free * self.history_share))
+        kept_docs, doc_tokens, doc_report = self._fit_docs(docs, free - history_tokens)
+        if self.stable_order:
+            # Same docs > same context text, whatever order the retriever returned them in:
+            kept_docs.sort(key=_position)
+
+        report = {
+            "budget": self.max_tokens,
+            "used": self.prompt_tokens + input_tokens + history_tokens + doc_tokens,
+            "answer_reserve": self.answer_reserve,
+            "history": {"kept": len(kept_history), "dropped": len(history) - len(kept_history),
+                        "tokens": history_tokens},
+            "documents": {"kept": len(kept_docs), "tokens": doc_tokens, **doc_report},
+        }
+        if report["history"]["dropped"] or doc_report["dropped"] or doc_report["truncated"]:
+            log.info(
+                f"Packed context: dropped {report['history']['dropped']} messages, "
+                f"{len(doc_report['dropped'])} docs, truncated {doc_report['truncated']}."
+            )
+
+        return {**inputs, "chat_history": kept_history, "context": kept_docs, "packing": report}
+
+    def as_runnable(self) -> Runnable:
+        """Returns the stage as runnable, taking and returning the chain inputs."""
+        return RunnableLambda(self.pack, name="pack_context")
+
+
+if __name__ == "__main__":
+    from langchain_core.messages import AIMessage, HumanMessage
+    from .prompts import template_chat
+
+    packer = ContextPacker(template_chat, max_tokens=3000, answer_reserve=500)
+    history = [HumanMessage("q" * 1200), AIMessage("a" * 1200)] * 3
+    docs = [Document(page_content="d" * 2000, metadata={"source": "x.pdf", "page": i}) for i in range(6)]
+
+    packed = packer.pack({"input": "What is x?", "chat_history": history, "context": docs})
+    print(packed["packing"])
+    assert packed["packing"]["used"] <= 3000 - 500, "Over budget"
+    assert packed["chat_history"][0].type == "human", "History starts with AI reply"
+    assert packed["packing"]["documents"]["truncated"], "Nothing truncated"
+    assert "truncated" not in docs[0].metadata, "Original doc mutated"
+
+    stable = ContextPacker(template_chat, stable_order=True)
+    packed = stable.pack({"input": "What is x?", "chat_history": [], "context": docs[:3][::-1]})
+    assert [d.metadata["page"] for d in packed["context"]] == [0, 1, 2], "Docs not in stable order"
+    print("All packer checks passed.")
@@ -0,0 +1,94 @@
+"""Contains the prefix reuse tracker of the chat prompts.
+- llama.cpp / Ollama keep the KV state of the last prompt, and only prefill the part after the longest
+  common prefix with the new prompt.
+- The tracker renders each chat prompt sent to the LLM, compares it with the previous prompt of the same
+  session, and records the reusable prefix length (approx tokens) per request.
+"""
+
+import os
+from threading import Lock
+from collections import OrderedDict
+from typing import Any, Dict
+
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+
+from .packer import count_tokens, CHARS_PER_TOKEN
+from llm_system.config import PREFIX_TRACK_SESSIONS
+
+from logger import get_logger
+log = get_logger(name="chains_prefix")
+
+
+def render_prompt(prompt: PromptValue) -> str:
+    """Flat text of the prompt messages, in the order the backend's chat template would serialize them."""
+    return "".join(f"<{m.type}>\n{m.text()}\n" for m in prompt.to_messages())
+
+
+class PrefixTracker:
+    """Measures how much of each chat prompt is a prefix of the previous prompt of the session.
+
+    Args:
+        max_sessions (int): Num of sessions whose last prompt is kept (LRU).
+
+    ## Functions:
+        + `observe(session_id, text)`: Records one prompt, returns its reuse metrics.
+        + `as_runnable()`: Returns a pass-through runnable observing the prompts, to put before the LLM.
+        + `get_stats()`: Returns the avg reuse ratio and the total reused tokens.
+    """
+
+    def __init__(self, max_sessions: int = PREFIX_TRACK_SESSIONS):
+        self.max_sessions = max_sessions
+        self._lock = Lock()
+        self._last: "OrderedDict[str, str]" = OrderedDict()
+        self._stats = {"requests": 0, "prompt_tokens": 0, "prefix_tokens": 0}
+
+    def observe(self, session_id: str, text: str) -> Dict[str, Any]:
+        """Record the prompt of one request.
+
+        Returns:
+            Dict[str, Any]: `prompt_tokens`, `prefix_tokens` (reusable) and their `reuse` ratio.
+        """
+
+        with self._lock:
+            previous = self._last.pop(session_id, "")
+            self._last[session_id] = text
+            while len(self._last) > self.max_sessions:
+                self._last.popitem(last=False)
+
+        prefix = len(os.path.commonprefix([previous, text]))
+        metrics = {
+            "prompt_tokens": count_tokens(text),
+            "prefix_tokens": prefix // CHARS_PER_TOKEN,
+        }
+        metrics["reuse"] = round(metrics["prefix_tokens"] / max(metrics["prompt_tokens"], 1), 3)
+
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["prompt_tokens"] += metrics["prompt_tokens"]
+            self._stats["prefix_tokens"] += metrics["prefix_tokens"]
+
+        log.info(
+            f"Prompt prefix reuse for '{session_id}': {metrics['prefix_tokens']} / "
+            f"{metrics['prompt_tokens']} tokens ({metrics['reuse']:.1%})."
+        )
+        return metrics
+
+    def as_runnable(self) -> Runnable:
+        """Returns a runnable passing the prompt through as is, after observing it for the session."""
+
+        def _observe(prompt: PromptValue, config: RunnableConfig) -> PromptValue:
+            session_id = config.get("configurable", {}).get("session_id", "unknown_session")
+            self.observe(session_id, render_prompt(prompt))
+            return prompt
+
+        return RunnableLambda(_observe, name="observe_prefix")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns the num of requests, total prompt / reused tokens and the overall reuse ratio."""
+        with self._lock:
+            return {
+                **self._stats,
+                "reuse": round(self._stats["prefix_tokens"] / max(self._stats["prompt_tokens"], 1), 3),
+                "sessions": len(self._last),
+            }
@@ -1,4 +1,11 @@
-"""Contains the prompt templates for chat and summarization tasks."""
+"""Contains the prompt templates for chat and summarization tasks.
+- `template_chat`: Context documents inside the system message, ahead of the chat history.
+- `template_chat_cached`: Same instructions, but with the per turn context placed late (in the last
+  human message), so the system prefix + history stay byte identical across turns of a session.
+  The backend (llama.cpp / Ollama) can then reuse its cached KV state of that prefix.
+- `template_summarize`: Condenses the chat history + latest input into a standalone question.
+- `template_memory`: Folds older turns into the running summary of the conversation.
+"""
 
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 
@@ -28,6 +35,31 @@ template_chat = ChatPromptTemplate.from_messages(
 )
 
 
+# Chat Template, prefix cache friendly:
+template_chat_cached = ChatPromptTemplate.from_messages(
+    messages=[
+        ("system",  (
+            "You are a highly knowledgeable and helpful AI assistant.\n"
+            "You will be provided with:\n"
+            "- The user's ongoing conversation history\n"
+            "- A set of external context documents, given along with the user's latest query\n\n"
+            "Your responsibilities:\n"
+            "1. Answer the user's latest query clearly and accurately.\n"
+            "2. Integrate relevant information from the context documents given with it.\n"
+            "3. Use markdown formatting for readability (e.g., headings, bullet points, code blocks, tables, ...).\n"
+            "4. If the required answer is not found in the context, explicitly mention this and fall back to your general knowledge, making it clear that the source is outside the provided documents."
+        )),
+        MessagesPlaceholder(variable_name="chat_history"),
+        ("human", (
+            "### Context Documents\n"
+            "<CONTEXT>{context}</CONTEXT>\n\n"
+            "### Query\n"
+            "{input}"
+        ))
+    ]
+)
+
+
 # Summarizer Template:
 template_summarize = ChatPromptTemplate.from_messages(
     messages=[
@@ -47,4 +79,19 @@ template_summarize = ChatPromptTemplate.from_messages(
     ]
 )
 
-log.info("Initialized chat and summarize prompt templates.")
+# Memory Template, folds older turns into the running summary of the conversation:
+template_memory = ChatPromptTemplate.from_messages(
+    messages=[
+        ("system", (
+            "You maintain a running summary of a conversation between a user and an AI assistant.\n"
+            "Extend the current summary with the new lines of the conversation.\n"
+            "- Keep the facts, names, numbers, documents and open questions that later turns may refer to.\n"
+            "- Drop greetings and repetitions.\n"
+            "- Keep it under 200 words.\n\n"
+            "Only return the new summary. Do not add explanations or formatting."
+        )),
+        ("human", "Current summary:\n{summary}\n\nNew lines of the conversation:\n{new_lines}")
+    ]
+)
+
+log.info("Initialized chat, summarize and memory prompt templates.")
@@ -1,49 +1,130 @@
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.runnables import RunnableWithMessageHistory
+from langchain_core.runnables import Runnable, RunnableLambda, RunnablePassthrough, RunnableWithMessageHistory
 
-from .prompts import template_chat as chat_prompt
+from .prompts import template_chat, template_chat_cached
 from .prompts import template_summarize as summary_prompt
+from .retrieval import ContextRetriever
+from .packer import ContextPacker
+from .standalone import StandaloneDetector
+from .speculative import SpeculativeRetrieval
+from .reranker import Reranker
+from .answer_cache import AnswerCache
+from .prefix import PrefixTracker
+from .compressor import SentenceCompressor
+from .intent import IntentRouter
+from .merger import ChunkMerger
+from .native import NativeRagChain
+from llm_system.config import PROMPT_LAYOUT, RAG_EXECUTOR
 
-from typing import Callable
+from typing import Callable, Optional
 from langchain_core.vectorstores import VectorStoreRetriever
-from langchain_core.language_models.chat_models import BaseChatModel
 
 from logger import get_logger
 log = get_logger(name="chains_rag")
 
 
 def build_rag_chain(
-        llm_chat: BaseChatModel, llm_summary: BaseChatModel,
-        retriever: VectorStoreRetriever, get_history_fn: Callable):
+        llm_chat: Runnable, llm_summary: Runnable,
+        retriever: VectorStoreRetriever, get_history_fn: Callable,
+        detector: Optional[StandaloneDetector] = None,
+        speculation: Optional[SpeculativeRetrieval] = None,
+        reranker: Optional[Reranker] = None,
+        answer_cache: Optional[AnswerCache] = None,
+        prefix_tracker: Optional[PrefixTracker] = None,
+        compressor: Optional[SentenceCompressor] = None,
+        intent_router: Optional[IntentRouter] = None,
+        merger: Optional[ChunkMerger] = None,
+        prompt_layout: str = PROMPT_LAYOUT,
+        executor: str = RAG_EXECUTOR):
     """Builds a Conversational RAG (Retrieval-Augmented Generation) chain.
 
     Args:
-        llm_chat (BaseChatModel): The LLM model for generating chat responses.
-        llm_summary (BaseChatModel): The LLM model for summarizing chat history.
+        llm_chat (Runnable): The chat model (or `ModelRouter` stage) for generating chat responses.
+        llm_summary (Runnable): The chat model (or `ModelRouter` stage) for summarizing chat history.
         retriever (VectorStoreRetriever): The retriever to fetch relevant documents.
         get_history_fn (Callable): Function to retrieve chat history for a session.
+        detector (StandaloneDetector, optional): Skips the summarization of already standalone questions.
+        speculation (SpeculativeRetrieval, optional): Retrieves for the raw input while summarizing.
+        reranker (Reranker, optional): Reorders a larger candidate set, and keeps the best docs.
+        answer_cache (AnswerCache, optional): Replays answers of similar questions over unchanged docs.
+        prefix_tracker (PrefixTracker, optional): Measures the prompt prefix shared with the session's last one.
+        compressor (SentenceCompressor, optional): Sends only the relevant sentences of the docs to the LLM.
+        intent_router (IntentRouter, optional): Skips the retrieval for chit-chat / rework of the last answer.
+        merger (ChunkMerger, optional): Stitches the overlapping chunks of a page into one doc.
+        prompt_layout (str): `cache_friendly` (context late, stable docs order) or `legacy` (context in system).
+        executor (str): `runnable` (the runnable stack below) or `native` (same stages in plain async code).
 
     Returns:
         RunnableWithMessageHistory: A runnable chain that processes user input and chat history
         to provide a final answer based on retrieved documents and chat context.
+        (`NativeRagChain` with the `native` executor, streaming the same chunks, async only.)
     """
 
-    log.info("Building the Conversational RAG Chain...")
+    if executor == "native":
+        log.info("Building the native async RAG chain...")
+        return NativeRagChain(
+            llm_chat, llm_summary, retriever, get_history_fn, detector, speculation, reranker,
+            answer_cache, prefix_tracker, compressor, intent_router, merger, prompt_layout)
+
+    log.info(f"Building the Conversational RAG Chain with '{prompt_layout}' prompt layout...")
+    cache_friendly = prompt_layout == "cache_friendly"
+    chat_prompt = template_chat_cached if cache_friendly else template_chat
+
+    # Stage to decide whether the turn needs documents at all
+    # 3a User Input + Chat History > Rules (+ Prototypes) > Intent (retrieve / chitchat / meta)
+    route = RunnablePassthrough() if intent_router is None else intent_router.as_runnable()
 
     # Chain to summarize the history and retrieve relevant documents
-    # 3 User Input + Chat History > Summarizer Template > Standalone Que > Get Docs
-    retriever_chain = create_history_aware_retriever(llm_summary, retriever, summary_prompt)
+    # 3b User Input + Chat History > Summarizer Template > Standalone Que > Get Docs
+    #   (Skipped, with no docs, if the intent is not `retrieve`)
+    #   (Summarizer is skipped if the user input is already a standalone question)
+    #   (Docs for the raw user input are retrieved while summarizing, and reused if still relevant)
+    #   (With reranker: Get more Docs > Rerank against Standalone Que > Best Docs)
+    #   (With answer cache: Standalone Que > Cached Answer + Docs, if any)
+    retriever_chain = ContextRetriever(
+        llm_summary, retriever, summary_prompt, detector, speculation, reranker, answer_cache).as_runnable()
     log.info("Created the retriever chain with summarization.")
 
+    # Stage to send the overlap of consecutive chunks only once
+    # 4a Docs > Group by Source / Page > Stitch contiguous chunks (by `start_index`) > Merging Report
+    merge = RunnablePassthrough() if merger is None else merger.as_runnable()
+
+    # Stage to fit the prompt, history and docs within the model's context size
+    # 4b Chat History + Docs > Trim History > Fit Docs > Packing Report
+    #   (Cache friendly layout: kept docs in source / page order, so same docs > same prompt text)
+    packer = ContextPacker(chat_prompt, stable_order=cache_friendly).as_runnable()
+    log.info("Created the context packer.")
+
+    # Stage to keep only the sentences of the docs relevant to the standalone question
+    # 5 Packed Docs > Split Sentences > Score vs Standalone Que > Best Sentences (+ neighbours)
+    #   (Original docs stay in `context` for the client, the LLM gets `compressed_context`)
+    compress = RunnablePassthrough() if compressor is None else compressor.as_runnable()
+
     # Chain to combine the retrieved documents and get the final answer
-    # 4 Multiple Docs > Combine All > Chat Template > Final Output
-    qa_chain = create_stuff_documents_chain(llm=llm_chat, prompt=chat_prompt)
+    # 6 Multiple Docs > Combine All > Chat Template > Final Output
+    #   (With prefix tracker: Chat Template > Measure prefix reuse > LLM)
+    llm = llm_chat if prefix_tracker is None else prefix_tracker.as_runnable() | llm_chat
+    qa_chain = create_stuff_documents_chain(llm=llm, prompt=chat_prompt)
+    if compressor is not None:
+        qa_chain = RunnableLambda(
+            lambda inputs: {**inputs, "context": inputs["compressed_context"]}, name="use_compressed_context"
+        ) | qa_chain
+    if answer_cache is not None:
+        # Cached Answer > Replay | Final Output > Store in cache
+        qa_chain = answer_cache.as_answer_stage(qa_chain)
     log.info("Created the QA chain with chat template.")
 
-    # Main RAG Chain:
-    # 2 Input + Chat History > [ `Summarizer Template` > `Get Docs` ] > [ `Combine` > `Chat Template` ] > Output
-    rag_chain = create_retrieval_chain(retriever_chain, qa_chain)
+    # Main RAG Chain (same as `create_retrieval_chain`, with merging / packing / compression in between):
+    # 2 Input + Chat History > `Route` > [ `Summarizer Template` > `Get Docs` ] > `Merge` > `Pack` > `Compress`
+    #   > [ `Combine` > `Chat Template` ] > Output
+    rag_chain = (
+        route
+        | retriever_chain.with_config(run_name="retrieve_documents")
+        | merge
+        | packer
+        | compress
+        | RunnablePassthrough.assign(answer=qa_chain)
+    ).with_config(run_name="retrieval_chain")
     log.info("Created the main RAG chain.")
 
     log.info("Returning the final Conversational RAG Chain w history.")
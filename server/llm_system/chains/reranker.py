@@ -0,0 +1,267 @@
+"""Contains the second stage ranking of the retrieved documents.
+- More candidates than needed are retrieved, scored against the standalone question in one batch,
+  and cut back to the requested `k`.
+- Scorers are pluggable: `LexicalScorer` needs no model, `CrossEncoderScorer` runs a local cross-encoder.
+- Scoring is bounded by a time budget, after which the first stage (vector search) order is used.
+
+## For testing:
+- Run this file from `server` folder as:
+- `python -m llm_system.chains.reranker`
+"""
+
+import re
+import math
+import asyncio
+from threading import Lock
+from time import perf_counter
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, Dict, List, Optional, Protocol, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import patch_config
+
+from llm_system.config import (
+    DOCS_NUM_COUNT, RERANK_SCORER, RERANK_CANDIDATE_MULT, RERANK_TIME_BUDGET_MS, RERANK_PRIOR_WEIGHT
+)
+
+from logger import get_logger
+log = get_logger(name="chains_reranker")
+
+_WORD_RE = re.compile(r"\w[\w.-]*")
+_STOPWORDS = frozenset(
+    "a an the and or but of to in on at by for with from as is are was were be been being do does did "
+    "what which who whom whose when where why how this that these those it its i me my we our you your "
+    "he she they them their can could should would will shall may might must not no yes please tell "
+    "about into over under than then there here so if any all some more most such only also just".split()
+)
+
+
+def _terms(text: str) -> List[str]:
+    return [w for w in _WORD_RE.findall(text.lower()) if len(w) > 1 and w not in _STOPWORDS]
+
+
+class Scorer(Protocol):
+    """Scores candidate docs against the query, higher is better. Docs below `min_score` are dropped."""
+    name: str
+    min_score: Optional[float]
+
+    def score(self, query: str, docs: List[Document]) -> List[float]: ...
+
+
+class LexicalScorer:
+    """IDF weighted query term overlap, over the candidate set itself, fused with a prior from the first stage rank.
+    - Overlap is in [0, 1), and the prior is `prior_weight / (1 + rank)`.
+    - Docs sharing no query term keep their prior, so good dense hits (paraphrases) are not dropped.
+    """
+
+    name = "lexical"
+    min_score: Optional[float] = None
+
+    def __init__(self, prior_weight: float = RERANK_PRIOR_WEIGHT):
+        self.prior_weight = prior_weight
+
+    def score(self, query: str, docs: List[Document]) -> List[float]:
+        query_terms = set(_terms(query))
+        doc_terms = [Counter(_terms(doc.page_content)) for doc in docs]
+
+        n_docs = len(docs)
+        idf = {
+            term: math.log(1 + n_docs / (1 + sum(1 for terms in doc_terms if term in terms)))
+            for term in query_terms
+        }
+        max_weight = sum(idf.values()) or 1.0
+
+        scores = []
+        for rank, terms in enumerate(doc_terms):
+            overlap = sum(idf[t] * terms[t] / (terms[t] + 1.2) for t in query_terms if t in terms)
+            prior = self.prior_weight / (1 + rank)
+            scores.append(overlap / max_weight + prior)
+        return scores
+
+
+class CrossEncoderScorer:
+    """Scores (query, doc) pairs with a local `sentence_transformers` cross-encoder, on CPU."""
+
+    name = "cross-encoder"
+    min_score: Optional[float] = None
+
+    def __init__(self, model_name: str, max_length: int = 512):
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError as e:
+            raise ImportError(
+                "Cross-encoder reranking needs `sentence_transformers`, install it with "
+                "`pip install sentence-transformers`."
+            ) from e
+        self.model = CrossEncoder(model_name, max_length=max_length, device="cpu")
+        self.name = f"cross-encoder:{model_name}"
+
+    def score(self, query: str, docs: List[Document]) -> List[float]:
+        return [float(s) for s in self.model.predict([(query, doc.page_content) for doc in docs])]
+
+
+def get_scorer(spec: str = RERANK_SCORER) -> Scorer:
+    """Build the scorer from its spec: `lexical` or `cross-encoder:<model>`, falls back to `lexical`."""
+    if spec.startswith("cross-encoder:"):
+        try:
+            return CrossEncoderScorer(spec[len("cross-encoder:"):])
+        except Exception as e:
+            log.error(f"Failed to load '{spec}', falling back to lexical scorer: {e}")
+    elif spec != "lexical":
+        log.error(f"Unknown scorer '{spec}', falling back to lexical scorer.")
+    return LexicalScorer()
+
+
+class Reranker:
+    """Reorders the retrieved candidates with a scorer, within a time budget.
+
+    Args:
+        scorer (Scorer, optional): The scorer to use. Defaults to the one in `RERANK_SCORER`.
+        candidate_mult (int): Candidates retrieved per final doc.
+        time_budget_ms (int): Max scoring time, after which the first stage order is used.
+        default_k (int): Final num of docs, if the request does not set `k` in its search kwargs.
+
+    ## Functions:
+        + `widen(config)`: Returns the config retrieving more candidates, and the final `k`.
+        + `rerank()` / `arerank()`: Returns the best `k` candidates for the query.
+        + `get_stats()`: Returns the num of reranks, fallbacks and the scoring latency.
+    """
+
+    def __init__(self, scorer: Optional[Scorer] = None, candidate_mult: int = RERANK_CANDIDATE_MULT,
+                 time_budget_ms: int = RERANK_TIME_BUDGET_MS, default_k: int = DOCS_NUM_COUNT):
+        self.scorer = scorer or get_scorer()
+        self.candidate_mult = max(1, candidate_mult)
+        self.time_budget = time_budget_ms / 1000
+        self.default_k = default_k
+
+        # Scoring runs in its own threads, so that a slow scorer can be abandoned:
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="rerank")
+        self._lock = Lock()
+        self._stats = {"reranked": 0, "timeouts": 0, "errors": 0, "no_match": 0, "dropped": 0}
+        self._score_seconds = 0.0
+        log.info(
+            f"Initialized Reranker(scorer={self.scorer.name}, candidate_mult={candidate_mult}, "
+            f"time_budget_ms={time_budget_ms})."
+        )
+
+    def widen(self, config: RunnableConfig) -> Tuple[RunnableConfig, int]:
+        """Returns the config with `k * candidate_mult` in its search kwargs, and the original `k`."""
+        configurable = config.get("configurable", {})
+        search_kwargs = configurable.get("search_kwargs") or {}
+        k = search_kwargs.get("k", self.default_k)
+        wide_kwargs = {**search_kwargs, "k": k * self.candidate_mult}
+        return patch_config(config, configurable={**configurable, "search_kwargs": wide_kwargs}), k
+
+    def _count(self, key: str, value: int = 1):
+        with self._lock:
+            self._stats[key] += value
+
+    def _order(self, docs: List[Document], k: int, scores: List[float]) -> List[Document]:
+        """Best `k` docs by score, without the ones below the scorer's `min_score`."""
+        ranked = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)[:k]
+        min_score = self.scorer.min_score
+        if min_score is not None:
+            kept = [i for i in ranked if scores[i] >= min_score]
+            if not kept:
+                self._count("no_match")
+                return docs[:k]
+            self._count("dropped", len(ranked) - len(kept))
+            ranked = kept
+        return [docs[i] for i in ranked]
+
+    def _finish(self, docs: List[Document], k: int, scores: Optional[List[float]], error: Optional[str], start: float) -> List[Document]:
+        elapsed = perf_counter() - start
+        if scores is None:
+            self._count("timeouts" if error == "timeout" else "errors")
+            log.warning(f"Rerank {error} after {1000 * elapsed:.0f} ms, using first stage order.")
+            return docs[:k]
+
+        with self._lock:
+            self._stats["reranked"] += 1
+            self._score_seconds += elapsed
+        result = self._order(docs, k, scores)
+        log.info(f"Reranked {len(docs)} candidates to {len(result)} docs in {1000 * elapsed:.1f} ms.")
+        return result
+
+    def rerank(self, query: str, docs: List[Document], k: int) -> List[Document]:
+        """Returns the best `k` of the candidate docs for the query, or the first `k` if scoring fails.
+
+        Args:
+            query (str): The standalone question.
+            docs (List[Document]): Candidates in first stage order.
+            k (int): Num of docs to return.
+        """
+
+        if len(docs) <= 1:
+            return docs[:k]
+
+        start = perf_counter()
+        future = self._executor.submit(self.scorer.score, query, docs)
+        try:
+            return self._finish(docs, k, future.result(timeout=self.time_budget), None, start)
+        except FutureTimeout:
+            return self._finish(docs, k, None, "timeout", start)
+        except Exception as e:
+            log.error(f"Rerank scorer failed: {e}")
+            return self._finish(docs, k, None, "error", start)
+
+    async def arerank(self, query: str, docs: List[Document], k: int) -> List[Document]:
+        """Async version of `rerank`."""
+
+        if len(docs) <= 1:
+            return docs[:k]
+
+        start = perf_counter()
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self.scorer.score, query, docs)
+        try:
+            scores = await asyncio.wait_for(future, timeout=self.time_budget)
+            return self._finish(docs, k, scores, None, start)
+        except asyncio.TimeoutError:
+            return self._finish(docs, k, None, "timeout", start)
+        except Exception as e:
+            log.error(f"Rerank scorer failed: {e}")
+            return self._finish(docs, k, None, "error", start)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns the counts of reranks / fallbacks / dropped docs, and the avg scoring time."""
+        with self._lock:
+            done = self._stats["reranked"]
+            return {
+                "scorer": self.scorer.name,
+                **self._stats,
+                "avg_score_ms": round(1000 * self._score_seconds / done, 1) if done else 0.0,
+            }
+
+
+if __name__ == "__main__":
+    import time
+
+    candidates = [
+        Document(page_content="The weather is sunny today."),
+        Document(page_content="Refund policy: refunds are issued within 30 days of purchase."),
+        Document(page_content="Shipping takes 5 days."),
+        Document(page_content="A refund needs the original receipt."),
+    ]
+
+    reranker = Reranker(LexicalScorer())
+    best = reranker.rerank("What is the refund policy?", candidates, k=3)
+    print([d.page_content for d in best])
+    assert best[0] is candidates[1] and len(best) == 3, "Lexical rerank mismatch"
+
+    # Top dense hit without any shared term (a paraphrase) is kept:
+    paraphrase = [Document(page_content="Money is returned within a month of buying.")] + candidates
+    best = reranker.rerank("What is the refund policy?", paraphrase, k=3)
+    assert paraphrase[0] in best, "Dense hit without lexical overlap dropped"
+
+    class SlowScorer(LexicalScorer):
+        def score(self, query, docs):
+            time.sleep(0.5)
+            return super().score(query, docs)
+
+    slow = Reranker(SlowScorer(), time_budget_ms=50)
+    assert slow.rerank("refund policy", candidates, k=2) == candidates[:2], "No fallback on timeout"
+    assert asyncio.run(slow.arerank("refund policy", candidates, k=2)) == candidates[:2], "No async fallback"
+    print(reranker.get_stats(), slow.get_stats())
+    print("All reranker checks passed.")
@@ -0,0 +1,217 @@
+"""Contains the history aware retrieval stage of the RAG chain.
+- Same behavior as langchain's `create_history_aware_retriever`:
+  User Input + Chat History > Summarizer Template > Standalone Que > Get Docs
+- Except that the condensing LLM call is skipped when the question is already standalone.
+- And that (async only) docs are speculatively retrieved for the raw input while condensing.
+- Optionally, more candidates are retrieved and reranked against the standalone question.
+- Optionally, a semantically cached answer for the standalone question skips the retrieval.
+- Turns routed to an intent other than `retrieve` (see `IntentRouter`) skip condensing and retrieval.
+"""
+
+import asyncio
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import BasePromptTemplate
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from langchain_core.retrievers import RetrieverLike
+
+from .standalone import StandaloneDetector
+from .speculative import SpeculativeRetrieval, SAME_QUESTION
+from .reranker import Reranker
+from .answer_cache import AnswerCache, CacheLookup
+from .intent import RETRIEVE
+
+from metrics import STAGE_SECONDS
+from logger import get_logger
+log = get_logger(name="chains_retrieval")
+
+
+class ContextRetriever:
+    """Condenses the user input with chat history into a standalone question, and retrieves documents for it.
+
+    Args:
+        llm_summary (Runnable): The chat model (or `ModelRouter` stage) for condensing the chat history.
+        retriever (RetrieverLike): The (configurable) retriever to fetch relevant documents.
+        prompt (BasePromptTemplate): The summarizer prompt, with `input` and `chat_history` variables.
+        detector (StandaloneDetector, optional): Detector to skip condensing of standalone questions.
+        speculation (SpeculativeRetrieval, optional): Policy to retrieve for the raw input while condensing.
+        reranker (Reranker, optional): Second stage ranking of a larger candidate set.
+        answer_cache (AnswerCache, optional): Semantic cache of answers, looked up by the standalone question
+            of turns without chat history.
+
+    ## Functions:
+        + `condense()` / `acondense()`: Returns the standalone question for the inputs.
+        + `resolve()` / `aresolve()`: Returns the standalone question, documents and answer cache lookup.
+        + `retrieve()` / `aretrieve()`: Returns the documents for the inputs.
+        + `as_runnable()`: Returns the stage as a runnable, to be used in the RAG chain.
+    """
+
+    def __init__(self, llm_summary: Runnable, retriever: RetrieverLike,
+                 prompt: BasePromptTemplate, detector: Optional[StandaloneDetector] = None,
+                 speculation: Optional[SpeculativeRetrieval] = None, reranker: Optional[Reranker] = None,
+                 answer_cache: Optional[AnswerCache] = None):
+        self.retriever = retriever
+        self.detector = detector
+        self.speculation = speculation
+        self.reranker = reranker
+        self.answer_cache = answer_cache
+        self.condense_chain = (prompt | llm_summary | StrOutputParser()).with_config(
+            run_name="condense_question")
+
+    def _bypass(self, standalone: bool, reason: str) -> bool:
+        if standalone and self.detector is not None:
+            self.detector.record_bypass(reason)
+        return standalone
+
+    def _record(self, start: float):
+        seconds = perf_counter() - start
+        STAGE_SECONDS.observe(seconds, stage="condense")
+        if self.detector is not None:
+            self.detector.record_condense(seconds)
+
+    def condense(self, inputs: Dict[str, Any], config: RunnableConfig) -> str:
+        """Returns the standalone question for the user input and chat history."""
+
+        if not inputs.get("chat_history"):
+            return inputs["input"]
+
+        if self.detector is not None and self._bypass(
+                *self.detector.is_standalone(inputs["input"], inputs["chat_history"])):
+            return inputs["input"]
+
+        start = perf_counter()
+        question = self.condense_chain.invoke(inputs, config)
+        self._record(start)
+        return question
+
+    async def _aneeds_condense(self, inputs: Dict[str, Any]) -> bool:
+        if not inputs.get("chat_history"):
+            return False
+        if self.detector is not None and self._bypass(
+                *await self.detector.ais_standalone(inputs["input"], inputs["chat_history"])):
+            return False
+        return True
+
+    async def _acondense_llm(self, inputs: Dict[str, Any], config: RunnableConfig) -> str:
+        start = perf_counter()
+        question = await self.condense_chain.ainvoke(inputs, config)
+        self._record(start)
+        return question
+
+    async def acondense(self, inputs: Dict[str, Any], config: RunnableConfig) -> str:
+        """Async version of `condense`."""
+        if not await self._aneeds_condense(inputs):
+            return inputs["input"]
+        return await self._acondense_llm(inputs, config)
+
+    def _resolved(self, question: str, docs: List[Document], lookup: Optional[CacheLookup]) -> Dict[str, Any]:
+        return {"standalone_question": question, "context": docs, "cache": lookup}
+
+    @staticmethod
+    def _skips(inputs: Dict[str, Any]) -> bool:
+        return inputs.get("intent", RETRIEVE) != RETRIEVE
+
+    def _caches(self, inputs: Dict[str, Any]) -> bool:
+        """Answer cache only for turns without history, whose answer depends on the question and docs alone."""
+        return self.answer_cache is not None and not inputs.get("chat_history")
+
+    @STAGE_SECONDS.timed(stage="retrieve")
+    def resolve(self, inputs: Dict[str, Any], config: RunnableConfig) -> Dict[str, Any]:
+        """Returns `{"standalone_question", "context", "cache"}` for the user input and chat history.
+        - `cache` is the answer cache lookup (None without cache), on a hit `context` is the cached one.
+        - No docs for turns which need no retrieval (`intent` other than `retrieve`).
+        """
+
+        if self._skips(inputs):
+            return self._resolved(inputs["input"], [], None)
+
+        question = self.condense(inputs, config)
+        lookup = self.answer_cache.lookup(question, config) if self._caches(inputs) else None
+        if lookup is not None and lookup.entry is not None:
+            return self._resolved(question, lookup.entry.context, lookup)
+
+        if self.reranker is None:
+            return self._resolved(question, self.retriever.invoke(question, config), lookup)
+
+        wide_config, k = self.reranker.widen(config)
+        docs = self.reranker.rerank(question, self.retriever.invoke(question, wide_config), k)
+        return self._resolved(question, docs, lookup)
+
+    def retrieve(self, inputs: Dict[str, Any], config: RunnableConfig) -> List[Document]:
+        """Returns the documents relevant to the (condensed) user input."""
+        return self.resolve(inputs, config)["context"]
+
+    async def _atimed_retrieve(self, question: str, config: RunnableConfig) -> Tuple[List[Document], float]:
+        start = perf_counter()
+        docs = await self.retriever.ainvoke(question, config)
+        return docs, perf_counter() - start
+
+    async def _acandidates(self, inputs: Dict[str, Any],
+                           config: RunnableConfig) -> Tuple[str, List[Document], Optional[CacheLookup]]:
+        """Returns the standalone question, its docs and the answer cache lookup (the cached context on a hit).
+        - With speculation, docs for the raw input are retrieved concurrently with the condensing call.
+        """
+
+        speculative = None
+        if not await self._aneeds_condense(inputs):
+            question = inputs["input"]
+        elif self.speculation is None:
+            question = await self._acondense_llm(inputs, config)
+        else:
+            question, (speculative, spec_seconds) = await asyncio.gather(
+                self._acondense_llm(inputs, config),
+                self._atimed_retrieve(inputs["input"], config),
+            )
+
+        lookup = None
+        if self._caches(inputs):
+            lookup = await self.answer_cache.alookup(question, config)  # type: ignore[union-attr]
+            if lookup.entry is not None:
+                return question, lookup.entry.context, lookup
+
+        if speculative is None:
+            return question, await self.retriever.ainvoke(question, config), lookup
+
+        if self.speculation.same_question(inputs["input"], question):  # type: ignore[union-attr]
+            self.speculation.record(SAME_QUESTION, hidden_seconds=spec_seconds)  # type: ignore[union-attr]
+            return question, speculative, lookup
+
+        docs = await self.retriever.ainvoke(question, config)
+        docs, outcome = self.speculation.resolve(speculative, docs)  # type: ignore[union-attr]
+        self.speculation.record(outcome)  # type: ignore[union-attr]
+        return question, docs, lookup
+
+    @STAGE_SECONDS.timed(stage="retrieve")
+    async def aresolve(self, inputs: Dict[str, Any], config: RunnableConfig) -> Dict[str, Any]:
+        """Async version of `resolve`."""
+
+        if self._skips(inputs):
+            return self._resolved(inputs["input"], [], None)
+
+        if self.reranker is None:
+            return self._resolved(*await self._acandidates(inputs, config))
+
+        wide_config, k = self.reranker.widen(config)
+        question, docs, lookup = await self._acandidates(inputs, wide_config)
+        # A hit replays the cached context as is, it was already reranked when stored:
+        if lookup is not None and lookup.entry is not None:
+            return self._resolved(question, docs, lookup)
+        return self._resolved(question, await self.reranker.arerank(question, docs, k), lookup)
+
+    async def aretrieve(self, inputs: Dict[str, Any], config: RunnableConfig) -> List[Document]:
+        """Async version of `retrieve`."""
+        return (await self.aresolve(inputs, config))["context"]
+
+    def as_runnable(self) -> Runnable:
+        """Returns the stage as runnable, taking `{input, chat_history}` and adding the `resolve` keys to it."""
+
+        def _stage(inputs: Dict[str, Any], config: RunnableConfig) -> Dict[str, Any]:
+            return {**inputs, **self.resolve(inputs, config)}
+
+        async def _astage(inputs: Dict[str, Any], config: RunnableConfig) -> Dict[str, Any]:
+            return {**inputs, **await self.aresolve(inputs, config)}
+
+        return RunnableLambda(_stage, afunc=_astage, name="chat_retriever_chain")
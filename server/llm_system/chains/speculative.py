@@ -0,0 +1,110 @@
+"""Contains the speculative retrieval policy, used to overlap retrieval with the history condensing LLM call.
+- Docs are retrieved for the raw user input while `llm_summary` writes the standalone question.
+- If the standalone question is about the same as the raw input, the speculative docs are used as is.
+- Else the standalone question is retrieved too, and both sets are merged if they differ materially.
+"""
+
+import re
+from threading import Lock
+from typing import Any, Dict, List, Tuple
+
+from langchain_core.documents import Document
+
+from llm_system.config import SPECULATIVE_QUERY_SIM, SPECULATIVE_MIN_OVERLAP, SPECULATIVE_MERGE_WEIGHT
+from llm_system.utils.fusion import overlap, rrf_merge
+
+from logger import get_logger
+log = get_logger(name="chains_speculative")
+
+_WORD_RE = re.compile(r"[\w'.-]+")
+
+# Outcomes of one speculative retrieval:
+SAME_QUESTION = "same_question"     # Standalone question ~ raw input, second retrieval skipped.
+SAME_DOCS = "same_docs"             # Both retrievals agree, speculative set kept.
+MERGED = "merged"                   # Both retrievals differ, sets merged.
+
+
+class SpeculativeRetrieval:
+    """Decides whether the docs retrieved for the raw input can stand in for the standalone question's docs.
+
+    Args:
+        query_similarity (float): Min word overlap (Jaccard) of raw input and standalone question
+            to use the speculative docs without retrieving again.
+        min_overlap (float): Min fraction of common docs to keep the speculative set, else both are merged.
+        merge_weight (float): Weight of the speculative docs in the merge (standalone question's docs have 1.0).
+
+    ## Functions:
+        + `same_question(raw, standalone)`: Whether the second retrieval can be skipped.
+        + `resolve(speculative, standalone_docs)`: Returns the final docs and the outcome.
+        + `record(outcome, hidden_seconds)`: Book-keeping of the outcomes.
+        + `get_stats()`: Returns the speculative hit rate and the retrieval time hidden behind condensing.
+    """
+
+    def __init__(self, query_similarity: float = SPECULATIVE_QUERY_SIM,
+                 min_overlap: float = SPECULATIVE_MIN_OVERLAP,
+                 merge_weight: float = SPECULATIVE_MERGE_WEIGHT):
+        self.query_similarity = query_similarity
+        self.min_overlap = min_overlap
+        self.merge_weight = merge_weight
+
+        self._lock = Lock()
+        self._outcomes = {SAME_QUESTION: 0, SAME_DOCS: 0, MERGED: 0}
+        self._hidden_seconds = 0.0
+        log.info(
+            f"Initialized SpeculativeRetrieval(query_similarity={query_similarity}, "
+            f"min_overlap={min_overlap}, merge_weight={merge_weight})."
+        )
+
+    def same_question(self, raw: str, standalone: str) -> bool:
+        """Whether the standalone question is about the same as the raw input (word Jaccard similarity)."""
+        raw_words = set(_WORD_RE.findall(raw.lower()))
+        new_words = set(_WORD_RE.findall(standalone.lower()))
+        if not raw_words or not new_words:
+            return raw_words == new_words
+        return len(raw_words & new_words) / len(raw_words | new_words) >= self.query_similarity
+
+    def resolve(self, speculative: List[Document], standalone_docs: List[Document]) -> Tuple[List[Document], str]:
+        """Pick the final docs from both retrievals.
+
+        Args:
+            speculative (List[Document]): Docs retrieved for the raw input.
+            standalone_docs (List[Document]): Docs retrieved for the standalone question.
+
+        Returns:
+            Tuple[List[Document], str]: The final docs, and the outcome (`SAME_DOCS` or `MERGED`).
+        """
+
+        agreement = overlap(speculative, standalone_docs)
+        if agreement >= self.min_overlap:
+            return speculative, SAME_DOCS
+
+        k = max(len(standalone_docs), len(speculative))
+        merged = rrf_merge([standalone_docs, speculative], k=k, weights=[1.0, self.merge_weight])
+        log.info(f"Speculative docs differ (overlap {agreement:.0%}), merged into {len(merged)} docs.")
+        return merged, MERGED
+
+    def record(self, outcome: str, hidden_seconds: float = 0.0):
+        """Record one outcome, with the retrieval time hidden behind the condensing call (for `SAME_QUESTION`)."""
+        with self._lock:
+            self._outcomes[outcome] += 1
+            self._hidden_seconds += hidden_seconds
+            stats = self._snapshot()
+        log.info(
+            f"Speculative retrieval: {outcome}. "
+            f"Hit rate {stats['hit_rate']:.1%}, total hidden ~{stats['hidden_ms']} ms."
+        )
+
+    def _snapshot(self) -> Dict[str, Any]:
+        total = sum(self._outcomes.values())
+        hits = self._outcomes[SAME_QUESTION] + self._outcomes[SAME_DOCS]
+        return {
+            **self._outcomes,
+            "total": total,
+            "hit_rate": hits / total if total else 0.0,
+            "hidden_ms": round(1000 * self._hidden_seconds, 1),
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns the count of each outcome, the hit rate and the retrieval time hidden."""
+        with self._lock:
+            return self._snapshot()
@@ -0,0 +1,195 @@
+"""Contains the standalone question detector, used to skip the history condensing LLM call.
+- With chat history present, the question is normally rewritten by `llm_summary` before retrieval.
+- Questions like "What is the refund policy in contract.pdf?" need no rewriting at all.
+- Detection uses cheap lexical rules, plus an optional embedding similarity check against recent turns.
+
+## For testing:
+- Run this file from `server` folder as:
+- `python -m llm_system.chains.standalone`
+"""
+
+import re
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import BaseMessage
+
+from llm_system.config import (
+    STANDALONE_MIN_WORDS, STANDALONE_EMB_CHECK, STANDALONE_EMB_MAX_SIM, STANDALONE_RECENT_TURNS
+)
+
+from logger import get_logger
+log = get_logger(name="chains_standalone")
+
+# Words without the surrounding punctuation ("it." is "it"):
+_WORD_RE = re.compile(r"\b[\w']+\b")
+
+# Question starts which continue the previous turn ("and the second one?", "what about ..."):
+_CONTINUATIONS: Tuple[str, ...] = (
+    "and", "also", "but", "so", "then", "or", "what about", "how about", "why not", "same",
+    "more", "another", "again", "continue", "elaborate", "explain more", "tell me more",
+)
+_CONTINUATION_RE = re.compile(rf"^(?:{'|'.join(map(re.escape, _CONTINUATIONS))})\b")
+
+# Words which usually point back to something said earlier:
+_REFERENCES = frozenset({
+    "it", "its", "it's", "this", "that", "these", "those", "they", "them", "their", "theirs",
+    "he", "him", "his", "she", "her", "hers", "above", "previous", "previously", "earlier",
+    "former", "latter", "same", "aforementioned", "mentioned",
+})
+
+
+class StandaloneDetector:
+    """Decides whether a question can be used for retrieval as is, without condensing it with history.
+
+    Args:
+        embeddings (Embeddings, optional): Embeddings model for the similarity check against recent turns.
+            The check only runs if given and `STANDALONE_EMB_CHECK` is enabled.
+        min_words (int): Questions with fewer words are always condensed.
+        max_similarity (float): Questions with referring words are still standalone if their
+            cosine similarity with every recent turn is below this (new topic).
+        recent_turns (int): Number of most recent human turns to compare against.
+
+    ## Functions:
+        + `is_standalone(question, chat_history)`: Returns the decision and its reason.
+        + `record_condense(seconds)` / `record_bypass(reason)`: Book-keeping of both paths.
+        + `get_stats()`: Returns the bypass rate and estimated time saved.
+    """
+
+    def __init__(self, embeddings: Optional[Embeddings] = None,
+                 min_words: int = STANDALONE_MIN_WORDS,
+                 max_similarity: float = STANDALONE_EMB_MAX_SIM,
+                 recent_turns: int = STANDALONE_RECENT_TURNS):
+        self.embeddings = embeddings if STANDALONE_EMB_CHECK else None
+        self.min_words = min_words
+        self.max_similarity = max_similarity
+        self.recent_turns = recent_turns
+
+        self._lock = Lock()
+        self._bypassed = 0
+        self._condensed = 0
+        self._condense_seconds = 0.0
+        log.info(
+            f"Initialized StandaloneDetector(min_words={min_words}, "
+            f"emb_check={self.embeddings is not None}, max_similarity={max_similarity})."
+        )
+
+    def _lexical(self, question: str) -> Tuple[Optional[bool], str]:
+        """Lexical verdict: False (needs history), True (standalone) or None (has referring words)."""
+        text = question.strip().lower()
+        words = _WORD_RE.findall(text)
+
+        if len(words) < self.min_words:
+            return False, "too_short"
+        if _CONTINUATION_RE.match(text):
+            return False, "continuation"
+        if any(word in _REFERENCES for word in words):
+            return None, "reference"
+        return True, "lexical"
+
+    def _recent_turns(self, chat_history: List[BaseMessage]) -> List[str]:
+        return [m.text() for m in chat_history if m.type == "human"][-self.recent_turns:]
+
+    def _max_similarity(self, vectors: List[List[float]]) -> float:
+        """Max cosine similarity of first vector (question) with the rest (recent turns)."""
+        matrix = np.asarray(vectors, dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12
+        similarity = float(np.max(matrix[1:] @ matrix[0]))
+        log.info(f"Question similarity with recent turns: {similarity:.3f}")
+        return similarity
+
+    def is_standalone(self, question: str, chat_history: List[BaseMessage]) -> Tuple[bool, str]:
+        """Decide whether the question can skip the condensing step.
+
+        Args:
+            question (str): The latest user input.
+            chat_history (List[BaseMessage]): The conversation so far.
+
+        Returns:
+            Tuple[bool, str]: True if it is standalone, and the reason of the decision.
+        """
+
+        if not chat_history:
+            return True, "no_history"
+
+        verdict, reason = self._lexical(question)
+        recent = self._recent_turns(chat_history)
+        if verdict is None and self.embeddings is not None and recent:
+            try:
+                vectors = self.embeddings.embed_documents([question] + recent)
+                if self._max_similarity(vectors) < self.max_similarity:
+                    return True, "new_topic"
+            except Exception as e:
+                log.error(f"Embedding check failed, condensing the question: {e}")
+        return bool(verdict), reason
+
+    async def ais_standalone(self, question: str, chat_history: List[BaseMessage]) -> Tuple[bool, str]:
+        """Async version of `is_standalone`."""
+
+        if not chat_history:
+            return True, "no_history"
+
+        verdict, reason = self._lexical(question)
+        recent = self._recent_turns(chat_history)
+        if verdict is None and self.embeddings is not None and recent:
+            try:
+                vectors = await self.embeddings.aembed_documents([question] + recent)
+                if self._max_similarity(vectors) < self.max_similarity:
+                    return True, "new_topic"
+            except Exception as e:
+                log.error(f"Embedding check failed, condensing the question: {e}")
+        return bool(verdict), reason
+
+    def record_condense(self, seconds: float):
+        """Record the duration of one condensing LLM call."""
+        with self._lock:
+            self._condensed += 1
+            self._condense_seconds += seconds
+
+    def record_bypass(self, reason: str):
+        """Record one skipped condensing call, and log the running bypass rate."""
+        with self._lock:
+            self._bypassed += 1
+            stats = self._snapshot()
+        log.info(
+            f"Condense bypassed ({reason}), saved ~{stats['avg_condense_ms']} ms. "
+            f"Bypass rate {stats['bypass_rate']:.1%}, total saved ~{stats['est_saved_ms']} ms."
+        )
+
+    def _snapshot(self) -> Dict[str, Any]:
+        total = self._bypassed + self._condensed
+        avg = self._condense_seconds / self._condensed if self._condensed else 0.0
+        return {
+            "bypassed": self._bypassed,
+            "condensed": self._condensed,
+            "bypass_rate": self._bypassed / total if total else 0.0,
+            "avg_condense_ms": round(1000 * avg, 1),
+            "est_saved_ms": round(1000 * avg * self._bypassed, 1),
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns the counts of both paths, the bypass rate and the estimated time saved."""
+        with self._lock:
+            return self._snapshot()
+
+
+if __name__ == "__main__":
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    detector = StandaloneDetector()
+    history = [HumanMessage("What is the refund policy?"), AIMessage("Refunds are paid within 30 days.")]
+    cases = {
+        "What is the refund policy in contract.pdf?": True,
+        "Please tell me more about it.": False,
+        "Who signed it?": False,
+        "Does that apply to digital goods, too?": False,
+        "and the second one?": False,
+        "What are the termination clauses of the lease agreement?": True,
+    }
+    for question, expected in cases.items():
+        standalone, reason = detector.is_standalone(question, history)
+        assert standalone == expected, f"'{question}' standalone={standalone} ({reason}), expected {expected}"
+    assert detector.is_standalone("Please tell me more about it.", [])[0], "No history is standalone"
+    print("All standalone checks passed.")
@@ -2,9 +2,25 @@
 config.py - Central configuration for AI System.
 
 This module stores all configurable constants related to:
-- LLMs (chat, summarization)
+- LLMs (chat, summarization) and their routing per chain stage
+- Admission control of the generations
 - Embeddings
 - Chunking and content limits
+- Chunk merging
+- Context packing
+- Prompt layout (prefix caching)
+- RAG chain executor
+- Context compression
+- Chat memory (rolling summary)
+- Ingestion scheduling
+- Executors of the blocking endpoint work
+- Parsed-text cache
+- Intent routing (retrieval bypass)
+- Standalone question detection
+- Speculative retrieval
+- Reranking
+- Hybrid (BM25 + vector) search
+- Answer cache
 - Verification checks
 - Dummy response simulator
 """
@@ -17,13 +33,40 @@ This module stores all configurable constants related to:
 # Model configuration::
 LLM_CHAT_MODEL_NAME: str = "gemma3:latest"              # Chatting model
 LLM_CHAT_TEMPERATURE: float = 0.75
-LLM_SUMMARY_MODEL_NAME: str = "gemma3:latest"           # History Summarization model
+LLM_SUMMARY_MODEL_NAME: str = "gemma3:latest"           # History Summarization (query rewriting) model
+# A smaller summary model (e.g. "gemma3:1b") makes the `condense` stage faster; `ollama pull` it first.
 LLM_SUMMARY_TEMPERATURE: float = 0.5
 EMB_MODEL_NAME: str = "mxbai-embed-large:latest"        # Embeddings model
 
 # The max token count which shall be allowed after 'chat_history + input + context'.
 MAX_CONTENT_SIZE: int = 14000
 
+# Model routing per chain stage (`condense`: standalone question + memory, `answer`: RAG, `simple`: /simple):
+#   - Each stage has its primary / fallback model, context size, temperature and keep-alive.
+#   - Calls go to the fallback while the primary's expected wait (in flight calls x avg latency)
+#     exceeds `LLM_FALLBACK_WAIT_MS`, or when the primary fails before its first token.
+#   - A fallback equal to the primary model is never used (the default, until a smaller summary model is set).
+#   - A model used by several stages is loaded with the largest of their context sizes (Ollama reloads on change).
+LLM_STAGES: dict = {
+    "condense": {"model": LLM_SUMMARY_MODEL_NAME, "fallback": LLM_CHAT_MODEL_NAME,
+                 "context_size": 4096, "temperature": LLM_SUMMARY_TEMPERATURE, "keep_alive": -1},
+    "answer":   {"model": LLM_CHAT_MODEL_NAME, "fallback": LLM_SUMMARY_MODEL_NAME,
+                 "context_size": MAX_CONTENT_SIZE, "temperature": LLM_CHAT_TEMPERATURE, "keep_alive": -1},
+    "simple":   {"model": LLM_CHAT_MODEL_NAME, "fallback": None,
+                 "context_size": 4096, "temperature": LLM_CHAT_TEMPERATURE, "keep_alive": -1},
+}
+LLM_FALLBACK_WAIT_MS: int = 4000                        # Expected wait on the primary to use the fallback.
+
+
+# Admission control of the generations (`/rag`, `/simple`, `/simple/stream`):
+#   - At most `ADMISSION_MAX_CONCURRENT` generations run at once, the others wait in per session queues,
+#     served round-robin over the sessions, while the stream reports their `queued` position.
+#   - Requests beyond the queue budget (total / per session) are rejected at once with 429 + Retry-After.
+ADMISSION_MAX_CONCURRENT: int = 4                       # Max generations at once (~ OLLAMA_NUM_PARALLEL).
+ADMISSION_MAX_QUEUE: int = 32                           # Max waiting requests of all sessions.
+ADMISSION_MAX_QUEUE_PER_SESSION: int = 2                # Max waiting requests of one session.
+ADMISSION_MAX_RETRY_SEC: int = 30                       # Max Retry-After suggested to rejected clients.
+
 
 # Verification configuration:
 #   - Whether to immediately verify the connection to
@@ -38,14 +81,161 @@ DOC_CHAR_LIMIT: int = 2000                              # Char limit for each do
 DOC_OVERLAP_NO: int = 250                               # Char limit for chunk overlap.
 
 
+# Bulk ingestion:
+INGEST_WORKERS: int = 4                                 # Parallel workers for archive members.
+
+
+# Scheduling between interactive chats and bulk ingestion (same Ollama backend):
+#   - Query embeddings and generations always run immediately.
+#   - Ingestion embeddings run in batches, only when no chat is active for the grace period.
+SCHED_BULK_CONCURRENCY: int = 1                         # Max ingestion batches at once.
+SCHED_IDLE_GRACE_SEC: float = 0.5                       # Idle time needed before a batch.
+EMB_BULK_BATCH_SIZE: int = 16                           # Num of chunks per ingestion batch.
+
+
+# Executors of the blocking work of the endpoints (`server/pools.py`):
+#   - `db`: sqlite calls and small file system operations, threads.
+#   - `cpu`: bcrypt hashing / checks and PDF previews, spawned processes (threads if disabled).
+#   - `index`: Ingestion, archive extraction and FAISS deletes / saves, threads.
+#   - Calls beyond workers + queue are rejected (503), instead of piling up behind a stuck pool.
+POOL_DB_WORKERS: int = 4                                # Threads for sqlite / file system calls.
+POOL_CPU_WORKERS: int = 2                               # Workers for bcrypt / PDF previews.
+POOL_CPU_PROCESSES: bool = True                         # Run the `cpu` pool in processes.
+POOL_INDEX_WORKERS: int = 2                             # Threads for ingestion / index writes.
+POOL_MAX_QUEUE: int = 64                                # Calls waiting per pool, before rejecting.
+
+
+# Parsed-text cache:
+#   - `load_file` stores the extracted per-page text + metadata of each file here.
+#   - Entries are keyed by file hash + loader version, so re-chunking never re-parses.
+PARSE_CACHE_DIR: str = "parse_cache"                    # Path to store the parsed pages.
+PARSE_CACHE_MAX_BYTES: int = 256 * 1024 * 1024          # Max size of cache on disk (256 MB).
+LOADER_VERSION: str = "1"                               # Bump when loader output changes.
+
+
 # Document Retrieval properties:
 DOC_TOKEN_SIZE: int = DOC_CHAR_LIMIT // 4               # Appx number of tokens in each doc.
 DOCS_NUM_COUNT: int = 3000 // DOC_TOKEN_SIZE            # Max num of docs to retrieve.
 
 
+# Merging of the retrieved chunks, before packing:
+#   - Contiguous chunks of the same page (by `start_index`) are stitched, their overlap is sent once.
+#   - Chunks ingested without `start_index` are left as they are (re-ingest the files to merge them).
+MERGE_ADJACENT_CHUNKS: bool = True                      # Enable the merging stage.
+
+
+# Context packing (within MAX_CONTENT_SIZE):
+#   - Tokens are approximated as 4 chars each, same as `DOC_TOKEN_SIZE`.
+#   - System prompt + input are always kept, history is trimmed oldest first,
+#     and the docs (best first) fill the rest. The last doc that fits partially is truncated.
+ANSWER_TOKEN_RESERVE: int = 1024                        # Tokens left free for the answer.
+HISTORY_TOKEN_SHARE: float = 0.4                        # Max share of the free tokens for history.
+MIN_DOC_TOKENS: int = 100                               # Min tokens of a doc worth truncating.
+
+
+# Prompt layout of the chat template:
+#   - `cache_friendly`: Fixed system prompt > history > [context + input], with the docs in a stable order,
+#     so that each prompt starts with the previous one and the backend can reuse its prefix (KV) cache.
+#   - `legacy`: Context inside the system prompt, ahead of the history (invalidates the prefix each turn).
+PROMPT_LAYOUT: str = "cache_friendly"                   # `cache_friendly` or `legacy`.
+PREFIX_TRACK_SESSIONS: int = 1024                       # Sessions whose last prompt is kept for reuse stats.
+
+
+# Executor of the RAG chain stages:
+#   - `runnable`: LangChain runnable stack (`RunnableWithMessageHistory` around the composed stages).
+#   - `native`: Same stages and streamed events in plain async code, less overhead per token / request.
+RAG_EXECUTOR: str = "runnable"                          # `runnable` or `native`.
+
+
+# Sentence level compression of the packed docs, before generation:
+#   - Sentences are scored against the standalone question embedding, best ones (+ neighbours) are kept.
+#   - The LLM gets the compressed text, the client still gets the original chunks as `context`.
+CONTEXT_COMPRESSION: bool = True                        # Enable the compression stage.
+COMPRESS_TOKEN_BUDGET: int = 1500                       # Max tokens of all compressed docs together.
+COMPRESS_NEIGHBOURS: int = 1                            # Sentences kept around each selected one.
+COMPRESS_MIN_SENTENCE_CHARS: int = 40                   # Shorter pieces are merged with the next one.
+COMPRESS_CACHE_SIZE: int = 8192                         # Cached sentence vectors (LRU).
+
+
+# Chat memory given to the chains:
+#   - `full`: The complete history of the session, prompt grows every turn.
+#   - `summary`: Last `HISTORY_KEEP_TURNS` turns verbatim + a running summary of the older ones,
+#     updated in the background once `HISTORY_FOLD_TURNS` more turns piled up (`/chat_history` stays complete).
+HISTORY_MEMORY_MODE: str = "summary"                    # `full` or `summary`.
+HISTORY_KEEP_TURNS: int = 4                             # Turns (human + AI message) kept verbatim.
+HISTORY_FOLD_TURNS: int = 2                             # Extra turns folded into the summary at once.
+
+
+# Intent routing, before retrieval:
+#   - Chit-chat ("thanks!", "hi") and requests to rework the previous answer ("rewrite that shorter")
+#     skip the retrieval (and summarization), and are answered from the chat history only.
+#   - Cheap rules first, then optionally the similarity with embedded prototype phrases.
+INTENT_ROUTING: bool = True                             # Enable the intent router.
+INTENT_EMB_CHECK: bool = False                          # Enable the prototype similarity check.
+INTENT_EMB_MIN_SIM: float = 0.8                         # Min similarity with a prototype phrase.
+INTENT_MAX_WORDS: int = 12                              # Longer inputs are always retrieved for.
+
+
+# Standalone question detection:
+#   - Skips the history summarization LLM call, if the user input is already a standalone question.
+#   - Questions with referring words (it, that, ...) can optionally be checked against recent turns
+#     with embeddings. If dissimilar to all of them (new topic), summarization is skipped too.
+STANDALONE_MIN_WORDS: int = 5                           # Shorter inputs are always summarized.
+STANDALONE_EMB_CHECK: bool = False                      # Enable the embedding similarity check.
+STANDALONE_EMB_MAX_SIM: float = 0.5                     # Max similarity to count as new topic.
+STANDALONE_RECENT_TURNS: int = 2                        # Num of recent user turns to compare.
+
+
+# Speculative retrieval:
+#   - While the question is being summarized with history, docs are already retrieved for the raw input.
+#   - If the standalone question is about the same as the raw input, the speculative docs are used as is.
+#   - Else docs are retrieved again, and merged with the speculative ones if both sets differ materially.
+SPECULATIVE_RETRIEVAL: bool = True                      # Enable the speculative retrieval.
+SPECULATIVE_QUERY_SIM: float = 0.7                      # Min word overlap to reuse the docs as is.
+SPECULATIVE_MIN_OVERLAP: float = 0.6                    # Min docs overlap to keep speculative set.
+SPECULATIVE_MERGE_WEIGHT: float = 0.5                   # Weight of speculative docs when merging.
+
+
+# Reranking of the retrieved docs:
+#   - `RERANK_CANDIDATE_MULT` times more docs are retrieved, scored in one batch and cut back to `k`.
+#   - Scorer `lexical` needs no model, `cross-encoder:<model>` needs `sentence_transformers`.
+#   - If scoring exceeds the time budget, the first stage (vector search) order is used.
+RERANK_ENABLED: bool = True                             # Enable the reranking stage.
+RERANK_SCORER: str = "lexical"                          # `lexical` or `cross-encoder:<model>`.
+RERANK_CANDIDATE_MULT: int = 3                          # Candidates fetched per final doc.
+RERANK_TIME_BUDGET_MS: int = 200                        # Max scoring time before falling back.
+RERANK_PRIOR_WEIGHT: float = 0.3                        # Weight of first stage rank (lexical).
+
+
+# Search type of the retriever, passed in `search_kwargs`: `similarity`, `mmr` or `hybrid`.
+#   - `hybrid` runs the BM25 index and the vector search in parallel, and fuses them by RRF.
+#   - `mmr` diversifies the top `MMR_FETCH_K` vector search results, e.g. the overlapping chunks of a page.
+#   - Can be overridden per `/rag` request with `search_type`.
+RETRIEVER_SEARCH_TYPE: str = "hybrid"
+MMR_FETCH_K: int = 20                                   # Candidates MMR selects from.
+MMR_LAMBDA: float = 0.5                                 # 1 = pure relevance, 0 = pure diversity.
+HYBRID_DENSE_WEIGHT: float = 1.0                        # RRF weight of the vector search.
+HYBRID_LEXICAL_WEIGHT: float = 1.0                      # RRF weight of the BM25 search.
+BM25_K1: float = 1.2                                    # BM25 term frequency saturation.
+BM25_B: float = 0.75                                    # BM25 length normalization.
+RETRIEVAL_CACHE_SIZE: int = 1024                        # Cached search results (LRU), 0 disables.
+
+
+# Semantic answer cache:
+#   - Answers are cached by the standalone question embedding + version of the docs the user can see.
+#   - Only for turns without chat history, in buckets per user scope of the request.
+#   - A similar enough question over unchanged docs replays the stored answer and context.
+ANSWER_CACHE_ENABLED: bool = True                       # Enable the answer cache.
+ANSWER_CACHE_MIN_SIM: float = 0.95                      # Min cosine similarity for a hit.
+ANSWER_CACHE_MAX_ENTRIES: int = 512                     # Max cached answers (LRU).
+ANSWER_CACHE_TTL_SEC: int = 24 * 60 * 60                # Max age of a cached answer.
+
+
 # Database:
 VECTOR_DB_PERSIST_DIR: str = "user_faiss"            # Path to persist the vector DB.
 VECTOR_DB_INDEX_NAME: str = "index.faiss"               # Name of the vector DB file.
+FILE_RECORDS_NAME: str = "file_records.json"            # File level metadata of the chunks.
+LEXICAL_INDEX_DIR: str = "lexical"                      # BM25 postings, inside the DB folder.
 
 # Dummy response mode properties:
 TOKENS_PER_SEC: int = 50                                # num of tokens yielded per sec
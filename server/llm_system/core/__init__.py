@@ -3,4 +3,5 @@ Contains following components:
 - Database: Manages the vector database for storing and retrieving documents.
 - Chat History: Manages the chat history for conversational context.
 - Ingestion: Handles the ingestion of new documents into the vector database.
+- Scheduler: Prioritizes interactive chats over bulk ingestion on the shared backend.
 """
\ No newline at end of file
@@ -0,0 +1,281 @@
+"""Admission Control Module for LLM System
+- Contains the `AdmissionController` class, which caps the generations running at once on the chat models.
+    + At most `max_concurrent` generations run, the others wait in per session queues.
+    + Free slots go round-robin over the sessions with waiting requests, so one user's burst
+      (many tabs / retries) can't starve the other users.
+    + Requests beyond the queue budget (total or per session) are rejected at once, with a retry delay.
+    + The budget check and the queueing are one step (`enqueue`), so concurrent requests can't both pass it.
+- Contains the `Ticket` class, the handle of one request: its queue position, admission and release.
+"""
+
+import math
+import asyncio
+from threading import RLock
+from time import monotonic
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Deque, Dict, Optional
+
+from llm_system.config import (
+    ADMISSION_MAX_CONCURRENT, ADMISSION_MAX_QUEUE, ADMISSION_MAX_QUEUE_PER_SESSION, ADMISSION_MAX_RETRY_SEC
+)
+
+from logger import get_logger
+log = get_logger(name="core_admission")
+
+# Weight of the latest generation in the avg hold time (EWMA), for the retry delay:
+HOLD_EWMA_ALPHA: float = 0.2
+
+
+class AdmissionRejected(Exception):
+    """Raised when the queue budget is exceeded, the client should retry after `retry_after` secs."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Server busy ({reason}), retry in {retry_after}s.")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """One request's place in the admission queue, see `AdmissionController.enqueue()`.
+
+    ## Functions:
+        + `wait()`: Async iterator of the queue positions (1 = next), ends once admitted.
+        + `release()`: Frees the slot (or leaves the queue), safe to call more than once.
+    """
+
+    def __init__(self, controller: "AdmissionController", session_id: str):
+        self.controller = controller
+        self.session_id = session_id
+        self.admitted = False
+        self.released = False
+        self.enqueued_at = monotonic()
+        self.admitted_at: Optional[float] = None
+        self._moved = asyncio.Event()
+
+    async def wait(self) -> AsyncIterator[int]:
+        """Yields the queue position whenever it changes, until admitted (nothing if admitted at once)."""
+        last = None
+        while not self.admitted:
+            position = self.controller.position(self)
+            if position != last:
+                last = position
+                yield position
+            self._moved.clear()
+            await self._moved.wait()
+
+    def release(self):
+        """Frees the slot if admitted, else leaves the queue (client gone)."""
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+
+class AdmissionController:
+    """Caps the concurrent generations, with fair round-robin queues per session.
+
+    Args:
+        max_concurrent (int): Max generations running at once.
+        max_queue (int): Max requests waiting in all queues together.
+        max_queue_per_session (int): Max requests waiting per session.
+        max_retry (int): Max retry delay suggested to rejected clients (secs).
+
+    ## Functions:
+        + `enqueue(session_id)`: Returns the `Ticket` of a new request, admitted at once if a slot is free.
+            Raises `AdmissionRejected` if it would exceed the queue budget.
+        + `position(ticket)`: Returns the num of requests admitted before the ticket (incl. itself).
+        + `get_stats()`: Returns active / queued requests, admissions, rejections and wait times.
+    """
+
+    def __init__(self, max_concurrent: int = ADMISSION_MAX_CONCURRENT, max_queue: int = ADMISSION_MAX_QUEUE,
+                 max_queue_per_session: int = ADMISSION_MAX_QUEUE_PER_SESSION,
+                 max_retry: int = ADMISSION_MAX_RETRY_SEC):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max_queue
+        self.max_queue_per_session = max_queue_per_session
+        self.max_retry = max_retry
+
+        self._lock = RLock()
+        # Sessions in round-robin order, each with its waiting tickets in arrival order:
+        self._queues: "OrderedDict[str, Deque[Ticket]]" = OrderedDict()
+        self._waiting = 0
+        self._active = 0
+        self._hold_avg = 0.0
+        self._stats = {"admitted": 0, "queued": 0, "rejected": 0, "abandoned": 0,
+                       "wait_total": 0.0, "wait_max": 0.0}
+        log.info(
+            f"Initialized AdmissionController(max_concurrent={max_concurrent}, max_queue={max_queue}, "
+            f"max_queue_per_session={max_queue_per_session})."
+        )
+
+    def _retry_after(self) -> int:
+        """Secs until the queue ahead of a new request is likely drained."""
+        rounds = (self._waiting + 1) / self.max_concurrent
+        return min(max(1, math.ceil(rounds * (self._hold_avg or 1.0))), self.max_retry)
+
+    def _check(self, session_id: str):
+        """Raises `AdmissionRejected` if the total or the session's queue is full (call under `_lock`)."""
+        if self._active < self.max_concurrent and not self._waiting:
+            return
+        reason = None
+        if self._waiting >= self.max_queue:
+            reason = "queue full"
+        elif len(self._queues.get(session_id, ())) >= self.max_queue_per_session:
+            reason = "too many requests of this session"
+        if reason is not None:
+            self._stats["rejected"] += 1
+            retry_after = self._retry_after()
+            log.warning(f"Rejected request of '{session_id}': {reason}, retry after {retry_after}s.")
+            raise AdmissionRejected(reason, retry_after)
+
+    def enqueue(self, session_id: str) -> Ticket:
+        """Queue a new request of the session, it is admitted at once if a slot is free and nobody waits.
+        - Call it before any response is started, so that a rejection can still be sent as is.
+        - The caller must `release()` the ticket in all cases (done, failed, cancelled).
+
+        Raises:
+            AdmissionRejected: If the total or the session's queue is full.
+        """
+        with self._lock:
+            self._check(session_id)
+            ticket = Ticket(self, session_id)
+            if self._active < self.max_concurrent and not self._waiting:
+                self._admit(ticket)
+                return ticket
+
+            self._queues.setdefault(session_id, deque()).append(ticket)
+            self._waiting += 1
+            self._stats["queued"] += 1
+            # A new session goes ahead of the later turns of the others:
+            self._notify()
+            position = self.position(ticket)
+        log.info(f"Queued request of '{session_id}' at position {position}.")
+        return ticket
+
+    def position(self, ticket: Ticket) -> int:
+        """Num of requests to be admitted before the ticket, plus one (0 if already admitted)."""
+        with self._lock:
+            queue = self._queues.get(ticket.session_id)
+            if ticket.admitted or queue is None or ticket not in queue:
+                return 0
+
+            # Round-robin: every session ahead in the rotation gets one more turn than the ones behind:
+            index, ahead, before = queue.index(ticket), 0, True
+            for session_id, waiting in self._queues.items():
+                if session_id == ticket.session_id:
+                    before = False
+                    continue
+                ahead += min(len(waiting), index + 1 if before else index)
+            return ahead + index + 1
+
+    def _notify(self):
+        """Wake up the waiting tickets, to report their new positions."""
+        for queue in self._queues.values():
+            for waiting in queue:
+                waiting._moved.set()
+
+    def _admit(self, ticket: Ticket):
+        ticket.admitted, ticket.admitted_at = True, monotonic()
+        waited = ticket.admitted_at - ticket.enqueued_at
+        self._active += 1
+        self._stats["admitted"] += 1
+        self._stats["wait_total"] += waited
+        self._stats["wait_max"] = max(self._stats["wait_max"], waited)
+        ticket._moved.set()
+
+    def _dispatch(self):
+        """Admit waiting tickets round-robin over the sessions, while slots are free."""
+        moved = False
+        while self._active < self.max_concurrent and self._queues:
+            session_id, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            # Session goes to the back of the rotation, or leaves it:
+            del self._queues[session_id]
+            if queue:
+                self._queues[session_id] = queue
+            self._waiting -= 1
+            self._admit(ticket)
+            moved = True
+        if moved:
+            self._notify()
+
+    def _release(self, ticket: Ticket):
+        with self._lock:
+            self._release_locked(ticket)
+
+    def _release_locked(self, ticket: Ticket):
+        if ticket.admitted:
+            hold = monotonic() - ticket.admitted_at  # type: ignore[operator]
+            self._hold_avg = hold if not self._hold_avg else \
+                (1 - HOLD_EWMA_ALPHA) * self._hold_avg + HOLD_EWMA_ALPHA * hold
+            self._active -= 1
+            self._dispatch()
+            return
+
+        # Left the queue before admission (client gone):
+        queue = self._queues.get(ticket.session_id)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.session_id]
+            self._waiting -= 1
+            self._stats["abandoned"] += 1
+            self._notify()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns `active`, `queue_depth`, queued `sessions`, admitted / queued / rejected / abandoned requests,
+        the avg / max queue wait and the avg generation time."""
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self) -> Dict[str, Any]:
+        admitted = self._stats["admitted"]
+        return {
+            "max_concurrent": self.max_concurrent,
+            "active": self._active,
+            "queue_depth": self._waiting,
+            "sessions": len(self._queues),
+            "admitted": admitted,
+            "queued": self._stats["queued"],
+            "rejected": self._stats["rejected"],
+            "abandoned": self._stats["abandoned"],
+            "wait_avg_ms": round(1000 * self._stats["wait_total"] / max(admitted, 1), 2),
+            "wait_max_ms": round(1000 * self._stats["wait_max"], 2),
+            "hold_avg_ms": round(1000 * self._hold_avg, 2),
+        }
+
+
+if __name__ == "__main__":
+
+    async def _check():
+        controller = AdmissionController(max_concurrent=1, max_queue=5, max_queue_per_session=3)
+        running = controller.enqueue("a")
+        assert running.admitted, "Not admitted with a free slot"
+
+        # User `a` opens 3 more tabs, then `b` and `c` send one request each:
+        tickets = [controller.enqueue(s) for s in ("a", "a", "a", "b", "c")]
+        assert [controller.position(t) for t in tickets] == [1, 4, 5, 2, 3], "Not round-robin"
+        try:
+            controller.enqueue("a")
+            raise AssertionError("Per session budget not enforced")
+        except AdmissionRejected as e:
+            assert e.retry_after >= 1
+        assert controller.get_stats()["queue_depth"] == 5, "Rejected request was queued"
+
+        order = []
+        for _ in tickets:
+            running.release()
+            running = next(t for t in tickets if t.admitted and not t.released)
+            order.append(running.session_id)
+        assert order == ["a", "b", "c", "a", "a"], f"Admission order {order}"
+
+        # Leaving the queue frees the place, releasing twice is a no-op:
+        waiting = controller.enqueue("d")
+        positions = controller.position(waiting)
+        waiting.release()
+        waiting.release()
+        running.release()
+        assert positions == 1 and controller.get_stats()["active"] == 0, controller.get_stats()
+        print(controller.get_stats())
+
+    asyncio.run(_check())
+    print("All admission checks passed.")
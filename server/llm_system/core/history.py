@@ -1,21 +1,98 @@
+""" Chat history of the sessions.
+- `full` memory: The chains get the complete history of the session.
+- `summary` memory: The chains get a running summary of the older turns + the last turns verbatim.
+    - Older turns are folded into the summary in a background thread, after the turn is saved,
+      so the summarization never adds to the response latency.
+    - Turns are folded in batches, so the prompt prefix (and the backend's KV cache) stays stable in between.
+    - The complete messages are always kept, for `/chat_history`.
+"""
+
+from threading import Lock
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Set
+
 from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import Runnable
 from langchain_community.chat_message_histories import ChatMessageHistory
 
+from llm_system.chains.prompts import template_memory
+from llm_system.config import HISTORY_MEMORY_MODE, HISTORY_KEEP_TURNS, HISTORY_FOLD_TURNS
+
 from logger import get_logger
 log = get_logger(name="core_history")
 
+SUMMARY_PREFIX: str = "Summary of the earlier conversation:\n"
+
+
+class SessionHistory(ChatMessageHistory):
+    """All messages of a session, and the running summary of the first `summarized` of them."""
+    summary: str = ""
+    summarized: int = 0
+
+
+class _PromptHistory(BaseChatMessageHistory):
+    """View of a session given to the chains: summary message + messages not folded into it yet."""
+
+    def __init__(self, store: "HistoryStore", session_id: str, session: SessionHistory):
+        self.store = store
+        self.session_id = session_id
+        self.session = session
+
+    @property
+    def messages(self) -> List[BaseMessage]:  # type: ignore[override]
+        recent = self.session.messages[self.session.summarized:]
+        if not self.session.summary:
+            return list(recent)
+        return [SystemMessage(content=SUMMARY_PREFIX + self.session.summary), *recent]
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self.session.add_messages(messages)
+        self.store.schedule_fold(self.session_id, self.session)
+
+    def clear(self) -> None:
+        self.session.clear()
+        self.session.summary, self.session.summarized = "", 0
+
 
 class HistoryStore:
     """A class to manage chat message histories for different sessions/users.
 
+    Args:
+        llm (Runnable, optional): LLM (or `ModelRouter` stage) which writes the running summaries (`summary` mode only).
+        mode (str): `full` or `summary` memory, see module docs. `summary` needs the `llm`.
+        keep_turns (int): Turns (human + AI message) always given verbatim.
+        fold_turns (int): Turns beyond `keep_turns` to wait for, before folding them into the summary.
+
     ## Functions:
-        + `get_session_history(session_id: str)`: Retrieves the chat history for a given session ID.
+        + `get_session_history(session_id: str)`: Retrieves the complete chat history for a given session ID.
             If no history exists, it creates a new one and returns empty initialized history.
+        + `get_prompt_history(session_id: str)`: Retrieves the history as given to the chains
+            (summary + recent turns in `summary` mode), new turns added to it are saved to the session.
+        + `schedule_fold(session_id, session)`: Folds old turns of the session in the background, if due.
+        + `get_stats()`: Returns the num of folds and their avg time.
     """
 
-    def __init__(self):
-        self.histories = {}
-        log.info("Initialized HistoryStore with an empty history dictionary.")
+    def __init__(self, llm: Optional[Runnable] = None, mode: str = HISTORY_MEMORY_MODE,
+                 keep_turns: int = HISTORY_KEEP_TURNS, fold_turns: int = HISTORY_FOLD_TURNS):
+        if mode == "summary" and llm is None:
+            log.warning("No LLM given for the summary memory, using full history.")
+            mode = "full"
+
+        self.histories: Dict[str, SessionHistory] = {}
+        self.mode = mode
+        self.keep_turns = keep_turns
+        self.fold_turns = fold_turns
+        self.summary_chain = (template_memory | llm | StrOutputParser()) if llm is not None else None
+
+        # One fold at a time, the backend is shared with the chats anyway:
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history_fold")
+        self._lock = Lock()
+        self._folding: Set[str] = set()
+        self._stats = {"folds": 0, "failed": 0, "folded_messages": 0, "seconds": 0.0}
+        log.info(f"Initialized HistoryStore with '{mode}' memory and an empty history dictionary.")
 
     def get_session_history(self, session_id: str) -> BaseChatMessageHistory:
         """Retrieves the chat history for a given session ID.
@@ -28,12 +105,72 @@ class HistoryStore:
         """
 
         if session_id not in self.histories:
-            self.histories[session_id] = ChatMessageHistory()
+            self.histories[session_id] = SessionHistory()
             log.info(f"Created history for session: `{session_id}`")
 
         log.info(f"Retrieved history for session: `{session_id}`")
         return self.histories[session_id]
 
+    def get_prompt_history(self, session_id: str) -> BaseChatMessageHistory:
+        """Retrieves the chat history of the session as the chains should see it.
+
+        Args:
+            session_id (str): The unique identifier for the chat session.
+        Returns:
+            BaseChatMessageHistory: The full history (`full` mode), or the summary + recent turns view.
+        """
+
+        session = self.get_session_history(session_id)
+        if self.mode != "summary":
+            return session
+        return _PromptHistory(self, session_id, session)  # type: ignore[arg-type]
+
+    def schedule_fold(self, session_id: str, session: SessionHistory):
+        """Submit the folding of the session's old turns, if enough of them piled up and no fold is running."""
+
+        pending = len(session.messages) - session.summarized
+        if pending <= 2 * (self.keep_turns + self.fold_turns):
+            return
+        with self._lock:
+            if session_id in self._folding:
+                return
+            self._folding.add(session_id)
+        self._executor.submit(self._fold, session_id, session)
+
+    def _fold(self, session_id: str, session: SessionHistory):
+        start = perf_counter()
+        try:
+            begin, end = session.summarized, len(session.messages) - 2 * self.keep_turns
+            new_lines = "\n".join(f"{m.type.upper()}: {m.text()}" for m in session.messages[begin:end])
+            summary = self.summary_chain.invoke(  # type: ignore[union-attr]
+                {"summary": session.summary or "(empty)", "new_lines": new_lines})
+
+            session.summary, session.summarized = summary.strip(), end
+            seconds = perf_counter() - start
+            with self._lock:
+                self._stats["folds"] += 1
+                self._stats["folded_messages"] += end - begin
+                self._stats["seconds"] += seconds
+            log.info(f"Folded {end - begin} messages of session `{session_id}` into summary in {seconds:.2f}s.")
+
+        except Exception as e:
+            # Nothing lost, the turns stay verbatim and are folded with the next turn:
+            with self._lock:
+                self._stats["failed"] += 1
+            log.error(f"Failed to fold the history of session `{session_id}`: {e}")
+
+        finally:
+            with self._lock:
+                self._folding.discard(session_id)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns the memory mode, num of sessions, folds (ok / failed), folded messages and avg fold time."""
+        with self._lock:
+            stats = dict(self._stats)
+        folds, seconds = stats["folds"], stats.pop("seconds")
+        stats["avg_fold_ms"] = round(1000 * seconds / folds, 2) if folds else 0.0
+        return {"mode": self.mode, "sessions": len(self.histories), **stats}
+
     def clear_session_history(self, session_id: str):
         """Clears the chat history for a given session ID.
 
@@ -1,19 +1,28 @@
 """ A script which will deal with ingestion of new documents into the vector database.
 - Currently has file ingestion which supports txt, pdf, and md files.
+- Multiple files (like members of an uploaded archive) can be ingested in parallel.
 - Plan to add more file types in the future.
 - Plan to add web based ingestion in the future.
 """
 
-from typing import List
+import os
+from time import perf_counter
+from typing import Any, Dict, Generator, List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from langchain_core.documents import Document
 
 from llm_system.utils.loader import load_file
 from llm_system.utils.splitter import split_text
+from llm_system.utils.metadata import normalize_metadata
+from llm_system.config import INGEST_WORKERS
 
 # For type hinting
 from llm_system.core.database import VectorDB
 from langchain_core.embeddings import Embeddings
 
 
+from metrics import INGEST_SECONDS, INGEST_FILES, INGEST_CHUNKS
 from logger import get_logger
 log = get_logger(name="core_ingestion")
 
@@ -34,6 +43,59 @@ def ingest_file(user_id: str, file_path: str, vectorstore: VectorDB,
             - str: Message indicating the result of the ingestion.
     """
 
+    start = perf_counter()
+    status, split_docs, message = prepare_file(user_id, file_path)
+    INGEST_SECONDS.observe(perf_counter() - start, step="prepare")
+    if not status or not split_docs:
+        INGEST_FILES.inc(status="ok" if status else "failed")
+        return status, [], message
+
+    # Add the split documents to the vector database:
+    try:
+        _register_file_record(vectorstore, split_docs, file_path)
+
+        # Embedding is the slow part, do it outside the lock:
+        texts = [doc.page_content for doc in split_docs]
+        with INGEST_SECONDS.time(step="embed"):
+            vectors = embeddings.embed_documents(texts)
+
+        with vectorstore.write_lock:
+            doc_ids = vectorstore.db.add_embeddings(
+                text_embeddings=list(zip(texts, vectors)),
+                metadatas=[doc.metadata for doc in split_docs],
+            )
+            vectorstore.index_chunks(user_id, doc_ids, texts)
+        if vectorstore.save_db_to_disk():
+            log.info(f"Ingested {len(split_docs)} documents from {file_path} into the vector database.")
+            INGEST_FILES.inc(status="ok")
+            INGEST_CHUNKS.inc(len(doc_ids))
+            INGEST_SECONDS.observe(perf_counter() - start, step="total")
+            return True, doc_ids, f"Ingested {len(split_docs)} documents successfully."
+        else:
+            log.error("Failed to save the vector database to disk after ingestion.")
+            INGEST_FILES.inc(status="failed")
+            return False, [], "Failed to save the vector database to disk after ingestion."
+            
+    except Exception as e:
+        log.error(f"Failed to ingest documents: {e}")
+        INGEST_FILES.inc(status="failed")
+        return False, [], f"Failed to ingest documents: {e}"
+
+
+def prepare_file(user_id: str, file_path: str) -> tuple[bool, List[Document], str]:
+    """Load a file and split it into chunks ready to be embedded.
+
+    Args:
+        user_id (str): The ID of the user who owns the file.
+        file_path (str): The absolute path to the file to be prepared.
+
+    Returns:
+        tuple[bool, List[Document], str]: A tuple containing:
+            - bool: True if the file was loaded and split successfully, False otherwise.
+            - List[Document]: List of chunks (empty if the file has no content).
+            - str: Message indicating the result.
+    """
+
     # Load the file and get its content as Document objects:
     status, documents, message = load_file(user_id, file_path)
     # print(status, documents, message)
@@ -50,19 +112,127 @@ def ingest_file(user_id: str, file_path: str, vectorstore: VectorDB,
     if not status:
         return False, [], message
 
-    # Add the split documents to the vector database:
-    try:
-        doc_ids = vectorstore.db.add_documents(split_docs, embeddings=embeddings)
-        if vectorstore.save_db_to_disk():
-            log.info(f"Ingested {len(split_docs)} documents from {file_path} into the vector database.")
-            return True, doc_ids, f"Ingested {len(split_docs)} documents successfully."
-        else:
-            log.error("Failed to save the vector database to disk after ingestion.")
-            return False, [], "Failed to save the vector database to disk after ingestion."
-            
-    except Exception as e:
-        log.error(f"Failed to ingest documents: {e}")
-        return False, [], f"Failed to ingest documents: {e}"
+    return True, split_docs, message
+
+
+def _register_file_record(vectorstore: VectorDB, split_docs: List[Document], file_path: str):
+    """Move the file level metadata of the chunks into one file record stored in the vector DB."""
+
+    file_ref, record, sizes = normalize_metadata(split_docs)
+    if file_ref:
+        vectorstore.add_file_record(file_ref, record)
+
+    saved = sizes["before"] - sizes["after"]
+    log.info(
+        f"Normalized metadata of {len(split_docs)} chunks from {os.path.basename(file_path)}: "
+        f"{sizes['before']} -> {sizes['after']} bytes ({saved} bytes saved)."
+    )
+
+
+def ingest_files(user_id: str, file_paths: List[str], vectorstore: VectorDB, embeddings: Embeddings,
+                 max_workers: int = INGEST_WORKERS) -> Generator[Dict[str, Any], None, None]:
+    """Ingest multiple files in parallel, yielding progress as each file completes.
+    - Loading, splitting and embedding of the files run in a worker pool.
+    - Only the insert into the FAISS / lexical index is serialized (under `vectorstore.write_lock`).
+    - The vector database is saved to disk once, after all the files are done.
+
+    Args:
+        user_id (str): The ID of the user who owns the files.
+        file_paths (List[str]): The absolute paths to the files to be ingested.
+        vectorstore (VectorDB): The vector database instance.
+        embeddings (Embeddings): The embeddings model to use for the documents.
+        max_workers (int): Number of files processed concurrently.
+
+    Yields:
+        Dict[str, Any]: One `{"event": "file", ...}` dict per file in completion order with keys
+        `file, status, doc_ids, chunks, seconds, embed_seconds, message, done, total`, followed by one final
+        `{"event": "summary", ...}` dict with the throughput metrics and the save status.
+    """
+
+    start = perf_counter()
+    total = len(file_paths)
+    total_bytes = sum(os.path.getsize(path) for path in file_paths if os.path.isfile(path))
+    stats = {"ok": 0, "failed": 0, "chunks": 0, "embed_seconds": 0.0}
+
+    def _worker(file_path: str) -> Dict[str, Any]:
+        file_start = perf_counter()
+        doc_ids: List[str] = []
+        embed_seconds = 0.0
+
+        try:
+            status, split_docs, message = prepare_file(user_id, file_path)
+            INGEST_SECONDS.observe(perf_counter() - file_start, step="prepare")
+
+            if status and split_docs:
+                _register_file_record(vectorstore, split_docs, file_path)
+
+                # Embedding is the slow part, do it outside the lock:
+                embed_start = perf_counter()
+                texts = [doc.page_content for doc in split_docs]
+                vectors = embeddings.embed_documents(texts)
+                embed_seconds = perf_counter() - embed_start
+                INGEST_SECONDS.observe(embed_seconds, step="embed")
+
+                with vectorstore.write_lock:
+                    doc_ids = vectorstore.db.add_embeddings(
+                        text_embeddings=list(zip(texts, vectors)),
+                        metadatas=[doc.metadata for doc in split_docs],
+                    )
+                    vectorstore.index_chunks(user_id, doc_ids, texts)
+                message = f"Ingested {len(split_docs)} documents successfully."
+
+        except Exception as e:
+            log.error(f"Failed to ingest documents of {file_path}: {e}")
+            status, message = False, f"Failed to ingest documents: {e}"
+
+        INGEST_FILES.inc(status="ok" if status else "failed")
+        INGEST_CHUNKS.inc(len(doc_ids))
+        INGEST_SECONDS.observe(perf_counter() - file_start, step="total")
+        return {
+            "file": os.path.basename(file_path),
+            "status": status,
+            "doc_ids": doc_ids,
+            "chunks": len(doc_ids),
+            "seconds": round(perf_counter() - file_start, 3),
+            "embed_seconds": round(embed_seconds, 3),
+            "message": message,
+        }
+
+    log.info(f"Ingesting {total} files for user '{user_id}' with {max_workers} workers.")
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, total or 1)),
+                            thread_name_prefix="ingest") as pool:
+        futures = [pool.submit(_worker, path) for path in file_paths]
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            result = future.result()
+            stats["ok" if result["status"] else "failed"] += 1
+            stats["chunks"] += result["chunks"]
+            stats["embed_seconds"] += result["embed_seconds"]
+            yield {"event": "file", **result, "done": done, "total": total}
+
+    # Persist once for the whole batch:
+    save_start = perf_counter()
+    saved = vectorstore.save_db_to_disk() if stats["chunks"] else True
+    save_seconds = perf_counter() - save_start
+
+    elapsed = max(perf_counter() - start, 1e-9)
+    summary = {
+        "event": "summary",
+        "saved": saved,
+        "files": total,
+        "ok": stats["ok"],
+        "failed": stats["failed"],
+        "chunks": stats["chunks"],
+        "bytes": total_bytes,
+        "seconds": round(elapsed, 3),
+        "embed_seconds": round(stats["embed_seconds"], 3),
+        "save_seconds": round(save_seconds, 3),
+        "files_per_sec": round(total / elapsed, 2),
+        "chunks_per_sec": round(stats["chunks"] / elapsed, 2),
+        "mb_per_sec": round(total_bytes / (1024 * 1024) / elapsed, 3),
+    }
+    log.info(f"Bulk ingestion for user '{user_id}' finished: {summary}")
+    yield summary
 
 
 if __name__ == "__main__":
@@ -0,0 +1,378 @@
+""" Lexical (BM25) index, kept next to the FAISS vector store.
+- Dense retrieval misses exact identifiers, error codes and part numbers, an inverted index does not.
+- One index per user, updated incrementally as chunks are added to / deleted from the vector store.
+- Postings are kept in memory as `array('I')` of (doc_num, term_freq) pairs, and persisted per user
+  as gzipped, delta + varint encoded lists in `<persist_path>/lexical/`.
+
+## For testing:
+- Run this file from `server` folder as:
+- `python -m llm_system.core.lexical`
+"""
+
+import os
+import re
+import gzip
+import json
+import math
+import base64
+import hashlib
+import threading
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from langchain_core.documents import Document
+
+from llm_system.config import BM25_K1, BM25_B
+
+from logger import get_logger
+log = get_logger(name="core_lexical")
+
+INDEX_VERSION: int = 1
+
+# Words joined by `-_./:` are kept as one token (XJ-9000, ERR_404, v1.2), plus their parts:
+_TOKEN_RE = re.compile(r"[^\W_]+(?:[-_./:][^\W_]+)*")
+_SPLIT_RE = re.compile(r"[-_./:]")
+_STOPWORDS = frozenset(
+    "a an the and or but of to in on at by for with from as is are was were be been do does did "
+    "what which who when where why how this that these those it its i me my we our you your "
+    "he she they them their can could should would will not no so if".split()
+)
+
+
+def tokenize(text: str) -> Iterator[str]:
+    """Lower case tokens of the text, without stop words. Compound tokens also yield their parts."""
+    for token in _TOKEN_RE.findall(text.lower()):
+        if token in _STOPWORDS:
+            continue
+        yield token
+        if _SPLIT_RE.search(token):
+            yield from (part for part in _SPLIT_RE.split(token) if part and part not in _STOPWORDS)
+
+
+# ------------------------------------------------------------------------------
+# Compact postings encoding:
+# ------------------------------------------------------------------------------
+
+def _encode_varints(values: Iterable[int]) -> bytes:
+    out = bytearray()
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+
+def _decode_varints(data: bytes) -> array:
+    values, value, shift = array("I"), 0, 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value, shift = 0, 0
+    return values
+
+
+def _encode_postings(postings: array) -> str:
+    """(doc_num, tf) pairs with increasing doc_num > delta encoded doc_nums > varints > base64."""
+    deltas, previous = [], 0
+    for i in range(0, len(postings), 2):
+        deltas.append(postings[i] - previous)
+        deltas.append(postings[i + 1])
+        previous = postings[i]
+    return base64.b64encode(_encode_varints(deltas)).decode("ascii")
+
+
+def _decode_postings(encoded: str) -> array:
+    postings = _decode_varints(base64.b64decode(encoded))
+    previous = 0
+    for i in range(0, len(postings), 2):
+        previous += postings[i]
+        postings[i] = previous
+    return postings
+
+
+class _UserIndex:
+    """Inverted index over the chunks of one user. Deleted chunks are skipped until compaction."""
+
+    def __init__(self):
+        self.doc_ids: List[Optional[str]] = []
+        self.lengths = array("I")
+        self.postings: Dict[str, array] = {}
+        self.live = 0
+        self.live_length = 0
+
+    def add(self, doc_id: str, text: str) -> int:
+        doc_num = len(self.doc_ids)
+        counts = Counter(tokenize(text))
+        self.doc_ids.append(doc_id)
+        self.lengths.append(sum(counts.values()))
+        for term, tf in counts.items():
+            self.postings.setdefault(term, array("I")).extend((doc_num, tf))
+        self.live += 1
+        self.live_length += self.lengths[doc_num]
+        return doc_num
+
+    def delete(self, doc_num: int):
+        if self.doc_ids[doc_num] is not None:
+            self.doc_ids[doc_num] = None
+            self.live -= 1
+            self.live_length -= self.lengths[doc_num]
+
+    def needs_compaction(self) -> bool:
+        return len(self.doc_ids) > 64 and self.live < len(self.doc_ids) // 2
+
+    def compact(self) -> Dict[str, int]:
+        """Drop deleted chunks and renumber. Returns the new doc_num of each doc_id."""
+        remap = {}
+        for old, doc_id in enumerate(self.doc_ids):
+            if doc_id is not None:
+                remap[old] = len(remap)
+
+        postings: Dict[str, array] = {}
+        for term, old_postings in self.postings.items():
+            new = array("I")
+            for i in range(0, len(old_postings), 2):
+                if old_postings[i] in remap:
+                    new.extend((remap[old_postings[i]], old_postings[i + 1]))
+            if new:
+                postings[term] = new
+
+        self.postings = postings
+        self.lengths = array("I", (self.lengths[old] for old in remap))
+        self.doc_ids = [self.doc_ids[old] for old in remap]
+        return {doc_id: num for num, doc_id in enumerate(self.doc_ids)}  # type: ignore[misc]
+
+    def to_json(self, user_id: str) -> Dict:
+        return {
+            "version": INDEX_VERSION,
+            "user_id": user_id,
+            "doc_ids": self.doc_ids,
+            "lengths": base64.b64encode(_encode_varints(self.lengths)).decode("ascii"),
+            "postings": {term: _encode_postings(p) for term, p in self.postings.items()},
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict) -> "_UserIndex":
+        index = cls()
+        index.doc_ids = data["doc_ids"]
+        index.lengths = _decode_varints(base64.b64decode(data["lengths"]))
+        index.postings = {term: _decode_postings(p) for term, p in data["postings"].items()}
+        live = [num for num, doc_id in enumerate(index.doc_ids) if doc_id is not None]
+        index.live = len(live)
+        index.live_length = sum(index.lengths[num] for num in live)
+        return index
+
+
+class LexicalIndex:
+    """Per user BM25 index over the chunks of the vector store.
+
+    Args:
+        persist_dir (str, optional): Folder to persist the postings. If None, kept in memory only.
+        k1 (float): BM25 term frequency saturation.
+        b (float): BM25 length normalization.
+
+    ## Functions:
+        + `add(user_id, doc_ids, texts)` / `delete(doc_ids)`: Incremental updates.
+        + `doc_count(user_id)` / `users()`: Num of chunks of a user / users having chunks.
+        + `search(query, users, k)`: Returns the best `(doc_id, score)` pairs over the given users.
+        + `rebuild(items)`: Builds the index from scratch, from `(doc_id, Document)` pairs.
+        + `load()` / `save()`: Persistence, only changed users are written.
+    """
+
+    def __init__(self, persist_dir: Optional[str] = None, k1: float = BM25_K1, b: float = BM25_B):
+        self.persist_dir = persist_dir
+        self.k1 = k1
+        self.b = b
+
+        self._lock = threading.RLock()
+        self._users: Dict[str, _UserIndex] = {}
+        self._locations: Dict[str, Tuple[str, int]] = {}   # doc_id > (user_id, doc_num)
+        self._dirty: Set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self._locations)
+
+    def add(self, user_id: str, doc_ids: List[str], texts: List[str]):
+        """Index the chunks of one user."""
+        with self._lock:
+            index = self._users.setdefault(user_id, _UserIndex())
+            for doc_id, text in zip(doc_ids, texts):
+                if doc_id in self._locations:
+                    self._delete_one(doc_id)
+                self._locations[doc_id] = (user_id, index.add(doc_id, text))
+            self._dirty.add(user_id)
+
+    def _delete_one(self, doc_id: str):
+        user_id, doc_num = self._locations.pop(doc_id)
+        self._users[user_id].delete(doc_num)
+        self._dirty.add(user_id)
+
+    def delete(self, doc_ids: Iterable[str]) -> Set[str]:
+        """Remove chunks by their vector store ids, unknown ids are skipped. Returns the users affected."""
+        users: Set[str] = set()
+        with self._lock:
+            for doc_id in doc_ids:
+                if doc_id in self._locations:
+                    users.add(self._locations[doc_id][0])
+                    self._delete_one(doc_id)
+
+            for user_id in list(self._dirty):
+                index = self._users.get(user_id)
+                if index is not None and index.needs_compaction():
+                    for doc_id, doc_num in index.compact().items():
+                        self._locations[doc_id] = (user_id, doc_num)
+        return users
+
+    def doc_count(self, user_id: str) -> int:
+        """Num of live chunks of the user."""
+        with self._lock:
+            index = self._users.get(user_id)
+            return index.live if index is not None else 0
+
+    def users(self) -> List[str]:
+        """Users having at least one live chunk."""
+        with self._lock:
+            return [user_id for user_id, index in self._users.items() if index.live]
+
+    def search(self, query: str, users: Optional[Iterable[str]] = None, k: int = 10) -> List[Tuple[str, float]]:
+        """BM25 search over the chunks of the given users (all users if None).
+
+        Args:
+            query (str): The search query.
+            users (Iterable[str], optional): The users whose chunks are searched.
+            k (int): Max number of results.
+
+        Returns:
+            List[Tuple[str, float]]: `(doc_id, score)` pairs, best first.
+        """
+
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+
+        with self._lock:
+            indexes = [self._users[u] for u in (self._users if users is None else users) if u in self._users]
+            n_docs = sum(index.live for index in indexes)
+            if not n_docs:
+                return []
+            avg_length = max(sum(index.live_length for index in indexes) / n_docs, 1.0)
+
+            # Live (doc, tf) hits of each term, over all the users:
+            hits: Dict[str, List[Tuple[_UserIndex, int, int]]] = {}
+            for term in terms:
+                for index in indexes:
+                    postings = index.postings.get(term)
+                    if not postings:
+                        continue
+                    for i in range(0, len(postings), 2):
+                        if index.doc_ids[postings[i]] is not None:
+                            hits.setdefault(term, []).append((index, postings[i], postings[i + 1]))
+
+            scores: Dict[str, float] = {}
+            for term, term_hits in hits.items():
+                idf = math.log(1 + (n_docs - len(term_hits) + 0.5) / (len(term_hits) + 0.5))
+                for index, doc_num, tf in term_hits:
+                    norm = self.k1 * (1 - self.b + self.b * index.lengths[doc_num] / avg_length)
+                    doc_id = index.doc_ids[doc_num]
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)  # type: ignore[index]
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return best[:k]
+
+    def rebuild(self, items: Iterable[Tuple[str, Document]]):
+        """Build the index from scratch, from `(doc_id, Document)` pairs having `user_id` in metadata."""
+        with self._lock:
+            self._users.clear()
+            self._locations.clear()
+            grouped: Dict[str, Tuple[List[str], List[str]]] = {}
+            for doc_id, doc in items:
+                ids, texts = grouped.setdefault(doc.metadata.get("user_id", "public"), ([], []))
+                ids.append(doc_id)
+                texts.append(doc.page_content)
+            for user_id, (ids, texts) in grouped.items():
+                self.add(user_id, ids, texts)
+        log.info(f"Rebuilt lexical index of {len(self._locations)} chunks for {len(self._users)} users.")
+
+    def _user_file(self, user_id: str) -> str:
+        name = hashlib.sha1(user_id.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.persist_dir, f"{name}.idx.gz")  # type: ignore[arg-type]
+
+    def load(self) -> bool:
+        """Load all users from the persist folder. Returns False if there is nothing persisted yet."""
+        if not self.persist_dir or not os.path.isdir(self.persist_dir):
+            return False
+
+        with self._lock:
+            for name in os.listdir(self.persist_dir):
+                if not name.endswith(".idx.gz"):
+                    continue
+                with gzip.open(os.path.join(self.persist_dir, name), "rt", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") != INDEX_VERSION:
+                    log.warning(f"Lexical index '{name}' has old version, rebuilding.")
+                    return False
+                index = _UserIndex.from_json(data)
+                self._users[data["user_id"]] = index
+                for doc_num, doc_id in enumerate(index.doc_ids):
+                    if doc_id is not None:
+                        self._locations[doc_id] = (data["user_id"], doc_num)
+
+        log.info(f"Loaded lexical index of {len(self._locations)} chunks for {len(self._users)} users.")
+        return True
+
+    def save(self) -> int:
+        """Write the changed users to the persist folder (atomic per user). Returns the number written."""
+        if not self.persist_dir:
+            return 0
+
+        with self._lock:
+            os.makedirs(self.persist_dir, exist_ok=True)
+            for user_id in self._dirty:
+                path = self._user_file(user_id)
+                index = self._users.get(user_id)
+                if index is None or not index.live:
+                    self._users.pop(user_id, None)
+                    if os.path.exists(path):
+                        os.remove(path)
+                    continue
+                with gzip.open(f"{path}.tmp", "wt", encoding="utf-8") as f:
+                    json.dump(index.to_json(user_id), f, ensure_ascii=False, separators=(",", ":"))
+                os.replace(f"{path}.tmp", path)
+
+            written = len(self._dirty)
+            self._dirty.clear()
+        return written
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    folder = tempfile.mkdtemp()
+    lex = LexicalIndex(os.path.join(folder, "lexical"))
+    lex.add("alice", ["a1", "a2", "a3"], [
+        "Error code ERR_404 happens when the page is missing.",
+        "The pump part number is XJ-9000, replace it yearly.",
+        "General notes about pumps and valves.",
+    ])
+    lex.add("bob", ["b1"], ["Bob also has part XJ-9000 in stock."])
+
+    print(lex.search("what is XJ-9000?", users=["alice"]))
+    assert lex.search("what is XJ-9000?", users=["alice"])[0][0] == "a2", "Identifier not matched"
+    assert lex.search("err_404")[0][0] == "a1", "Error code not matched"
+    assert {d for d, _ in lex.search("xj-9000")} == {"a2", "b1"}, "Users not merged"
+
+    lex.delete(["a2"])
+    assert lex.search("9000", users=["alice"]) == [], "Deleted chunk found"
+    lex.save()
+
+    loaded = LexicalIndex(os.path.join(folder, "lexical"))
+    assert loaded.load() and len(loaded) == 3, "Load mismatch"
+    assert loaded.search("pumps valves", users=["alice"])[0][0] == "a3", "Loaded search mismatch"
+
+    rebuilt = LexicalIndex()
+    rebuilt.rebuild([("x", Document(page_content="ERR_404 again", metadata={"user_id": "carol"}))])
+    assert rebuilt.search("err_404", users=["carol"])[0][0] == "x", "Rebuild mismatch"
+    print("All lexical index checks passed.")
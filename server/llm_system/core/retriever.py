@@ -0,0 +1,315 @@
+""" Retriever over the FAISS vector store and the BM25 lexical index.
+- Honours `search_kwargs["search_type"]`, which the configurable `VectorStoreRetriever` ignored:
+    - `similarity`: Dense vector search (default).
+    - `mmr`: Dense search, diversified with max marginal relevance (vectorised, stored vectors).
+      Tuned with `fetch_k` / `lambda_mult` in `search_kwargs`.
+    - `hybrid`: Dense + BM25 search in parallel, fused by Reciprocal Rank Fusion.
+- Latency of each leg is tracked, see `get_stats()`.
+- Results are cached (LRU) by normalised query + search kwargs + version of the visible corpus.
+"""
+
+import re
+import json
+import asyncio
+import threading
+from collections import OrderedDict
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from pydantic import ConfigDict
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+from langchain_community.vectorstores import FAISS
+
+from llm_system.core.lexical import LexicalIndex
+from llm_system.utils.fusion import rrf_merge
+from llm_system.utils.mmr import mmr_search
+from llm_system.config import HYBRID_DENSE_WEIGHT, HYBRID_LEXICAL_WEIGHT, RETRIEVAL_CACHE_SIZE
+from llm_system.config import MMR_FETCH_K, MMR_LAMBDA
+
+from metrics import VECTORDB_SECONDS
+from logger import get_logger
+log = get_logger(name="core_retriever")
+
+SEARCH_TYPES = ("similarity", "mmr", "hybrid")
+
+# FAISS filters after the search, so fetch enough candidates for the filter to leave `k`:
+FILTER_FETCH_MULT: int = 4
+
+
+def filter_users(search_filter: Optional[Dict[str, Any]]) -> Optional[Set[str]]:
+    """User ids allowed by a `{"user_id": x}` / `{"$or": [{"user_id": x}, ...]}` filter, None if unrestricted."""
+    if not search_filter:
+        return None
+    if "user_id" in search_filter:
+        value = search_filter["user_id"]
+        if isinstance(value, dict):
+            return set(value["$in"]) if "$in" in value else None
+        return {value}
+    if "$or" in search_filter:
+        users: Set[str] = set()
+        for sub_filter in search_filter["$or"]:
+            sub_users = filter_users(sub_filter)
+            if sub_users is None:
+                return None
+            users |= sub_users
+        return users
+    return None
+
+
+def stamp_users(stamp: str) -> Set[str]:
+    """User ids in a corpus version stamp, like `public:0|u1:3`."""
+    return {part.rsplit(":", 1)[0] for part in stamp.split("|") if part}
+
+
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Lower case, single spaced, without trailing punctuation."""
+    return _SPACES_RE.sub(" ", query.lower()).strip().rstrip("?!. ")
+
+
+class RetrievalCache:
+    """LRU cache of search results.
+    - Keyed by the normalised query, the search kwargs and the version stamp of the corpus visible through
+      the filter, so results go stale as soon as any of the visible users' chunks change.
+    - Entries of a user are also dropped eagerly by `invalidate_user`, to free the memory.
+
+    Args:
+        version_fn (Callable): Returns the version stamp of the chunks visible to the given users.
+        max_entries (int): Max cached results.
+    """
+
+    def __init__(self, version_fn: Callable[[Optional[Set[str]]], str], max_entries: int = RETRIEVAL_CACHE_SIZE):
+        self.version_fn = version_fn
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str, str], List[Document]]" = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0, "invalidated": 0}
+
+    def key(self, query: str, search_kwargs: Dict[str, Any]) -> Tuple[str, str, str]:
+        stamp = self.version_fn(filter_users(search_kwargs.get("filter")))
+        kwargs = json.dumps(search_kwargs, sort_keys=True, default=str)
+        return stamp, normalize_query(query), kwargs
+
+    def get(self, key: Tuple[str, str, str]) -> Optional[List[Document]]:
+        with self._lock:
+            docs = self._entries.get(key)
+            if docs is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return list(docs)
+
+    def put(self, key: Tuple[str, str, str], docs: List[Document]):
+        with self._lock:
+            self._entries[key] = list(docs)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id: str):
+        """Drop the results whose stamp includes the user (their chunks changed)."""
+        with self._lock:
+            stale = [key for key in self._entries if user_id in stamp_users(key[0])]
+            for key in stale:
+                del self._entries[key]
+            self._stats["invalidated"] += len(stale)
+        if stale:
+            log.info(f"Invalidated {len(stale)} cached retrieval results of user '{user_id}'.")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "hit_rate": self._stats["hits"] / total if total else 0.0,
+                "entries": len(self._entries),
+            }
+
+
+class _LegStats:
+    """Latency of one search leg."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg_ms": round(1000 * self.seconds / self.count, 2) if self.count else 0.0,
+            "max_ms": round(1000 * self.max_seconds, 2),
+        }
+
+
+class RetrieverState:
+    """Latency stats, result cache and the lexical search threads, shared by all configured copies of the retriever."""
+
+    def __init__(self, cache: Optional[RetrievalCache] = None, lexical_workers: int = 4):
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=lexical_workers, thread_name_prefix="lexical")
+        self._lock = threading.Lock()
+        self._legs: Dict[str, _LegStats] = {}
+
+    def record(self, leg: str, seconds: float):
+        VECTORDB_SECONDS.observe(seconds, op=leg)
+        with self._lock:
+            self._legs.setdefault(leg, _LegStats()).add(seconds)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            legs = {leg: stats.to_dict() for leg, stats in self._legs.items()}
+        return {"legs": legs, "cache": self.cache.get_stats() if self.cache is not None else None}
+
+
+class VectorDBRetriever(BaseRetriever):
+    """Retriever with runtime `search_kwargs`: `k`, `filter`, `search_type` and the FAISS search options.
+
+    Args:
+        vector_store (FAISS): The FAISS vector store.
+        lexical (LexicalIndex): The BM25 index over the same chunks.
+        search_kwargs (dict): Default search kwargs, usually replaced per request via `ConfigurableField`.
+        state (RetrieverState): Stats / threads, kept across the per request copies.
+
+    ## Functions:
+        + `invoke()` / `ainvoke()`: Returns the documents for the query (standard retriever interface).
+        + `get_stats()`: Returns the latency of each search leg, and the cache hit rate.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    vector_store: FAISS
+    lexical: LexicalIndex
+    search_kwargs: Dict[str, Any] = {}
+    state: RetrieverState
+
+    def _record(self, leg: str, seconds: float):
+        self.state.record(leg, seconds)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns `{"legs": {leg: {count, avg_ms, max_ms}}, "cache": {hits, misses, hit_rate, ...}}`."""
+        return self.state.get_stats()
+
+    def _parse_kwargs(self) -> Tuple[str, int, Optional[Dict[str, Any]], Dict[str, Any]]:
+        kwargs = dict(self.search_kwargs)
+        search_type = kwargs.pop("search_type", "similarity")
+        if search_type not in SEARCH_TYPES:
+            log.warning(f"Unknown search_type '{search_type}', using 'similarity'.")
+            search_type = "similarity"
+        k = kwargs.pop("k", 4)
+        search_filter = kwargs.pop("filter", None)
+        if search_type == "mmr":
+            # `mmr_search` over-fetches for the filter itself, `fetch_k` stays the candidates to select from:
+            kwargs.setdefault("fetch_k", MMR_FETCH_K)
+        elif search_filter is not None:
+            kwargs["fetch_k"] = max(kwargs.get("fetch_k", 20), FILTER_FETCH_MULT * k)
+        return search_type, k, search_filter, kwargs
+
+    def _lexical_search(self, query: str, k: int, search_filter: Optional[Dict[str, Any]]) -> List[Document]:
+        start = perf_counter()
+        hits = self.lexical.search(query, users=filter_users(search_filter), k=FILTER_FETCH_MULT * k)
+
+        docs = []
+        filter_func = self.vector_store._create_filter_func(search_filter) if search_filter else None
+        for doc_id, _ in hits:
+            doc = self.vector_store.docstore.search(doc_id)
+            if isinstance(doc, Document) and (filter_func is None or filter_func(doc.metadata)):
+                docs.append(doc)
+                if len(docs) == k:
+                    break
+
+        self._record("lexical", perf_counter() - start)
+        return docs
+
+    def _mmr(self, embedding: List[float], k: int, search_filter: Optional[Dict[str, Any]],
+             kwargs: Dict[str, Any], start: float) -> List[Document]:
+        docs = mmr_search(
+            self.vector_store, embedding, k=k, filter=search_filter, filter_fetch_mult=FILTER_FETCH_MULT,
+            fetch_k=kwargs["fetch_k"], lambda_mult=kwargs.get("lambda_mult", MMR_LAMBDA),
+        )
+        self._record("mmr", perf_counter() - start)
+        return [doc for doc, _ in docs]
+
+    def _fuse(self, dense: List[Document], lexical: List[Document], k: int, start: float) -> List[Document]:
+        docs = rrf_merge([dense, lexical], k=k, weights=[HYBRID_DENSE_WEIGHT, HYBRID_LEXICAL_WEIGHT])
+        self._record("hybrid", perf_counter() - start)
+        return docs
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        cache = self.state.cache
+        if cache is None:
+            return self._search(query)
+
+        key = cache.key(query, self.search_kwargs)
+        docs = cache.get(key)
+        if docs is None:
+            docs = self._search(query)
+            cache.put(key, docs)
+        return docs
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        cache = self.state.cache
+        if cache is None:
+            return await self._asearch(query)
+
+        key = cache.key(query, self.search_kwargs)
+        docs = cache.get(key)
+        if docs is None:
+            docs = await self._asearch(query)
+            cache.put(key, docs)
+        return docs
+
+    def _search(self, query: str) -> List[Document]:
+        search_type, k, search_filter, kwargs = self._parse_kwargs()
+        start = perf_counter()
+
+        if search_type == "mmr":
+            return self._mmr(self.vector_store._embed_query(query), k, search_filter, kwargs, start)
+
+        lexical_future = None
+        if search_type == "hybrid":
+            lexical_future = self.state.executor.submit(self._lexical_search, query, k, search_filter)
+
+        dense = self.vector_store.similarity_search(query, k=k, filter=search_filter, **kwargs)
+        self._record("dense", perf_counter() - start)
+        if lexical_future is None:
+            return dense
+        return self._fuse(dense, lexical_future.result(), k, start)
+
+    async def _asearch(self, query: str) -> List[Document]:
+        search_type, k, search_filter, kwargs = self._parse_kwargs()
+        start = perf_counter()
+
+        loop = asyncio.get_running_loop()
+        if search_type == "mmr":
+            embedding = await self.vector_store._aembed_query(query)
+            return await loop.run_in_executor(None, self._mmr, embedding, k, search_filter, kwargs, start)
+
+        async def _dense() -> List[Document]:
+            docs = await self.vector_store.asimilarity_search(query, k=k, filter=search_filter, **kwargs)
+            self._record("dense", perf_counter() - start)
+            return docs
+
+        if search_type == "similarity":
+            return await _dense()
+
+        dense, lexical = await asyncio.gather(
+            _dense(),
+            loop.run_in_executor(self.state.executor, self._lexical_search, query, k, search_filter),
+        )
+        return self._fuse(dense, lexical, k, start)
@@ -0,0 +1,272 @@
+"""Scheduler Module for LLM System
+- Contains the `PriorityScheduler` class, which arbitrates the shared (CPU bound) Ollama backend between:
+    + `interactive` work: query embeddings and generations of live chats, which always run immediately.
+    + `bulk` work: embedding batches of document ingestion, admitted only when the backend is idle.
+- Contains the `ScheduledEmbeddings` wrapper, which routes embedding calls through the scheduler.
+"""
+
+import asyncio
+import threading
+from time import monotonic
+from contextvars import ContextVar
+from contextlib import contextmanager, asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, List
+
+from langchain_core.embeddings import Embeddings
+
+from llm_system.config import SCHED_BULK_CONCURRENCY, SCHED_IDLE_GRACE_SEC, EMB_BULK_BATCH_SIZE
+
+from logger import get_logger
+log = get_logger(name="core_scheduler")
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+# Priority class of the work running in current context (thread / task):
+current_priority: ContextVar[str] = ContextVar("current_priority", default=BULK)
+
+
+class PriorityScheduler:
+    """A strict priority scheduler between interactive and bulk work on the same backend.
+    - Interactive work is never queued, it only marks the backend as busy while it runs.
+    - Bulk work waits until no interactive work is running (or finished within `idle_grace` secs),
+      and at most `bulk_concurrency` bulk batches run at once.
+
+    Args:
+        bulk_concurrency (int): Max number of bulk batches admitted at once.
+        idle_grace (float): Seconds the backend must stay free of interactive work before bulk is admitted.
+
+    ## Functions:
+        + `interactive()` / `ainteractive()`: Context managers marking interactive work.
+        + `bulk()` / `abulk()`: Context managers which wait until a bulk batch is admitted.
+        + `get_stats()`: Returns queue depth and wait time metrics per class.
+    """
+
+    def __init__(self, bulk_concurrency: int = SCHED_BULK_CONCURRENCY,
+                 idle_grace: float = SCHED_IDLE_GRACE_SEC):
+        self.bulk_concurrency = max(1, bulk_concurrency)
+        self.idle_grace = idle_grace
+
+        self._cond = threading.Condition()
+        self._last_interactive = 0.0
+        self._stats = {
+            cls: {"active": 0, "waiting": 0, "admitted": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for cls in (INTERACTIVE, BULK)
+        }
+        log.info(f"Initialized PriorityScheduler(bulk_concurrency={bulk_concurrency}, idle_grace={idle_grace}s).")
+
+    def _admit(self, cls: str, waited: float):
+        """Book-keeping for admitted work, must hold `self._cond`."""
+        stats = self._stats[cls]
+        stats["active"] += 1
+        stats["admitted"] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+
+    def _enter_interactive(self):
+        with self._cond:
+            self._admit(INTERACTIVE, 0.0)
+
+    def _exit_interactive(self):
+        with self._cond:
+            self._stats[INTERACTIVE]["active"] -= 1
+            self._last_interactive = monotonic()
+            self._cond.notify_all()
+
+    @contextmanager
+    def interactive(self) -> Iterator[None]:
+        """Mark the enclosed (sync) work as interactive. Never blocks."""
+        self._enter_interactive()
+        token = current_priority.set(INTERACTIVE)
+        try:
+            yield
+        finally:
+            current_priority.reset(token)
+            self._exit_interactive()
+
+    @asynccontextmanager
+    async def ainteractive(self) -> AsyncIterator[None]:
+        """Mark the enclosed (async) work as interactive. Never blocks."""
+        self._enter_interactive()
+        token = current_priority.set(INTERACTIVE)
+        try:
+            yield
+        finally:
+            current_priority.reset(token)
+            self._exit_interactive()
+
+    def _acquire_bulk(self, blocking: bool = True) -> bool:
+        """Wait until the backend is idle and a bulk slot is free, to be released with `_release_bulk`.
+        - With `blocking=False`, returns False at once instead of waiting.
+        """
+        start = monotonic()
+
+        with self._cond:
+            self._stats[BULK]["waiting"] += 1
+            while True:
+                stats = self._stats
+                idle_for = monotonic() - self._last_interactive
+                if stats[INTERACTIVE]["active"] == 0 and idle_for >= self.idle_grace \
+                        and stats[BULK]["active"] < self.bulk_concurrency:
+                    break
+                if not blocking:
+                    self._stats[BULK]["waiting"] -= 1
+                    return False
+                # Wake up either on release, or once the grace period is over:
+                timeout = self.idle_grace - idle_for if stats[INTERACTIVE]["active"] == 0 else None
+                self._cond.wait(timeout=timeout if timeout and timeout > 0 else None)
+
+            self._stats[BULK]["waiting"] -= 1
+            self._admit(BULK, monotonic() - start)
+            return True
+
+    def _release_bulk(self):
+        with self._cond:
+            self._stats[BULK]["active"] -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def bulk(self) -> Iterator[None]:
+        """Block until the backend is idle and a bulk slot is free, then run the enclosed work.
+
+        Raises:
+            RuntimeError: If it would have to wait on an event loop thread, as the interactive work it
+                waits for could never finish there (use `abulk()`, or run the caller in a worker thread).
+        """
+        try:
+            asyncio.get_running_loop()
+            on_loop = True
+        except RuntimeError:
+            on_loop = False
+
+        if not self._acquire_bulk(blocking=not on_loop):
+            raise RuntimeError("PriorityScheduler.bulk() would block the event loop, use abulk().")
+        try:
+            yield
+        finally:
+            self._release_bulk()
+
+    @asynccontextmanager
+    async def abulk(self) -> AsyncIterator[None]:
+        """Async version of `bulk()`, waits for the admission in a worker thread so the event loop keeps running."""
+        admission = asyncio.ensure_future(asyncio.to_thread(self._acquire_bulk))
+        try:
+            await asyncio.shield(admission)
+        except asyncio.CancelledError:
+            # The waiting thread is admitted later anyway, give its slot back then:
+            admission.add_done_callback(
+                lambda future: future.cancelled() or future.exception() is not None or self._release_bulk())
+            raise
+
+        try:
+            yield
+        finally:
+            self._release_bulk()
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Returns per class `active`, `queue_depth`, `admitted`, `wait_avg_ms` and `wait_max_ms`."""
+        with self._cond:
+            return {
+                cls: {
+                    "active": stats["active"],
+                    "queue_depth": stats["waiting"],
+                    "admitted": stats["admitted"],
+                    "wait_avg_ms": round(1000 * stats["wait_total"] / max(stats["admitted"], 1), 2),
+                    "wait_max_ms": round(1000 * stats["wait_max"], 2),
+                }
+                for cls, stats in self._stats.items()
+            }
+
+
+class ScheduledEmbeddings(Embeddings):
+    """Embeddings wrapper which runs every call through a `PriorityScheduler`.
+    - Query embeddings are interactive.
+    - Document embeddings are bulk, split into batches of `batch_size` so interactive work
+      can get in between batches. Within an interactive context, they are interactive too.
+
+    Args:
+        embeddings (Embeddings): The actual embeddings model.
+        scheduler (PriorityScheduler): The scheduler shared with the chat model users.
+        batch_size (int): Number of texts per bulk batch.
+    """
+
+    def __init__(self, embeddings: Embeddings, scheduler: PriorityScheduler,
+                 batch_size: int = EMB_BULK_BATCH_SIZE):
+        self.embeddings = embeddings
+        self.scheduler = scheduler
+        self.batch_size = max(1, batch_size)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if current_priority.get() == INTERACTIVE:
+            with self.scheduler.interactive():
+                return self.embeddings.embed_documents(texts)
+
+        vectors: List[List[float]] = []
+        for i in range(0, len(texts), self.batch_size):
+            with self.scheduler.bulk():
+                vectors.extend(self.embeddings.embed_documents(texts[i:i + self.batch_size]))
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        with self.scheduler.interactive():
+            return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if current_priority.get() == INTERACTIVE:
+            async with self.scheduler.ainteractive():
+                return await self.embeddings.aembed_documents(texts)
+
+        vectors: List[List[float]] = []
+        for i in range(0, len(texts), self.batch_size):
+            async with self.scheduler.abulk():
+                vectors.extend(await self.embeddings.aembed_documents(texts[i:i + self.batch_size]))
+        return vectors
+
+    async def aembed_query(self, text: str) -> List[float]:
+        async with self.scheduler.ainteractive():
+            return await self.embeddings.aembed_query(text)
+
+
+if __name__ == "__main__":
+
+    async def _check():
+        scheduler = PriorityScheduler(bulk_concurrency=1, idle_grace=0.0)
+        ticks = []
+
+        async def _chat():
+            # Interactive generation, which needs the event loop to make progress:
+            async with scheduler.ainteractive():
+                for i in range(5):
+                    await asyncio.sleep(0.02)
+                    ticks.append(i)
+
+        async def _ingest():
+            await asyncio.sleep(0.01)
+            async with scheduler.abulk():
+                return list(ticks)
+
+        _, seen = await asyncio.gather(_chat(), _ingest())
+        assert seen == [0, 1, 2, 3, 4], f"Bulk admitted during interactive work, or loop blocked: {seen}"
+
+        # On the loop, bulk() only runs if admitted at once:
+        with scheduler.bulk():
+            pass
+        async with scheduler.ainteractive():
+            try:
+                with scheduler.bulk():
+                    pass
+                raise AssertionError("Blocking bulk() allowed on the event loop")
+            except RuntimeError:
+                pass
+
+        # A cancelled bulk waiter gives its slot back once admitted:
+        async with scheduler.ainteractive():
+            waiter = asyncio.create_task(_ingest())
+            await asyncio.sleep(0.05)
+            waiter.cancel()
+        await asyncio.sleep(0.1)
+        assert scheduler.get_stats()[BULK]["active"] == 0, scheduler.get_stats()
+        print(scheduler.get_stats())
+
+    asyncio.run(_check())
+    print("All scheduler checks passed.")
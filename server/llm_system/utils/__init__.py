@@ -2,4 +2,5 @@
 Currently, it includes:
 - Document loading functions to load text and PDF files into Document objects.
 - Text splitting functions to split documents into smaller chunks.
+- Parsed-text cache, so that uploaded files are parsed only once.
 """
\ No newline at end of file
@@ -0,0 +1,58 @@
+"""Contains helper functions to compare and fuse ranked lists of retrieved documents.
+- `doc_key` gives a stable identity for a document (vector store id, else content + source + page).
+- `rrf_merge` fuses ranked lists with (weighted) Reciprocal Rank Fusion.
+- `overlap` measures how much two result lists agree.
+"""
+
+import hashlib
+from typing import Dict, List, Optional, Sequence
+from langchain_core.documents import Document
+
+# Standard RRF damping constant:
+RRF_K: int = 60
+
+
+def doc_key(doc: Document) -> str:
+    """Stable identity of a document, to dedup results of different searches."""
+    if doc.id:
+        return doc.id
+    raw = f"{doc.metadata.get('source')}|{doc.metadata.get('page')}|{doc.page_content}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def overlap(first: Sequence[Document], second: Sequence[Document]) -> float:
+    """Fraction of the shorter list which is also present in the other list (1.0 if both are empty)."""
+    if not first or not second:
+        return 1.0 if not first and not second else 0.0
+    keys = {doc_key(doc) for doc in first}
+    common = sum(1 for doc in second if doc_key(doc) in keys)
+    return common / min(len(first), len(second))
+
+
+def rrf_merge(ranked_lists: Sequence[Sequence[Document]], k: Optional[int] = None,
+              weights: Optional[Sequence[float]] = None, rrf_k: int = RRF_K) -> List[Document]:
+    """Fuse ranked lists of documents with Reciprocal Rank Fusion.
+
+    Args:
+        ranked_lists (Sequence[Sequence[Document]]): Lists of documents, best first.
+        k (int, optional): Number of documents to return. Defaults to the longest list's length.
+        weights (Sequence[float], optional): Weight of each list. Defaults to 1.0 for all.
+        rrf_k (int): Damping constant, higher values flatten the rank differences.
+
+    Returns:
+        List[Document]: The fused list, best first, without duplicates.
+    """
+
+    weights = weights or [1.0] * len(ranked_lists)
+    scores: Dict[str, float] = {}
+    docs: Dict[str, Document] = {}
+
+    for weight, ranked in zip(weights, ranked_lists):
+        for rank, doc in enumerate(ranked):
+            key = doc_key(doc)
+            scores[key] = scores.get(key, 0.0) + weight / (rrf_k + rank + 1)
+            docs.setdefault(key, doc)
+
+    k = k if k is not None else max((len(ranked) for ranked in ranked_lists), default=0)
+    best = sorted(scores, key=scores.__getitem__, reverse=True)[:k]
+    return [docs[key] for key in best]
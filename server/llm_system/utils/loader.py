@@ -1,5 +1,6 @@
 """Module dealing specifically with loading files into Document objects.
 Contains the `load_file` function to load text, PDF, and markdown files.
+Parsed pages are kept in the on-disk parse cache, so a file is parsed only once.
 Planning to add more file types in the future.
 
 ## For testing:
@@ -13,6 +14,8 @@ from langchain_core.documents import Document
 from langchain_community.document_loaders import TextLoader, PyMuPDFLoader
 from langchain_community.document_loaders import UnstructuredMarkdownLoader
 
+from llm_system.utils import parse_cache
+
 from logger import get_logger
 log = get_logger(name="doc_loader")
 
@@ -38,21 +41,65 @@ def load_file(user_id: str, file_path: str) -> tuple[bool, List[Document], str]:
         log.error(f"Unsupported file type: {file_extension}.")
         return False, [], f"Unsupported file type: {file_extension}. Supported types are: txt, pdf."
 
-    if file_path.endswith('.txt'):
+    # Serve the parsed pages from cache if this exact file was parsed before:
+    try:
+        content_hash = parse_cache.file_hash(file_path)
+        file_content = parse_cache.get_pages(content_hash)
+    except OSError as e:
+        log.error(f"Failed to read file {file_path}: {e}")
+        return False, [], f"Failed to read file: {os.path.basename(file_path)}"
+
+    if file_content is None:
+        file_content = _parse_file(file_path, file_extension)
+        parse_cache.put_pages(content_hash, file_content)
+
+    # Add user metadata to each doc:
+    file_name = os.path.basename(file_path)
+    for doc in file_content:
+        doc.metadata['user_id'] = user_id
+        # Cache is keyed by content, so same file may be cached under another name:
+        if 'file_path' in doc.metadata:
+            doc.metadata['file_path'] = file_name
+        if 'source' in doc.metadata and not _is_remote(doc.metadata['source']):
+            doc.metadata['source'] = file_name
+
+    if not file_content:
+        log.error(f"No content found in the file: {file_path}")
+        return True, [], f"No content found in the file: {file_path}"
+        # raise ValueError(f"No content found in the file: {file_path}")
+
+    log.info(f"Loaded {len(file_content)} documents from {file_path} for user {user_id}.")
+    return True, file_content, f"Loaded {len(file_content)} documents."
+
+
+def _is_remote(source: str) -> bool:
+    """Check if a document source is a web url rather than a local file."""
+    return "www." in source or "http" in source
+
+
+def _parse_file(file_path: str, file_extension: str) -> List[Document]:
+    """Parse a file with the loader for its type, hiding the server file paths in metadata.
+
+    Args:
+        file_path (str): The absolute path to the file to be parsed.
+        file_extension (str): The lower-cased extension of the file.
+
+    Returns:
+        List[Document]: A list of Document objects, usually one per page.
+    """
+
+    if file_extension == 'txt':
         loader = TextLoader(file_path, encoding='utf-8')
 
-    elif file_path.endswith('.md'):
+    elif file_extension == 'md':
         loader = UnstructuredMarkdownLoader(file_path)
 
     else:
         loader = PyMuPDFLoader(file_path, extract_images=False)
 
-    # Load the file and return the documents
     file_content = loader.load()
 
-    # Add user metadata to each doc:
     for doc in file_content:
-        doc.metadata['user_id'] = user_id
         # Since i am exposing the retrieved docs to UI
         # Hide full server file path if its there:
         if 'file_path' in doc.metadata:
@@ -61,7 +108,7 @@ def load_file(user_id: str, file_path: str) -> tuple[bool, List[Document], str]:
 
         if 'source' in doc.metadata:
             # If it is not local file, keep source as is:
-            if "www." in doc.metadata['source'] or "http" in doc.metadata['source']:
+            if _is_remote(doc.metadata['source']):
                 continue
             # If it is local file, keep only the file name:
             else:
@@ -69,13 +116,8 @@ def load_file(user_id: str, file_path: str) -> tuple[bool, List[Document], str]:
                 #     doc.metadata['source'] = doc.metadata['source'].split('/')[-1]
                 doc.metadata['source'] = os.path.basename(doc.metadata['source'])
 
-    if not file_content:
-        log.error(f"No content found in the file: {file_path}")
-        return True, [], f"No content found in the file: {file_path}"
-        # raise ValueError(f"No content found in the file: {file_path}")
-
-    log.info(f"Loaded {len(file_content)} documents from {file_path} for user {user_id}.")
-    return True, file_content, f"Loaded {len(file_content)} documents."
+    log.info(f"Parsed {len(file_content)} pages from {os.path.basename(file_path)}.")
+    return file_content
 
 
 if __name__ == "__main__":
@@ -0,0 +1,92 @@
+"""Module dealing with the metadata of chunks before they are stored in the vector database.
+- Loaders (like `PyMuPDFLoader`) attach the same file level metadata (producer, creator, dates, title, ...) to every page.
+- `normalize_metadata` moves such fields into one file record, referenced from each chunk by `file_ref`.
+- Chunks keep only their own fields (user, source, page, offsets), with interned string values.
+
+## For testing:
+- Run this file from `server` folder as:
+- `python -m llm_system.utils.metadata`
+"""
+
+import sys
+import json
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
+from langchain_core.documents import Document
+
+from logger import get_logger
+log = get_logger(name="utils_metadata")
+
+# Fields which are always kept on the chunk itself:
+CHUNK_FIELDS: Tuple[str, ...] = ("user_id", "source", "page", "start_index")
+
+
+def _json_size(value: Any) -> int:
+    """Approx serialized size of a value in bytes."""
+    return len(json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str))
+
+
+def _intern(value: Any) -> Any:
+    """Intern string values, so that all chunks of a file share one string object."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def normalize_metadata(documents: List[Document]) -> Tuple[Optional[str], Dict[str, Any], Dict[str, int]]:
+    """Move the file level metadata of the chunks of one file into a single file record (in-place).
+    - A field goes to the file record if it is not a chunk field and has same value in all chunks.
+    - Each chunk then refers the record with `file_ref` (hash of the record, so equal records share an id).
+
+    Args:
+        documents (List[Document]): The chunks of one file.
+
+    Returns:
+        Tuple[Optional[str], Dict[str, Any], Dict[str, int]]: A tuple containing:
+            - Optional[str]: The `file_ref` of the record, or None if there was nothing to move.
+            - Dict[str, Any]: The file record.
+            - Dict[str, int]: Approx metadata bytes `before` and `after` (including the record once).
+    """
+
+    before = sum(_json_size(doc.metadata) for doc in documents)
+    if not documents:
+        return None, {}, {"before": 0, "after": 0}
+
+    # Candidate fields from the first chunk, kept only if all chunks agree:
+    first = documents[0].metadata
+    record = {
+        key: value for key, value in first.items()
+        if key not in CHUNK_FIELDS and all(
+            key in doc.metadata and doc.metadata[key] == value for doc in documents
+        )
+    }
+
+    file_ref = None
+    if record:
+        file_ref = hashlib.sha1(
+            json.dumps(record, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()[:16]
+
+    for doc in documents:
+        slim = {_intern(k): _intern(v) for k, v in doc.metadata.items() if k not in record}
+        if file_ref:
+            slim["file_ref"] = _intern(file_ref)
+        doc.metadata = slim
+
+    after = sum(_json_size(doc.metadata) for doc in documents) + (_json_size(record) if record else 0)
+    return file_ref, record, {"before": before, "after": after}
+
+
+if __name__ == "__main__":
+    pages = [
+        Document(page_content="chunk", metadata={
+            "user_id": "test_user", "source": "paper.pdf", "file_path": "paper.pdf", "page": i,
+            "total_pages": 3, "producer": "pdfTeX", "creator": "LaTeX", "creationdate": "2024-01-01",
+        })
+        for i in range(3)
+    ]
+
+    ref, rec, sizes = normalize_metadata(pages)
+    print(ref, rec, sizes)
+    assert set(pages[0].metadata) == {"user_id", "source", "page", "file_ref"}, "Chunk fields mismatch"
+    assert rec["total_pages"] == 3 and "page" not in rec, "File record mismatch"
+    assert sizes["after"] < sizes["before"], "No savings"
+    print("All metadata checks passed.")
@@ -0,0 +1,120 @@
+"""Contains the vectorised Max Marginal Relevance (MMR) search over the FAISS index.
+- Candidate vectors are reconstructed from the FAISS index in one batch, nothing is re-embedded.
+- The selection works on one candidate x candidate similarity matrix, with a running max similarity
+  to the already selected docs, i.e. one vector operation per selected doc.
+- Same results as langchain's `max_marginal_relevance_search`, which reconstructs vectors one by one
+  and recomputes the similarities to all selected docs at every step.
+
+## For testing:
+- Run this file from `server` folder as:
+- `python -m llm_system.utils.mmr`
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    return matrix / (np.linalg.norm(matrix, axis=-1, keepdims=True) + 1e-12)
+
+
+def mmr_select(query: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float = 0.5) -> List[int]:
+    """Indices of the `k` vectors balancing similarity to the query and diversity among themselves.
+
+    Args:
+        query (np.ndarray): The query vector, shape `(d,)`.
+        vectors (np.ndarray): The candidate vectors, shape `(n, d)`.
+        k (int): Num of vectors to select.
+        lambda_mult (float): 1 for pure relevance, 0 for pure diversity.
+
+    Returns:
+        List[int]: Indices into `vectors`, in selection order.
+    """
+
+    if not len(vectors) or k <= 0:
+        return []
+    candidates = _normalize(np.asarray(vectors, dtype=np.float32))
+    relevance = candidates @ _normalize(np.asarray(query, dtype=np.float32))
+    similarity = candidates @ candidates.T
+
+    selected = [int(np.argmax(relevance))]
+    max_similarity = similarity[selected[0]].copy()
+    for _ in range(min(k, len(candidates)) - 1):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+    return selected
+
+
+def _reconstruct(vector_store: FAISS, rows: List[int]) -> np.ndarray:
+    try:
+        return vector_store.index.reconstruct_batch(np.asarray(rows, dtype=np.int64))
+    except RuntimeError:
+        # Index types without batch reconstruction:
+        return np.vstack([vector_store.index.reconstruct(int(row)) for row in rows])
+
+
+def mmr_search(vector_store: FAISS, embedding: List[float], k: int = 4, fetch_k: int = 20,
+               lambda_mult: float = 0.5, filter: Optional[Dict[str, Any]] = None,
+               filter_fetch_mult: int = 4) -> List[Tuple[Document, float]]:
+    """MMR search by query vector, using the vectors stored in the FAISS index.
+
+    Args:
+        vector_store (FAISS): The FAISS vector store.
+        embedding (List[float]): The query vector.
+        k (int): Num of docs to return.
+        fetch_k (int): Num of candidates (after filtering) to select from.
+        lambda_mult (float): 1 for pure relevance, 0 for pure diversity.
+        filter (dict, optional): Metadata filter, same syntax as `FAISS.similarity_search`.
+        filter_fetch_mult (int): With a filter, `fetch_k` times this many vectors are searched.
+
+    Returns:
+        List[Tuple[Document, float]]: The selected docs with their FAISS distance / score.
+    """
+
+    total = vector_store.index.ntotal
+    if not total or k <= 0:
+        return []
+
+    query = np.asarray([embedding], dtype=np.float32)
+    scores, indices = vector_store.index.search(query, min(total, fetch_k * (filter_fetch_mult if filter else 1)))
+    filter_func = vector_store._create_filter_func(filter) if filter else None
+
+    rows: List[int] = []
+    candidates: List[Tuple[Document, float]] = []
+    for score, row in zip(scores[0], indices[0]):
+        if row == -1:
+            continue
+        doc = vector_store.docstore.search(vector_store.index_to_docstore_id[int(row)])
+        if not isinstance(doc, Document) or (filter_func is not None and not filter_func(doc.metadata)):
+            continue
+        rows.append(int(row))
+        candidates.append((doc, float(score)))
+        if len(rows) == fetch_k:
+            break
+
+    if not rows:
+        return []
+    selected = mmr_select(query[0], _reconstruct(vector_store, rows), k, lambda_mult)
+    return [candidates[i] for i in selected]
+
+
+if __name__ == "__main__":
+    from langchain_core.vectorstores.utils import maximal_marginal_relevance
+
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(50, 32)).astype(np.float32)
+    vectors[1] = vectors[0] + 0.01     # Near duplicate of the best candidate
+    query = vectors[0] + 0.1 * rng.normal(size=32).astype(np.float32)
+
+    for lambda_mult in (0.0, 0.5, 0.9):
+        ours = mmr_select(query, vectors, k=8, lambda_mult=lambda_mult)
+        theirs = maximal_marginal_relevance(query, list(vectors), k=8, lambda_mult=lambda_mult)
+        assert ours == list(theirs), f"Differs from langchain for lambda {lambda_mult}: {ours} vs {theirs}"
+    assert 1 not in mmr_select(query, vectors, k=3, lambda_mult=0.5), "Near duplicate selected"
+    print("All MMR checks passed.")
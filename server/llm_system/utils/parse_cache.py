@@ -0,0 +1,245 @@
+"""Module dealing with the on-disk cache of parsed (extracted) file contents.
+- `load_file` stores the per-page text and metadata of each file here after parsing it once.
+- Entries are keyed by the SHA-256 of the file content and the `LOADER_VERSION`.
+- Each entry is one gzip compressed NDJSON file, one line per page, so it can be streamed back.
+- Total cache size is bounded by `PARSE_CACHE_MAX_BYTES`, least recently used entries are evicted first.
+
+## For testing:
+- Run this file from `server` folder as:
+- `python -m llm_system.utils.parse_cache`
+"""
+
+import os
+import gzip
+import json
+import hashlib
+import threading
+from typing import Iterator, List, Optional
+from langchain_core.documents import Document
+
+from llm_system.config import PARSE_CACHE_DIR, PARSE_CACHE_MAX_BYTES, LOADER_VERSION
+
+from logger import get_logger
+log = get_logger(name="utils_parse_cache")
+
+# Read files in 1 MB blocks while hashing:
+_HASH_BLOCK_SIZE = 1024 * 1024
+_ENTRY_SUFFIX = ".jsonl.gz"
+
+# Guards the size bookkeeping, as uploads can be embedded in parallel:
+_lock = threading.Lock()
+
+
+def file_hash(file_path: str) -> str:
+    """Compute the SHA-256 hex digest of a file, reading it in blocks.
+
+    Args:
+        file_path (str): The absolute path to the file.
+
+    Returns:
+        str: The hex digest of the file content.
+    """
+
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _entry_path(content_hash: str) -> str:
+    """Path of the cache entry for the given content hash and current loader version."""
+    return os.path.join(PARSE_CACHE_DIR, f"{content_hash}.v{LOADER_VERSION}{_ENTRY_SUFFIX}")
+
+
+def has_entry(content_hash: str) -> bool:
+    """Check whether parsed pages for the given content hash are cached."""
+    return os.path.isfile(_entry_path(content_hash))
+
+
+def iter_pages(content_hash: str) -> Iterator[Document]:
+    """Stream the cached pages of a file as Document objects, one page at a time.
+    - Marks the entry as recently used, so it is evicted last.
+
+    Args:
+        content_hash (str): The SHA-256 of the file content.
+
+    Yields:
+        Document: One Document per cached page.
+    """
+
+    path = _entry_path(content_hash)
+    os.utime(path, None)
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            yield Document(page_content=record["t"], metadata=record["m"])
+
+
+def get_pages(content_hash: str) -> Optional[List[Document]]:
+    """Get the cached pages of a file, if present.
+
+    Args:
+        content_hash (str): The SHA-256 of the file content.
+
+    Returns:
+        Optional[List[Document]]: List of cached pages, or None on a cache miss / unreadable entry.
+    """
+
+    if not has_entry(content_hash):
+        return None
+
+    try:
+        pages = list(iter_pages(content_hash))
+        log.info(f"Cache hit for '{content_hash[:12]}' with {len(pages)} pages.")
+        return pages
+
+    except Exception as e:
+        log.error(f"Corrupt cache entry '{content_hash[:12]}', evicting it: {e}")
+        evict(content_hash)
+        return None
+
+
+def put_pages(content_hash: str, pages: List[Document]) -> bool:
+    """Store the parsed pages of a file in the cache.
+    - Written to a temp file first and renamed in place, so readers never see partial entries.
+    - Evicts the least recently used entries if the cache grows beyond its limit.
+
+    Args:
+        content_hash (str): The SHA-256 of the file content.
+        pages (List[Document]): The parsed pages of the file.
+
+    Returns:
+        bool: True if the entry was stored, False otherwise.
+    """
+
+    path = _entry_path(content_hash)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    try:
+        os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+        with gzip.open(temp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+            for page in pages:
+                f.write(json.dumps(
+                    {"t": page.page_content, "m": page.metadata},
+                    ensure_ascii=False, separators=(",", ":")
+                ) + "\n")
+
+        os.replace(temp_path, path)
+        log.info(f"Cached {len(pages)} pages for '{content_hash[:12]}' ({os.path.getsize(path)} bytes).")
+
+    except Exception as e:
+        log.error(f"Failed to cache pages for '{content_hash[:12]}': {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+    enforce_size_limit()
+    return True
+
+
+def evict(content_hash: str) -> bool:
+    """Remove the cache entries (of all loader versions) for the given content hash.
+
+    Args:
+        content_hash (str): The SHA-256 of the file content.
+
+    Returns:
+        bool: True if any entry was removed, False otherwise.
+    """
+
+    if not os.path.isdir(PARSE_CACHE_DIR):
+        return False
+
+    removed = False
+    with _lock:
+        for name in os.listdir(PARSE_CACHE_DIR):
+            if name.startswith(f"{content_hash}.v") and name.endswith(_ENTRY_SUFFIX):
+                try:
+                    os.remove(os.path.join(PARSE_CACHE_DIR, name))
+                    removed = True
+                except OSError as e:
+                    log.error(f"Failed to evict cache entry '{name}': {e}")
+
+    if removed:
+        log.info(f"Evicted cache entries for '{content_hash[:12]}'.")
+    return removed
+
+
+def evict_file(file_path: str) -> bool:
+    """Remove the cache entries of a file, must be called before the file itself is deleted.
+
+    Args:
+        file_path (str): The absolute path to the (still existing) file.
+
+    Returns:
+        bool: True if any entry was removed, False otherwise.
+    """
+
+    if not os.path.isfile(file_path):
+        return False
+
+    try:
+        return evict(file_hash(file_path))
+    except OSError as e:
+        log.error(f"Failed to hash '{os.path.basename(file_path)}' for cache eviction: {e}")
+        return False
+
+
+def enforce_size_limit(max_bytes: int = PARSE_CACHE_MAX_BYTES) -> int:
+    """Evict least recently used entries until the cache fits in `max_bytes`.
+
+    Args:
+        max_bytes (int): Upper bound of total cache size on disk.
+
+    Returns:
+        int: Number of entries evicted.
+    """
+
+    if not os.path.isdir(PARSE_CACHE_DIR):
+        return 0
+
+    with _lock:
+        entries = []
+        for name in os.listdir(PARSE_CACHE_DIR):
+            if not name.endswith(_ENTRY_SUFFIX):
+                continue
+            path = os.path.join(PARSE_CACHE_DIR, name)
+            try:
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+
+        # Oldest access first:
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                evicted += 1
+            except OSError as e:
+                log.error(f"Failed to evict cache entry '{path}': {e}")
+
+    if evicted:
+        log.info(f"Evicted {evicted} cache entries to fit size limit ({total}/{max_bytes} bytes).")
+    return evicted
+
+
+if __name__ == "__main__":
+    docs = [
+        Document(page_content="Page one text.", metadata={"source": "sample.pdf", "page": 0}),
+        Document(page_content="Page two text.", metadata={"source": "sample.pdf", "page": 1}),
+    ]
+
+    key = hashlib.sha256(b"sample").hexdigest()
+    assert put_pages(key, docs) == True, "Cache put failed"
+    assert get_pages(key) == docs, "Cache round trip mismatch"
+    assert evict(key) == True, "Cache eviction failed"
+    assert get_pages(key) is None, "Evicted entry still readable"
+    print("All parse cache checks passed.")
@@ -30,8 +30,9 @@ def split_text(
     """
 
     try:
+        # `start_index` lets the overlapping chunks of a page be stitched back after retrieval:
         text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size, chunk_overlap=chunk_overlap
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True
         )
 
         split_docs = text_splitter.split_documents(documents)
@@ -0,0 +1,330 @@
+"""
+Module for the in-process metrics of the server, exposed in the Prometheus text format on `/metrics`.
+- `Counter`, `Histogram` (fixed buckets, so p50 / p99 via `histogram_quantile`) and `Gauge` (read at scrape time).
+- Recording is a dict lookup, a bisect and an add under a lock, cheap enough for every token / query.
+- The metrics of the server are defined at the bottom, and imported where they are recorded.
+- Values recorded in the spawned `cpu` pool processes are not collected.
+"""
+
+import asyncio
+import functools
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple, Union
+
+from logger import get_logger
+log = get_logger(name="metrics")
+
+# Buckets (upper bounds) in seconds, from cache hits / sqlite queries to long generations:
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Buckets of the generation speed, in tokens / sec:
+RATE_BUCKETS: Tuple[float, ...] = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base of the metrics, with one child (value / buckets) per label values."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+        self._children: Dict[LabelValues, Any] = {}
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"Metric '{self.name}' expects labels {self.labelnames}, got {tuple(labels)}.")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonic count, e.g. requests or tokens. The name should end with `_total`.
+
+    ## Functions:
+        + `inc(amount, **labels)`: Adds the amount (default 1) to the count of the labels.
+    """
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._children[key] = self._children.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            children = dict(self._children)
+        return self._header() + [
+            f"{self.name}{_labels_text(self.labelnames, key)} {_number(value)}" for key, value in children.items()
+        ]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values (latencies, rates) over fixed buckets, with their sum and count.
+
+    ## Functions:
+        + `observe(value, **labels)`: Records one value.
+        + `time(**labels)`: Context manager recording the duration of its block, in seconds.
+        + `timed(**labels)`: Decorator recording the duration of each call (sync or async).
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                # Per bucket (not cumulative) counts, the last one for +Inf, then the sum:
+                child = self._children[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            child[index] += 1
+            child[-1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def timed(self, **labels) -> Callable:
+        def decorator(fn: Callable) -> Callable:
+            if asyncio.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def _async_wrapper(*args, **kwargs):
+                    with self.time(**labels):
+                        return await fn(*args, **kwargs)
+                return _async_wrapper
+
+            @functools.wraps(fn)
+            def _wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return fn(*args, **kwargs)
+            return _wrapper
+        return decorator
+
+    def render(self) -> List[str]:
+        with self._lock:
+            children = {key: list(child) for key, child in self._children.items()}
+        lines = self._header()
+        names = self.labelnames + ("le",)
+        for key, child in children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels_text(names, key + (_number(float(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labelnames, key)} {_number(child[-1])}")
+            lines.append(f"{self.name}_count{_labels_text(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+GaugeValue = Union[float, Dict[LabelValues, float]]
+
+
+class Gauge(_Metric):
+    """Current value, read from the component when scraped (index size, queue depths, ...).
+
+    Args:
+        fn (Callable): Returns the value, or `{label values: value}` for a labelled gauge.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Callable[[], GaugeValue], labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception as e:
+            log.warning(f"Gauge '{self.name}' failed to read: {e}")
+            return []
+        values = value if isinstance(value, dict) else {(): value}
+        return self._header() + [
+            f"{self.name}{_labels_text(self.labelnames, key)} {_number(val)}" for key, val in values.items()
+        ]
+
+
+class Registry:
+    """The metrics exposed on `/metrics`, by name.
+
+    ## Functions:
+        + `counter(name, help, labelnames)` / `histogram(...)`: Returns the metric, created on first use.
+        + `gauge(name, help, fn, labelnames)`: Registers (or replaces) a gauge read by `fn`.
+        + `render()`: Returns all metrics in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _get_or_add(self, metric: _Metric) -> Any:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None and type(existing) is type(metric):
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_add(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._get_or_add(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name: str, help: str, fn: Callable[[], GaugeValue], labelnames: Sequence[str] = ()) -> Gauge:
+        # Replaced, as it reads the components of the current app (lifespan):
+        gauge = Gauge(name, help, fn, labelnames)
+        with self._lock:
+            self._metrics[name] = gauge
+        return gauge
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting the HTTP requests and timing them, by route and status code.
+    - Plain ASGI (not `BaseHTTPMiddleware`), so streamed responses and `http.disconnect` pass through untouched.
+    - Labelled by the route template (e.g. `/rag`), unmatched paths share one label.
+    """
+
+    def __init__(self, app: Callable):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start, status = perf_counter(), 500
+
+        async def _send(message: Dict[str, Any]):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            route = scope.get("route")
+            endpoint = getattr(route, "path", None) or "unmatched"
+            HTTP_REQUESTS.inc(endpoint=endpoint, method=scope["method"], status=status)
+            HTTP_SECONDS.observe(perf_counter() - start, endpoint=endpoint)
+
+
+# ------------------------------------------------------------------------------
+# Metrics of the server (gauges are registered with the components, in the lifespan):
+# ------------------------------------------------------------------------------
+
+HTTP_REQUESTS = REGISTRY.counter(
+    "rag_http_requests_total", "HTTP requests by endpoint, method and status code.", ("endpoint", "method", "status"))
+HTTP_SECONDS = REGISTRY.histogram(
+    "rag_http_request_seconds", "HTTP request duration (until the last byte of the response).", ("endpoint",))
+
+TTFT_SECONDS = REGISTRY.histogram(
+    "rag_time_to_first_token_seconds", "Time from the start of the stream to its first answer token.",
+    ("endpoint",))
+STREAM_TOKENS = REGISTRY.counter(
+    "rag_stream_tokens_total", "Answer tokens (content events) streamed.", ("endpoint",))
+TOKENS_PER_SECOND = REGISTRY.histogram(
+    "rag_stream_tokens_per_second", "Answer tokens per second, from the first to the last token.",
+    ("endpoint",), buckets=RATE_BUCKETS)
+STREAMS_CANCELLED = REGISTRY.counter(
+    "rag_stream_cancelled_total", "Streams cancelled as their client disconnected.", ("endpoint",))
+WASTED_TOKENS = REGISTRY.counter(
+    "rag_stream_wasted_tokens_total", "Answer tokens generated for cancelled streams.", ("endpoint",))
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "rag_chain_stage_seconds",
+    "RAG chain stage duration: route, condense, retrieve (incl. condense / rerank), merge, pack, compress.",
+    ("stage",))
+
+VECTORDB_SECONDS = REGISTRY.histogram(
+    "rag_vectordb_seconds", "Vector DB operation duration: dense / mmr / lexical / hybrid search and save.", ("op",))
+
+INGEST_SECONDS = REGISTRY.histogram(
+    "rag_ingest_seconds", "File ingestion duration, by step: prepare (load + split), embed and total.", ("step",))
+INGEST_FILES = REGISTRY.counter(
+    "rag_ingest_files_total", "Files ingested, by status.", ("status",))
+INGEST_CHUNKS = REGISTRY.counter(
+    "rag_ingest_chunks_total", "Chunks embedded and indexed.")
+
+SQLITE_SECONDS = REGISTRY.histogram(
+    "rag_sqlite_query_seconds", "SQLite statement duration, by statement type.", ("op",))
+
+
+if __name__ == "__main__":
+    registry = Registry()
+    requests = registry.counter("test_requests_total", "Requests.", ("endpoint",))
+    latency = registry.histogram("test_seconds", "Latency.", ("stage",), buckets=(0.1, 1.0))
+    registry.gauge("test_depth", "Queue depth.", lambda: {("db",): 2, ("cpu",): 0}, ("pool",))
+
+    requests.inc(endpoint="/rag")
+    requests.inc(2, endpoint="/rag")
+    for value in (0.05, 0.5, 5.0):
+        latency.observe(value, stage="pack")
+
+    @latency.timed(stage="async")
+    async def _stage():
+        return 42
+
+    assert asyncio.run(_stage()) == 42
+    text = registry.render()
+    print(text)
+    assert 'test_requests_total{endpoint="/rag"} 3' in text
+    assert 'test_seconds_bucket{stage="pack",le="1.0"} 2' in text
+    assert 'test_seconds_bucket{stage="pack",le="+Inf"} 3' in text
+    assert 'test_seconds_count{stage="async"} 1' in text
+    assert 'test_depth{pool="db"} 2' in text
+    assert registry.counter("test_requests_total", "Requests.", ("endpoint",)) is requests
+    print("All metrics checks passed.")
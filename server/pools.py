@@ -0,0 +1,192 @@
+"""
+Module for running the blocking work of the async endpoints on dedicated, bounded executors.
+- The event loop only awaits these pools, so a slow sqlite call, bcrypt check or FAISS save
+  never stalls the token streams of the other requests.
+- `db`: sqlite calls (`sq_db`) and small file system operations, threads.
+- `cpu`: bcrypt hashing / checks and PDF previews, processes (off the GIL), or threads if disabled.
+- `index`: Ingestion, archive extraction and FAISS deletes / saves, threads (they share the index in memory).
+- Each pool accepts at most `workers + max_queue` calls at once, further calls fail with `PoolSaturated`.
+- Functions run in the process pool must be picklable, i.e. module level functions.
+"""
+
+import asyncio
+import multiprocessing
+from threading import Lock
+from time import perf_counter
+from functools import partial
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Tuple
+
+from llm_system.config import (
+    POOL_DB_WORKERS, POOL_CPU_WORKERS, POOL_CPU_PROCESSES, POOL_INDEX_WORKERS, POOL_MAX_QUEUE
+)
+
+from logger import get_logger
+log = get_logger(name="pools")
+
+
+class PoolSaturated(RuntimeError):
+    """Raised when a pool already has `workers + max_queue` calls pending."""
+
+    def __init__(self, pool: str):
+        super().__init__(f"Server busy: '{pool}' pool is saturated, retry shortly.")
+        self.pool = pool
+
+
+def _timed_call(fn: Callable, args: Tuple, kwargs: Dict[str, Any]) -> Tuple[Any, float]:
+    """Runs the call in the worker, and returns its result with its own duration (without the queue wait)."""
+    start = perf_counter()
+    result = fn(*args, **kwargs)
+    return result, perf_counter() - start
+
+
+class BoundedPool:
+    """An executor with a bounded num of pending calls, and its saturation stats.
+
+    Args:
+        name (str): Name of the pool, for logs and stats.
+        workers (int): Num of worker threads / processes.
+        max_queue (int): Num of calls which may wait for a free worker.
+        processes (bool): Run the calls in processes (spawned) instead of threads.
+
+    ## Functions:
+        + `run(fn, *args, **kwargs)`: Awaits the call on the pool, raises `PoolSaturated` if full.
+        + `get_stats()`: Returns the calls, rejections, active / queued calls and their timings.
+        + `shutdown()`: Stops the workers, cancelling the queued calls.
+    """
+
+    def __init__(self, name: str, workers: int, max_queue: int = POOL_MAX_QUEUE, processes: bool = False):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.processes = processes
+        self._executor: Executor = self._new_executor()
+
+        self._lock = Lock()
+        self._pending = 0
+        self._stats = {"calls": 0, "failed": 0, "rejected": 0, "peak_pending": 0,
+                       "wait_seconds": 0.0, "run_seconds": 0.0, "max_wait_seconds": 0.0}
+        log.info(f"Initialized {'process' if processes else 'thread'} pool '{name}' "
+                 f"(workers={workers}, max_queue={max_queue}).")
+
+    def _new_executor(self) -> Executor:
+        if self.processes:
+            # Spawned, as forking the server (threads, FAISS / Ollama clients) is not safe:
+            executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            # Start the workers now, rather than on the first (login) requests:
+            for _ in range(self.workers):
+                executor.submit(_timed_call, int, (), {})
+            return executor
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"pool_{self.name}")
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """Runs `fn(*args, **kwargs)` on the pool.
+
+        Returns:
+            Any: The result of the call, its exceptions are raised as is.
+        Raises:
+            PoolSaturated: If `workers + max_queue` calls are already pending.
+        """
+
+        with self._lock:
+            if self._pending >= self.workers + self.max_queue:
+                self._stats["rejected"] += 1
+                log.warning(f"Pool '{self.name}' saturated ({self._pending} pending), rejected {fn.__name__}.")
+                raise PoolSaturated(self.name)
+            self._pending += 1
+            self._stats["peak_pending"] = max(self._stats["peak_pending"], self._pending)
+
+        start, executor = perf_counter(), self._executor
+        try:
+            future = executor.submit(_timed_call, fn, args, kwargs)
+        except BaseException as e:
+            self._release(start, 0.0, failed=True)
+            if isinstance(e, BrokenProcessPool):
+                self._replace(executor)
+            raise
+        # Released when the call really ends, not when its awaiter is cancelled (the worker may still run it):
+        future.add_done_callback(partial(self._on_done, start))
+
+        try:
+            result, _ = await asyncio.wrap_future(future)
+            return result
+        except BrokenProcessPool:
+            self._replace(executor)
+            raise
+
+    def _on_done(self, start: float, future: "Future[Tuple[Any, float]]"):
+        if future.cancelled() or future.exception() is not None:
+            self._release(start, 0.0, failed=True)
+        else:
+            self._release(start, future.result()[1], failed=False)
+
+    def _release(self, start: float, run_seconds: float, failed: bool):
+        wait = max(perf_counter() - start - run_seconds, 0.0)
+        with self._lock:
+            self._pending -= 1
+            self._stats["calls"] += 1
+            self._stats["failed"] += failed
+            self._stats["wait_seconds"] += wait
+            self._stats["run_seconds"] += run_seconds
+            self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], wait)
+
+    def _replace(self, executor: Executor):
+        """A worker died (e.g. killed for memory): later calls get a new pool, the broken one is shut down."""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = self._new_executor()
+        log.error(f"Pool '{self.name}' broken, replaced its workers.")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Returns the calls (failed / rejected), active and queued calls, saturation and avg wait / run time.
+        - `saturation`: Pending calls per worker, above 1 the calls are queueing.
+        """
+        with self._lock:
+            stats, pending = dict(self._stats), self._pending
+        calls = stats["calls"]
+        return {
+            "kind": "process" if self.processes else "thread",
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "active": min(pending, self.workers),
+            "queued": max(pending - self.workers, 0),
+            "saturation": round(pending / self.workers, 2),
+            "calls": calls,
+            "failed": stats["failed"],
+            "rejected": stats["rejected"],
+            "peak_pending": stats["peak_pending"],
+            "avg_wait_ms": round(1000 * stats["wait_seconds"] / calls, 2) if calls else 0.0,
+            "max_wait_ms": round(1000 * stats["max_wait_seconds"], 2),
+            "avg_run_ms": round(1000 * stats["run_seconds"] / calls, 2) if calls else 0.0,
+        }
+
+    def shutdown(self):
+        """Stops the workers, the queued calls are cancelled."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        log.info(f"Pool '{self.name}' shut down.")
+
+
+class Pools:
+    """The `db`, `cpu` and `index` pools of the server, see module docs.
+
+    ## Functions:
+        + `get_stats()`: Returns the stats of every pool.
+        + `shutdown()`: Stops all pools.
+    """
+
+    def __init__(self, db_workers: int = POOL_DB_WORKERS, cpu_workers: int = POOL_CPU_WORKERS,
+                 cpu_processes: bool = POOL_CPU_PROCESSES, index_workers: int = POOL_INDEX_WORKERS,
+                 max_queue: int = POOL_MAX_QUEUE):
+        self.db = BoundedPool("db", db_workers, max_queue)
+        self.cpu = BoundedPool("cpu", cpu_workers, max_queue, processes=cpu_processes)
+        self.index = BoundedPool("index", index_workers, max_queue)
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {pool.name: pool.get_stats() for pool in (self.db, self.cpu, self.index)}
+
+    def shutdown(self):
+        for pool in (self.db, self.cpu, self.index):
+            pool.shutdown()
@@ -3,29 +3,47 @@
 # Avoid using --reload flag, because, LLMs will keep reloading and system will overheat.
 
 from fastapi import FastAPI, File, UploadFile, Form, Request, Query
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import iterate_in_threadpool
 
 import json
+import asyncio
+from functools import partial
+from typing import Optional
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
 
 # llm system imports:
-from llm_system.core.llm import get_llm, get_output_parser  # Functions
+from llm_system.core.llm import get_output_parser           # Function
+from llm_system.core.llm import ModelRouter                 # Class
 from llm_system.core.llm import get_dummy_response          # Function
 from llm_system.core.llm import get_dummy_response_stream   # Function
 from llm_system.core.database import VectorDB               # Class
 from llm_system.core.history import HistoryStore            # Class
+from llm_system.core.scheduler import PriorityScheduler     # Class
+from llm_system.core.admission import AdmissionController, AdmissionRejected  # Class, Exception
 from llm_system.chains.rag import build_rag_chain           # Function
+from llm_system.chains.standalone import StandaloneDetector # Class
+from llm_system.chains.speculative import SpeculativeRetrieval  # Class
+from llm_system.chains.reranker import Reranker             # Class
+from llm_system.chains.answer_cache import AnswerCache      # Class
+from llm_system.chains.prefix import PrefixTracker          # Class
+from llm_system.chains.compressor import SentenceCompressor # Class
+from llm_system.chains.intent import IntentRouter, RETRIEVE  # Class, Constant
+from llm_system.chains.merger import ChunkMerger            # Class
 from llm_system import config                               # Constants
 from llm_system.core.ingestion import ingest_file           # Function
+from llm_system.core.ingestion import ingest_files          # Function
 
 # Helper Modules:
 import sq_db
 import files
+from pools import Pools, PoolSaturated
+from streams import StreamWatcher, primed
+import metrics
 
 # Type hinting imports:
-from langchain_core.vectorstores import VectorStore as T_VECTOR_STORE
 from langchain_core.messages import BaseMessage as T_MESSAGE
 
 import logger
@@ -52,38 +70,79 @@ async def lifespan(app: FastAPI):
     # [ Startup ]
     log.info("[LifeSpan] Starting the server components.")
 
-    app.state.llm_chat = get_llm(
-        model_name=config.LLM_CHAT_MODEL_NAME,
-        context_size=config.MAX_CONTENT_SIZE,
-        temperature=config.LLM_CHAT_TEMPERATURE,
-        verify_connection=config.VERIFY_LLM_CONNECTION
-    )
-
-    # app.state.llm_summary = get_llm(...)
-    app.state.llm_summary = app.state.llm_chat
+    # Models per chain stage, see `config.LLM_STAGES`:
+    app.state.llm_router = ModelRouter(verify_connection=config.VERIFY_LLM_CONNECTION)
+    app.state.llm_chat = app.state.llm_router.get("answer")
+    app.state.llm_summary = app.state.llm_router.get("condense")
+    app.state.llm_simple = app.state.llm_router.get("simple")
 
     app.state.output_parser = get_output_parser()
+
+    # Chats get strict priority over ingestion on the shared Ollama backend:
+    app.state.scheduler = PriorityScheduler()
+    # Generations beyond the concurrency cap wait in fair per session queues:
+    app.state.admission = AdmissionController()
+    # Streamed generations are cancelled as soon as their client disconnects:
+    app.state.stream_watcher = StreamWatcher()
     app.state.vector_db = VectorDB(
         embed_model=config.EMB_MODEL_NAME,
         retriever_num_docs=config.DOCS_NUM_COUNT,
         verify_connection=config.VERIFY_EMB_CONNECTION,
+        scheduler=app.state.scheduler,
     )
-    app.state.history_store = HistoryStore()
+    app.state.history_store = HistoryStore(llm=app.state.llm_summary, mode=config.HISTORY_MEMORY_MODE)
+    app.state.standalone_detector = StandaloneDetector(
+        embeddings=app.state.vector_db.get_embeddings()
+    )
+    app.state.speculation = SpeculativeRetrieval() if config.SPECULATIVE_RETRIEVAL else None
+    app.state.reranker = Reranker() if config.RERANK_ENABLED else None
+    app.state.answer_cache = None
+    if config.ANSWER_CACHE_ENABLED:
+        app.state.answer_cache = AnswerCache(
+            embeddings=app.state.vector_db.get_embeddings(),
+            version_fn=app.state.vector_db.corpus_version,
+        )
+        app.state.vector_db.add_corpus_listener(app.state.answer_cache.invalidate_user)
+    app.state.prefix_tracker = PrefixTracker()
+    app.state.intent_router = None
+    if config.INTENT_ROUTING:
+        app.state.intent_router = IntentRouter(embeddings=app.state.vector_db.get_embeddings())
+    app.state.merger = ChunkMerger() if config.MERGE_ADJACENT_CHUNKS else None
+    app.state.compressor = None
+    if config.CONTEXT_COMPRESSION:
+        app.state.compressor = SentenceCompressor(embeddings=app.state.vector_db.get_embeddings())
 
     app.state.rag_chain = build_rag_chain(
         llm_chat=app.state.llm_chat,
         llm_summary=app.state.llm_summary,
         retriever=app.state.vector_db.get_retriever(),
-        get_history_fn=app.state.history_store.get_session_history,
+        get_history_fn=app.state.history_store.get_prompt_history,
+        detector=app.state.standalone_detector,
+        speculation=app.state.speculation,
+        reranker=app.state.reranker,
+        answer_cache=app.state.answer_cache,
+        prefix_tracker=app.state.prefix_tracker,
+        compressor=app.state.compressor,
+        intent_router=app.state.intent_router,
+        merger=app.state.merger,
+        prompt_layout=config.PROMPT_LAYOUT,
+        executor=config.RAG_EXECUTOR,
     )
 
     log.info("[LifeSpan] All LLM components initialized.")
 
+    # Bounded executors for the blocking work of the endpoints:
+    app.state.pools = Pools()
+
+    # Gauges of the components, read when `/metrics` is scraped:
+    register_gauges(app)
+
     # sq_db.delete_database()
     sq_db.create_tables()
 
     # Files
     files.check_create_uploads_folder()
+    files.delete_partial_uploads()
     files.delete_empty_user_folders()
 
     # [ Lifespan ]
@@ -93,10 +152,38 @@ async def lifespan(app: FastAPI):
     log.info("[LifeSpan] Shutting down LLM server...")
     # Add any cleanup part here
     # Like saving vector DB, or shutting down subprocesses
+    app.state.pools.shutdown()
+
+
+def register_gauges(app: FastAPI):
+    """Register the `/metrics` gauges of the index size, history sessions and queue depths."""
+
+    state = app.state
+    metrics.REGISTRY.gauge(
+        "rag_index_vectors", "Vectors (chunks) in the FAISS index.", state.vector_db.count_vectors)
+    metrics.REGISTRY.gauge(
+        "rag_history_sessions", "Chat sessions with a history in memory.",
+        lambda: state.history_store.get_stats()["sessions"])
+    metrics.REGISTRY.gauge(
+        "rag_admission_active", "Generations running.", lambda: state.admission.get_stats()["active"])
+    metrics.REGISTRY.gauge(
+        "rag_admission_queue_depth", "Generations waiting for a slot.",
+        lambda: state.admission.get_stats()["queue_depth"])
+    metrics.REGISTRY.gauge(
+        "rag_scheduler_queue_depth", "Ollama calls waiting, by priority class.",
+        lambda: {(cls,): stats["queue_depth"] for cls, stats in state.scheduler.get_stats().items()}, ("class",))
+    metrics.REGISTRY.gauge(
+        "rag_pool_active", "Calls running on the blocking work pools.",
+        lambda: {(name,): stats["active"] for name, stats in state.pools.get_stats().items()}, ("pool",))
+    metrics.REGISTRY.gauge(
+        "rag_pool_queued", "Calls waiting for a worker of the blocking work pools.",
+        lambda: {(name,): stats["queued"] for name, stats in state.pools.get_stats().items()}, ("pool",))
 
 
 # Make one FastAPI app instance with the lifespan context manager
 app = FastAPI(lifespan=lifespan)
+# Request counts / durations per endpoint, for `/metrics`:
+app.add_middleware(metrics.MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -110,6 +197,19 @@ app.add_middleware(
 )
 
 
+# A saturated pool means the server is overloaded, the client should retry later:
+@app.exception_handler(PoolSaturated)
+async def pool_saturated_handler(request: Request, exc: PoolSaturated):
+    return JSONResponse(content={"error": str(exc)}, status_code=503, headers={"Retry-After": "1"})
+
+
+# Generation queue budget exceeded, rejected before any stream is started:
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    return JSONResponse(content={"error": str(exc)}, status_code=429,
+                        headers={"Retry-After": str(exc.retry_after)})
+
+
 # ------------------------------------------------------------------------------
 # Basic API Endpoints:
 # ------------------------------------------------------------------------------
@@ -124,6 +224,46 @@ async def root():
     }
 
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Endpoint for Prometheus to scrape the server metrics.
+    - Return the counters, latency histograms (HTTP, time to first token, chain stages, vector DB,
+      ingestion, sqlite) and gauges (index size, sessions, queue depths) in the Prometheus text format.
+    """
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/stats")
+async def stats(request: Request):
+    """Endpoint to get the live metrics of the server components.
+    - Return JSON with `{"scheduler", "standalone", "speculative", "rerank", "retrieval", "answer_cache",
+      "prefix_reuse", "compression", "memory", "llm", "intent", "merge", "pools", "admission", "streams"}` keys.
+    """
+    speculation = request.app.state.speculation
+    reranker = request.app.state.reranker
+    answer_cache = request.app.state.answer_cache
+    compressor = request.app.state.compressor
+    intent_router = request.app.state.intent_router
+    merger = request.app.state.merger
+    return {
+        "scheduler": request.app.state.scheduler.get_stats(),
+        "standalone": request.app.state.standalone_detector.get_stats(),
+        "speculative": speculation.get_stats() if speculation else None,
+        "rerank": reranker.get_stats() if reranker else None,
+        "retrieval": request.app.state.vector_db.get_retrieval_stats(),
+        "answer_cache": answer_cache.get_stats() if answer_cache else None,
+        "prefix_reuse": request.app.state.prefix_tracker.get_stats(),
+        "compression": compressor.get_stats() if compressor else None,
+        "memory": request.app.state.history_store.get_stats(),
+        "llm": request.app.state.llm_router.get_stats(),
+        "intent": intent_router.get_stats() if intent_router else None,
+        "merge": merger.get_stats() if merger else None,
+        "pools": request.app.state.pools.get_stats(),
+        "admission": request.app.state.admission.get_stats(),
+        "streams": request.app.state.stream_watcher.get_stats(),
+    }
+
+
 # Define data model for chat request
 class BasicChatRequest(BaseModel):
     query: str
@@ -136,10 +276,14 @@ async def simple(request: Request, chat_request: BasicChatRequest):
     """Endpoint to handle ont time generation queries.
     - Post request expects JSON `{"query": "", "session_id": "", "dummy":T/F}` structure.
     - Return JSON with `{"response": "", "session_id": ""}` structure.
+    - Return 429 with `Retry-After` header if the generation queue is full.
     """
 
-    llm = request.app.state.llm_chat | request.app.state.output_parser
+    llm = request.app.state.llm_simple | request.app.state.output_parser
     session_id = chat_request.session_id.strip() or "unknown_session"
+    admission: AdmissionController = request.app.state.admission
+    # Checked and queued in one step, `AdmissionRejected` is sent as 429:
+    ticket = None if chat_request.dummy else admission.enqueue(session_id)
 
     try:
         query = chat_request.query
@@ -151,7 +295,13 @@ async def simple(request: Request, chat_request: BasicChatRequest):
             return get_dummy_response()
 
         else:
-            result = await llm.ainvoke(input=query)
+            try:
+                async for _ in ticket.wait():
+                    pass
+                async with request.app.state.scheduler.ainteractive():
+                    result = await llm.ainvoke(input=query)
+            finally:
+                ticket.release()
 
             log.info(f"/simple Response generated for '{session_id}'.")
             return {"response": result, "session_id": session_id}
@@ -173,12 +323,16 @@ class StreamChatRequest(BaseModel):
 async def chat_stream(request: Request, chat_request: StreamChatRequest):
     """Endpoint to handle streaming responses for one time generation queries.
     - Post request expects JSON `{"query": "", "session_id": "", "dummy":T/F}` structure.
-    - Return NDJSON with types "metadata", "content", or "error".
+    - Return NDJSON with types "metadata", "queued" (position while waiting), "content", or "error".
+    - Return 429 with `Retry-After` header if the generation queue is full.
     """
-    llm = request.app.state.llm_chat | request.app.state.output_parser
+    llm = request.app.state.llm_simple | request.app.state.output_parser
     session_id = chat_request.session_id.strip() or "unknown_session"
+    admission: AdmissionController = request.app.state.admission
 
     async def token_streamer():
+        # Checked and queued before the first line, which `primed` awaits in the endpoint (429 if rejected):
+        ticket = None if chat_request.dummy else admission.enqueue(session_id)
         try:
             dummy = chat_request.dummy
             s = 'dummy' if dummy else 'real'
@@ -198,26 +352,29 @@ async def chat_stream(request: Request, chat_request: StreamChatRequest):
                     batch_tokens=config.BATCH_TOKEN_PS,
                     token_rate=config.TOKENS_PER_SEC
                 )
-                for chunk in resp:
-                    if await request.is_disconnected():
-                        log.warning(f"/simple/stream client disconnected for '{session_id}'")
-                        break
-
+                # Paced with `time.sleep`, so iterated on a thread to keep the event loop free:
+                async for chunk in iterate_in_threadpool(resp):
                     yield json.dumps({
                         "type": "content",
                         "data": chunk
                     }) + "\n"
 
             else:
-                async for chunk in llm.astream(chat_request.query):
-                    if await request.is_disconnected():
-                        log.warning(f"/simple/stream client disconnected for '{session_id}'")
-                        break
+                try:
+                    async for position in ticket.wait():
+                        yield json.dumps({
+                            "type": "queued",
+                            "data": {"position": position}
+                        }) + "\n"
 
-                    yield json.dumps({
-                        "type": "content",
-                        "data": chunk
-                    }) + "\n"
+                    async with request.app.state.scheduler.ainteractive():
+                        async for chunk in llm.astream(chat_request.query):
+                            yield json.dumps({
+                                "type": "content",
+                                "data": chunk
+                            }) + "\n"
+                finally:
+                    ticket.release()
 
             # In the end, you can send some "Done" etc if u need some conditional logic
             # Server will auto send EOF to mark end of generator response.
@@ -233,9 +390,17 @@ async def chat_stream(request: Request, chat_request: StreamChatRequest):
                 "type": "error",
                 "data": str(e)
             }) + "\n"
+        finally:
+            if ticket is not None:
+                ticket.release()
 
     # Return a StreamingResponse with the token streamer generator (basically enable streaming)
-    return StreamingResponse(token_streamer(), media_type="text/plain")
+    # The watcher cancels the generation as soon as the client disconnects:
+    events = await primed(token_streamer())
+    return StreamingResponse(
+        request.app.state.stream_watcher.stream(request, events, "/simple/stream", session_id),
+        media_type="text/plain"
+    )
 
 
 # ------------------------------------------------------------------------------
@@ -244,7 +409,9 @@ async def chat_stream(request: Request, chat_request: StreamChatRequest):
 
 # Helper function to delete old files and embeddings:
 def delete_old_files(user_id: str, time: int = OLD_FILE_THRESHOLD):
-    """Function to delete old files and embeddings older than the specified time."""
+    """Function to delete old files and embeddings older than the specified time.
+    - Blocking (sqlite, disk and FAISS writes), endpoints run it on the `index` pool.
+    """
     log.info(
         f"/delete Deleting old files and embeddings for user '{user_id}' older than {time} seconds")
 
@@ -263,8 +430,8 @@ def delete_old_files(user_id: str, time: int = OLD_FILE_THRESHOLD):
     if old_files['embeddings']:
         log.info(f"/delete Removing old embeddings for user '{user_id}'")
         vs: VectorDB = app.state.vector_db
-        db: T_VECTOR_STORE = vs.get_vector_store()
-        resp = db.delete(old_files['embeddings'])
+        resp = vs.delete_documents(old_files['embeddings'])
+        vs.prune_file_records()
 
         # Save the changes to disk
         vs.save_db_to_disk()
@@ -303,14 +470,15 @@ async def login(request: Request, login_request: LoginRequest):
     password = login_request.password.strip()
     log.info(f"/login Requested by '{login_id}'")
 
-    # Check if the user exists in the database
-    status, msg = sq_db.authenticate_user(user_id=login_id, password=password)
+    # Check if the user exists in the database (bcrypt check, on the `cpu` pool)
+    pools: Pools = request.app.state.pools
+    status, msg = await pools.cpu.run(sq_db.authenticate_user, user_id=login_id, password=password)
     if status:
         user_id = login_id
         # Check if folder exists in UPLOADS_DIR with user_id
-        files.create_user_uploads_folder(user_id=user_id)
+        await pools.db.run(files.create_user_uploads_folder, user_id=user_id)
         # Delete any older data if exists
-        delete_old_files(user_id=user_id, time=OLD_FILE_THRESHOLD)
+        await pools.index.run(delete_old_files, user_id=user_id, time=OLD_FILE_THRESHOLD)
         return JSONResponse(content={"user_id": user_id, "name": msg}, status_code=200)
     else:
         return JSONResponse(content={"error": msg}, status_code=401)
@@ -358,13 +526,14 @@ async def register(request: Request, register_request: RegisterRequest):
     print(f"Name: {name}, UserID: {user_id}, Password: {password}")
 
     # Check if the user already exists
-    status = sq_db.check_user_exists(user_id=user_id)
+    pools: Pools = request.app.state.pools
+    status = await pools.db.run(sq_db.check_user_exists, user_id=user_id)
     if status:
         log.error(f"/register UserID '{user_id}' already exists.")
         return JSONResponse(content={"error": "User already exists"}, status_code=400)
 
-    # If user does not exist, add the user to the database
-    status = sq_db.add_user(user_id=user_id, name=name, password=password)
+    # If user does not exist, add the user to the database (bcrypt hash, on the `cpu` pool)
+    status = await pools.cpu.run(sq_db.add_user, user_id=user_id, name=name, password=password)
     if status:
         return JSONResponse(content={"status": "success"}, status_code=201)
     else:
@@ -424,22 +593,37 @@ async def clear_chat_history(user_id: str = Form(...)):
 # Endpoint to receive file uploads:
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...), user_id: str = Form(...)):
+    """Endpoint to upload one file, streamed to disk in chunks with its SHA-256.
+    - Post request expects form with `file` and `user_id`.
+    - Return JSON with `{"message": "saved file name", "duplicate": T/F}` or `{"error": "message"}` structure.
+    - An upload identical to an existing file of the user returns that file (`"duplicate": true`).
+    - Return 413 if the file is too large or the user's storage quota is exceeded.
+    """
     log.info(f"/upload Received file: {file.filename} from user: {user_id}")
     filename = file.filename if file.filename else "unknown_file"
 
-    status, message = files.save_file(
+    # Copied from the spooled upload chunk by chunk, never read whole in memory:
+    pools: Pools = app.state.pools
+    status, message, info = await pools.db.run(
+        files.save_upload,
         user_id=user_id,
-        file_value_binary=await file.read(),
-        file_name=filename
+        source=file.file,
+        file_name=filename,
+        find_duplicate=partial(sq_db.get_file_by_hash, user_id)
     )
 
     if status:
         filename = message
-        sq_db.add_file(user_id=user_id, filename=filename)
-        return JSONResponse(content={"message": filename}, status_code=200)
+        if info["duplicate"]:
+            # Uploaded again, so not cleaned up as an old file:
+            await pools.db.run(sq_db.touch_file, user_id=user_id, filename=filename)
+        else:
+            await pools.db.run(
+                sq_db.add_file, user_id=user_id, filename=filename, sha256=info["sha256"], size=info["size"])
+        return JSONResponse(content={"message": filename, "duplicate": info["duplicate"]}, status_code=200)
     else:
         log.error(f"/upload File upload failed for user {user_id}: {filename}")
-        return JSONResponse(content={"error": message}, status_code=500)
+        return JSONResponse(content={"error": message}, status_code=413 if info["too_large"] else 500)
 
 
 # Endpoint to embed the uploaded file:
@@ -460,8 +644,16 @@ async def embed_file(embed_request: EmbedRequest, request: Request):
 
     log.info(f"/embed Requested by '{user_id}' for file '{file_name}'")
 
-    # Call the ingest_file function to process the file
-    status, doc_ids, message = ingest_file(
+    # Duplicate uploads resolve to an already embedded file:
+    pools: Pools = request.app.state.pools
+    file_id = await pools.db.run(sq_db.get_file_id_by_name, user_id=user_id, file_name=file_name)
+    if file_id != -1 and await pools.db.run(sq_db.count_embeddings, file_id=file_id):
+        log.info(f"/embed File '{file_name}' of '{user_id}' is already embedded")
+        return JSONResponse(content={"status": "success", "message": "File already embedded."}, status_code=200)
+
+    # Call the ingest_file function to process the file (parse, embed and index, on the `index` pool)
+    status, doc_ids, message = await pools.index.run(
+        ingest_file,
         user_id=user_id,
         file_path=files.get_file_path(user_id=user_id, file_name=file_name),
         vectorstore=request.app.state.vector_db,
@@ -469,9 +661,7 @@ async def embed_file(embed_request: EmbedRequest, request: Request):
     )
 
     if status:
-        file_id = sq_db.get_file_id_by_name(user_id=user_id, file_name=file_name)
-        for vid in doc_ids:
-            sq_db.add_embedding(file_id=file_id, vector_id=vid)
+        await pools.db.run(sq_db.add_embeddings, file_id=file_id, vector_ids=doc_ids)
 
         log.info(f"/embed Embedding completed for '{user_id}' and file '{file_name}'")
         return JSONResponse(content={"status": "success"}, status_code=200)
@@ -480,6 +670,105 @@ async def embed_file(embed_request: EmbedRequest, request: Request):
         return JSONResponse(content={"error": message}, status_code=500)
 
 
+# Endpoint to upload a zip / tar archive of files and embed all of them:
+@app.post("/upload_archive")
+async def upload_archive(request: Request, file: UploadFile = File(...), user_id: str = Form(...)):
+    """Endpoint to bulk upload files as one archive, which are then extracted and embedded in parallel.
+    - Post request expects form with `file` (zip / tar archive) and `user_id`.
+    - Return NDJSON with types "metadata", "progress" (one per file), "summary", or "error".
+    - Members identical to a file of the user are not saved again, they are listed as `duplicates` in the
+      metadata (and embedded only if they were not yet).
+    """
+    user_id = user_id.strip()
+    archive_name = file.filename if file.filename else "unknown_archive"
+    log.info(f"/upload_archive Received archive: {archive_name} from user: {user_id}")
+
+    if not files.is_archive(archive_name):
+        return JSONResponse(content={"error": "Unsupported archive type!"}, status_code=400)
+
+    # Extract directly from the spooled upload, without reading it whole in memory:
+    pools: Pools = request.app.state.pools
+    status, result = await pools.index.run(
+        files.extract_archive, user_id=user_id, archive_file=file.file, archive_name=archive_name,
+        find_duplicate=partial(sq_db.get_file_by_hash, user_id))
+    if not status:
+        log.error(f"/upload_archive Extraction failed for user {user_id}: {result}")
+        return JSONResponse(content={"error": result}, status_code=400)
+
+    # Register all new members at once:
+    extracted: list[dict] = result  # type: ignore[assignment]
+    new_files = [member for member in extracted if not member["duplicate"]]
+    file_ids = await pools.db.run(
+        sq_db.add_files, user_id=user_id, filenames=[member["name"] for member in new_files],
+        sha256s=[member["sha256"] for member in new_files], sizes=[member["size"] for member in new_files])
+    if new_files and not file_ids:
+        for member in new_files:
+            await pools.db.run(files.delete_file, user_id=user_id, file_name=member["name"])
+        return JSONResponse(content={"error": "Failed to register the files!"}, status_code=500)
+    file_id_of = dict(zip([member["name"] for member in new_files], file_ids))
+
+    # Already uploaded files are refreshed, and embedded only if they were not yet:
+    duplicates = [member["name"] for member in extracted if member["duplicate"]]
+    for name in duplicates:
+        await pools.db.run(sq_db.touch_file, user_id=user_id, filename=name)
+        file_id = await pools.db.run(sq_db.get_file_id_by_name, user_id=user_id, file_name=name)
+        if file_id != -1 and not await pools.db.run(sq_db.count_embeddings, file_id=file_id):
+            file_id_of[name] = file_id
+    file_names = list(file_id_of)
+
+    def run_ingestion(loop: asyncio.AbstractEventLoop, events: asyncio.Queue):
+        """Ingest the files on the `index` pool, handing each event over to the event loop."""
+        for event in ingest_files(
+            user_id=user_id,
+            file_paths=[files.get_file_path(user_id=user_id, file_name=name) for name in file_names],
+            vectorstore=request.app.state.vector_db,
+            embeddings=request.app.state.vector_db.get_embeddings(),
+        ):
+            loop.call_soon_threadsafe(events.put_nowait, event)
+
+    async def progress_streamer():
+        try:
+            yield json.dumps({
+                "type": "metadata",
+                "data": {"archive": archive_name, "files": file_names, "duplicates": duplicates}
+            }) + "\n"
+
+            # The call ends after its last event is queued, so `None` marks the end of the events:
+            events: asyncio.Queue = asyncio.Queue()
+            ingestion = asyncio.ensure_future(pools.index.run(run_ingestion, asyncio.get_running_loop(), events))
+            ingestion.add_done_callback(lambda _: events.put_nowait(None))
+
+            while (event := await events.get()) is not None:
+                if event["event"] == "file":
+                    if event["doc_ids"]:
+                        await pools.db.run(
+                            sq_db.add_embeddings, file_id=file_id_of[event["file"]], vector_ids=event["doc_ids"])
+
+                    yield json.dumps({
+                        "type": "progress",
+                        "data": {k: v for k, v in event.items() if k not in ("event", "doc_ids")}
+                    }) + "\n"
+
+                else:
+                    yield json.dumps({
+                        "type": "summary",
+                        "data": {k: v for k, v in event.items() if k != "event"}
+                    }) + "\n"
+
+            # Raises the error of the ingestion, if any:
+            await ingestion
+            log.info(f"/upload_archive Completed for user {user_id}: {archive_name}")
+
+        except Exception as e:
+            log.exception(f"/upload_archive Error {e} for user {user_id}")
+            yield json.dumps({
+                "type": "error",
+                "data": str(e)
+            }) + "\n"
+
+    return StreamingResponse(progress_streamer(), media_type="text/plain")
+
+
 # ------------------------------------------------------------------------------
 # Data management endpoints:
 # ------------------------------------------------------------------------------
@@ -493,7 +782,7 @@ async def clear_my_files(user_id: str = Form(...)):
     """
 
     log.info(f"/clear_my_files Requested by '{user_id}'")
-    delete_old_files(user_id=user_id, time=1)
+    await app.state.pools.index.run(delete_old_files, user_id=user_id, time=1)
     return JSONResponse(content={"status": "success"}, status_code=200)
 
 
@@ -506,7 +795,7 @@ async def get_files(user_id: str = Query(...)):
     - Return JSON with `{"files": ["file1", "file2", ...]}` structure.
     """
     log.info(f"/uploads Requested by '{user_id}'")
-    files_list = sq_db.get_user_files(user_id=user_id)
+    files_list = await app.state.pools.db.run(sq_db.get_user_files, user_id=user_id)
     return {"files": files_list}
 
 
@@ -532,8 +821,9 @@ async def get_file_iframe(file_request: FileIframeRequest):
 
     log.info(f"/iframe Requested by '{user_id}' for file '{file_name}'")
 
-    # Get the iframe for the requested file
-    status, message = files.get_pdf_iframe(
+    # Get the iframe for the requested file (PDF rendering + base64, on the `cpu` pool)
+    status, message = await app.state.pools.cpu.run(
+        files.get_pdf_iframe,
         user_id=user_id,
         file_name=file_name,
         num_pages=num_pages
@@ -558,22 +848,37 @@ async def get_file_iframe(file_request: FileIframeRequest):
 # Output will be streamed in same format as the simple/streaming chat endpoint.
 
 
+def log_payload_savings(documents: list, file_records: dict):
+    """Log the bytes saved by sending file records once, instead of inside every context document."""
+    sizes = {ref: len(json.dumps(record)) for ref, record in file_records.items()}
+    repeated = sum(sizes.get(doc.metadata.get("file_ref"), 0) for doc in documents)
+    log.info(f"/rag Context file records: {sum(sizes.values())} bytes sent, "
+             f"{repeated - sum(sizes.values())} bytes saved over {len(documents)} documents")
+
+
 class RagChatRequest(BaseModel):
     query: str
     session_id: str
     dummy: bool = False
+    search_type: Optional[str] = None       # `similarity`, `mmr` or `hybrid`, else from config
 
 
 @app.post("/rag")
 async def rag(request: Request, chat_request: RagChatRequest):
     """Endpoint to handle RAG (Retrieval-Augmented Generation) queries.
     - Post request expects JSON `{"query": "", "session_id": "", "dummy":T/F}` structure.
-    - Return NDJSON with types "metadata", "content", "context", or "error".
+    - Optional `"search_type"` (`similarity`, `mmr`, `hybrid`) overrides `RETRIEVER_SEARCH_TYPE`.
+    - Return NDJSON with types "metadata", "queued" (position while waiting), "content", "context", or "error".
+    - A single empty ("data": null) "context" follows the "intent" metadata when no retrieval was needed.
+    - Return 429 with `Retry-After` header if the generation queue is full.
     """
     rag_chain = request.app.state.rag_chain
     session_id = chat_request.session_id.strip() or "unknown_session"
+    admission: AdmissionController = request.app.state.admission
 
     async def token_streamer():
+        # Checked and queued before the first line, which `primed` awaits in the endpoint (429 if rejected):
+        ticket = None if chat_request.dummy else admission.enqueue(session_id)
         try:
             dummy = chat_request.dummy
             log.info(f"/rag {'dummy' if dummy else 'real'} response requested by '{session_id}'")
@@ -590,11 +895,8 @@ async def rag(request: Request, chat_request: RagChatRequest):
                     batch_tokens=config.BATCH_TOKEN_PS,
                     token_rate=config.TOKENS_PER_SEC
                 )
-                for chunk in resp:
-                    if await request.is_disconnected():
-                        log.warning(f"/rag client disconnected for '{session_id}'")
-                        break
-
+                # Paced with `time.sleep`, so iterated on a thread to keep the event loop free:
+                async for chunk in iterate_in_threadpool(resp):
                     yield json.dumps({
                         "type": "content",
                         "data": chunk
@@ -603,8 +905,8 @@ async def rag(request: Request, chat_request: RagChatRequest):
             else:
                 # Search kwargs for the configurable retriever:
                 search_kwargs = {
-                    "k": 5,
-                    "search_type": "similarity",
+                    "k": config.DOCS_NUM_COUNT,
+                    "search_type": chat_request.search_type or config.RETRIEVER_SEARCH_TYPE,
                     "filter": {
                         "$or": [
                             {"user_id": session_id},
@@ -613,47 +915,94 @@ async def rag(request: Request, chat_request: RagChatRequest):
                     },
                 }
 
-                async for chunk in rag_chain.astream(
-                    input={"input": chat_request.query},
-                    config={
-                        "configurable": {
-                            "session_id": session_id,
-                            "search_kwargs": search_kwargs
-                        }
-                    }
-                ):
-                    if await request.is_disconnected():
-                        log.warning(f"/rag client disconnected for '{session_id}'")
-                        break
-
-                    # there is answer/input/context
-                    if "answer" in chunk:
+                try:
+                    async for position in ticket.wait():
                         yield json.dumps({
-                            "type": "content",
-                            "data": chunk["answer"]
+                            "type": "queued",
+                            "data": {"position": position}
                         }) + "\n"
 
-                    elif "context" in chunk:
-                        for document in chunk["context"]:
-                            if await request.is_disconnected():
-                                log.warning(f"/rag client disconnected for '{session_id}'")
-                                break
-
-                            # Hide user_id from metadata on UI
-                            if "user_id" in document.metadata:
-                                if document.metadata["user_id"] == "public":
-                                    document.metadata["isPublicDocument"] = True
-                                else:
-                                    document.metadata["isPublicDocument"] = False
-                                document.metadata.pop("user_id")
-
-                            yield json.dumps({
-                                "type": "context",
-                                "data": {
-                                    "metadata": document.metadata,
-                                    "page_content": document.page_content
+                    async with request.app.state.scheduler.ainteractive():
+                        async for chunk in rag_chain.astream(
+                            input={"input": chat_request.query},
+                            config={
+                                "configurable": {
+                                    "session_id": session_id,
+                                    "search_kwargs": search_kwargs
                                 }
-                            }) + "\n"
+                            }
+                        ):
+                            # there is answer/input/context
+                            if "answer" in chunk:
+                                yield json.dumps({
+                                    "type": "content",
+                                    "data": chunk["answer"]
+                                }) + "\n"
+
+                            elif "context" in chunk:
+                                # Turn answered from the history only, signal that no docs will follow:
+                                if chunk.get("intent", RETRIEVE) != RETRIEVE:
+                                    yield json.dumps({
+                                        "type": "metadata",
+                                        "data": {"intent": chunk["intent"]}
+                                    }) + "\n"
+                                    yield json.dumps({
+                                        "type": "context",
+                                        "data": None
+                                    }) + "\n"
+
+                                if chunk.get("cache") is not None and chunk["cache"].hit:
+                                    yield json.dumps({
+                                        "type": "metadata",
+                                        "data": {"answer_cache": "hit"}
+                                    }) + "\n"
+
+                                # Report the chunks stitched together, and the prompt tokens it saved:
+                                if "merging" in chunk:
+                                    yield json.dumps({
+                                        "type": "metadata",
+                                        "data": {"merging": chunk["merging"]}
+                                    }) + "\n"
+
+                                # Report what was dropped / truncated to fit the context size:
+                                if "packing" in chunk:
+                                    yield json.dumps({
+                                        "type": "metadata",
+                                        "data": {"packing": chunk["packing"]}
+                                    }) + "\n"
+
+                                # Send the file level metadata once, chunks only refer it by `file_ref`:
+                                file_refs = {doc.metadata["file_ref"] for doc in chunk["context"]
+                                             if "file_ref" in doc.metadata}
+                                if file_refs:
+                                    file_records = request.app.state.vector_db.get_file_records(file_refs)
+                                    yield json.dumps({
+                                        "type": "metadata",
+                                        "data": {"file_records": file_records}
+                                    }) + "\n"
+                                    log_payload_savings(chunk["context"], file_records)
+
+                                for document in chunk["context"]:
+                                    # Copy, as retrieved docs are the ones stored in the vector DB:
+                                    metadata = dict(document.metadata)
+
+                                    # Hide user_id from metadata on UI
+                                    if "user_id" in metadata:
+                                        if metadata["user_id"] == "public":
+                                            metadata["isPublicDocument"] = True
+                                        else:
+                                            metadata["isPublicDocument"] = False
+                                        metadata.pop("user_id")
+
+                                    yield json.dumps({
+                                        "type": "context",
+                                        "data": {
+                                            "metadata": metadata,
+                                            "page_content": document.page_content
+                                        }
+                                    }) + "\n"
+                finally:
+                    ticket.release()
 
             log.info(f"/rag Streaming completed for '{session_id}'")
 
@@ -663,8 +1012,16 @@ async def rag(request: Request, chat_request: RagChatRequest):
                 "type": "error",
                 "data": str(e)
             }) + "\n"
-
-    return StreamingResponse(token_streamer(), media_type="text/plain")
+        finally:
+            if ticket is not None:
+                ticket.release()
+
+    # The watcher cancels the retrieval / generation as soon as the client disconnects:
+    events = await primed(token_streamer())
+    return StreamingResponse(
+        request.app.state.stream_watcher.stream(request, events, "/rag", session_id),
+        media_type="text/plain"
+    )
 
 
 # ------------------------------------------------------------------------------
@@ -8,8 +8,10 @@ Module for managing SQLite database operations.
 import bcrypt
 import os
 import sqlite3
-from typing import List
+from time import perf_counter
+from typing import List, Optional
 from pathlib import Path
+from metrics import SQLITE_SECONDS
 from logger import get_logger
 
 import pytz
@@ -24,13 +26,37 @@ IST = pytz.timezone('Asia/Kolkata')
 # Database Management Functions:
 # ------------------------------------------------------------------------------
 
+class _TimedCursor(sqlite3.Cursor):
+    """Cursor recording the duration of each statement, by type (SELECT / INSERT / UPDATE / ...)."""
+
+    def execute(self, sql, parameters=(), /):
+        start = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            SQLITE_SECONDS.observe(perf_counter() - start, op=sql.lstrip().split(None, 1)[0].upper())
+
+    def executemany(self, sql, seq_of_parameters, /):
+        start = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            SQLITE_SECONDS.observe(perf_counter() - start, op=sql.lstrip().split(None, 1)[0].upper())
+
+
+class _TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=_TimedCursor):  # type: ignore[override]
+        return super().cursor(factory)
+
+
 def get_connection():
     """Creates and returns a SQLite database connection.
     - The connection is set to allow multiple threads to access it.
     - The database file is created if it does not exist.
+    - Its cursors record the statement durations in `metrics`.
     """
 
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+    return sqlite3.connect(DB_PATH, check_same_thread=False, factory=_TimedConnection)
 
 
 def delete_database() -> bool:
@@ -68,7 +94,7 @@ def create_tables():
             )
         """)
 
-        # UPLOADS(file_id*, user_id^, filename, created_at, available)
+        # UPLOADS(file_id*, user_id^, filename, created_at, available, sha256, size)
         cur.execute("""
             CREATE TABLE IF NOT EXISTS uploads (
                 file_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -76,10 +102,20 @@ def create_tables():
                 filename TEXT NOT NULL,
                 created_at TEXT NOT NULL,
                 available INTEGER DEFAULT 1,
+                sha256 TEXT,
+                size INTEGER,
                 FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
             )
         """)
 
+        # Databases created before the content hash was recorded:
+        columns = {row[1] for row in cur.execute("PRAGMA table_info(uploads)")}
+        for column, col_type in (("sha256", "TEXT"), ("size", "INTEGER")):
+            if column not in columns:
+                cur.execute(f"ALTER TABLE uploads ADD COLUMN {column} {col_type}")
+                log.info(f"Migrated table 'uploads': added column '{column}'.")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_uploads_user_sha256 ON uploads (user_id, sha256)")
+
         # EMBEDDINGS(file_id^, vector_id, available)
         cur.execute("""
             CREATE TABLE IF NOT EXISTS embeddings (
@@ -213,12 +249,14 @@ def authenticate_user(user_id: str, password: str) -> tuple[bool, str]:
 # File Management Functions:
 # ------------------------------------------------------------------------------
 
-def add_file(user_id: str, filename: str) -> int:
+def add_file(user_id: str, filename: str, sha256: Optional[str] = None, size: Optional[int] = None) -> int:
     """Adds a file upload record to the database.
 
     Args:
         user_id (str): The ID of the user uploading the file.
         filename (str): The name of the file being uploaded.
+        sha256 (str): The hex SHA-256 of the file content, if known (for dedup).
+        size (int): The size of the file in bytes, if known.
     Returns:
         int: The ID (=file_id) of the newly created file record, or -1 if an error occurred.
     """
@@ -229,8 +267,8 @@ def add_file(user_id: str, filename: str) -> int:
             ist_time = datetime.now(IST).strftime("%Y-%m-%d %H:%M:%S")
 
             cur.execute(
-                "INSERT INTO uploads (user_id, filename, created_at) VALUES (?, ?, ?)",
-                (user_id, filename, ist_time)
+                "INSERT INTO uploads (user_id, filename, created_at, sha256, size) VALUES (?, ?, ?, ?, ?)",
+                (user_id, filename, ist_time, sha256, size)
             )
             conn.commit()
 
@@ -246,6 +284,46 @@ def add_file(user_id: str, filename: str) -> int:
         return -1
 
 
+def add_files(user_id: str, filenames: List[str], sha256s: Optional[List[str]] = None,
+              sizes: Optional[List[int]] = None) -> List[int]:
+    """Adds multiple file upload records to the database in one transaction.
+    - Either all the records are added, or none of them (on error).
+
+    Args:
+        user_id (str): The ID of the user uploading the files.
+        filenames (List[str]): The names of the files being uploaded.
+        sha256s (List[str]): The hex SHA-256 of each file, in same order, if known (for dedup).
+        sizes (List[int]): The size of each file in bytes, in same order, if known.
+    Returns:
+        List[int]: The IDs (=file_id) of the new file records in same order, or empty list on error.
+    """
+
+    if not filenames:
+        return []
+
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            ist_time = datetime.now(IST).strftime("%Y-%m-%d %H:%M:%S")
+
+            file_ids = []
+            for filename, sha256, size in zip(
+                    filenames, sha256s or [None] * len(filenames), sizes or [None] * len(filenames)):
+                cur.execute(
+                    "INSERT INTO uploads (user_id, filename, created_at, sha256, size) VALUES (?, ?, ?, ?, ?)",
+                    (user_id, filename, ist_time, sha256, size)
+                )
+                file_ids.append(cur.lastrowid)
+            conn.commit()
+
+            log.info(f"Added {len(file_ids)} files for user '{user_id}' in one transaction")
+            return file_ids
+
+    except sqlite3.Error as e:
+        log.error(f"SQLite error while adding {len(filenames)} files for user '{user_id}': {e}")
+        return []
+
+
 def get_user_files(user_id: str) -> List[str]:
     """Retrieves all files uploaded by a user.
     - Only retrieves files that are marked as available (not deleted).
@@ -323,6 +401,61 @@ def get_old_files(user_id: str, time: int = 12*3600) -> dict[str, List[str]]:
         return {"files": [], "embeddings": []}
 
 
+def get_file_by_hash(user_id: str, sha256: str) -> Optional[str]:
+    """Retrieves the name of an available file of the user with the given content hash.
+
+    Args:
+        user_id (str): The ID of the user who owns the file.
+        sha256 (str): The hex SHA-256 of the file content.
+
+    Returns:
+        Optional[str]: The name of the identical file, or None if there is none.
+    """
+
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT filename FROM uploads
+                WHERE user_id = ? AND sha256 = ? AND available = 1
+                ORDER BY file_id LIMIT 1
+            """, (user_id, sha256))
+            result = cur.fetchone()
+            return result[0] if result else None
+
+    except sqlite3.Error as e:
+        log.error(f"SQLite error while looking up file hash for user '{user_id}': {e}")
+        return None
+
+
+def touch_file(user_id: str, filename: str) -> bool:
+    """Refreshes the `created_at` of an available file of the user, e.g. when it is uploaded again.
+    - So that the re-uploaded file is not cleaned up as old (see `get_old_files`).
+
+    Args:
+        user_id (str): The ID of the user who owns the file.
+        filename (str): The name of the file.
+
+    Returns:
+        bool: True if the file was found and refreshed, False otherwise.
+    """
+
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            ist_time = datetime.now(IST).strftime("%Y-%m-%d %H:%M:%S")
+            cur.execute("""
+                UPDATE uploads SET created_at = ?
+                WHERE user_id = ? AND filename = ? AND available = 1
+            """, (ist_time, user_id, filename))
+            conn.commit()
+            return cur.rowcount > 0
+
+    except sqlite3.Error as e:
+        log.error(f"SQLite error while refreshing file '{filename}' for user '{user_id}': {e}")
+        return False
+
+
 def get_file_id_by_name(user_id: str, file_name: str) -> int:
     """Retrieves the file ID for a given file name and user ID.
     - Checks only the active files and not old or deleted files.
@@ -427,6 +560,57 @@ def add_embedding(file_id: int, vector_id: str) -> bool:
         return False
 
 
+def add_embeddings(file_id: int, vector_ids: List[str]) -> bool:
+    """Adds the embedding records of all chunks of a file in one transaction.
+
+    Args:
+        file_id (int): The ID of the file to which the embeddings belong.
+        vector_ids (List[str]): The IDs of the embedding vectors.
+
+    Returns:
+        bool: True if the embeddings were added successfully, False otherwise.
+    """
+
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.executemany(
+                "INSERT INTO embeddings (file_id, vector_id) VALUES (?, ?)",
+                [(file_id, vector_id) for vector_id in vector_ids]
+            )
+            conn.commit()
+            log.info(f"Added {len(vector_ids)} embeddings for file ID {file_id}")
+            return True
+
+    except sqlite3.Error as e:
+        log.error(f"SQLite error while adding embeddings for file ID {file_id}: {e}")
+        return False
+
+
+def count_embeddings(file_id: int) -> int:
+    """Counts the available embedding records of a file.
+
+    Args:
+        file_id (int): The ID of the file.
+
+    Returns:
+        int: The num of available embeddings, 0 on error.
+    """
+
+    try:
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT COUNT(*) FROM embeddings
+                WHERE file_id = ? AND available = 1
+            """, (file_id,))
+            return cur.fetchone()[0]
+
+    except sqlite3.Error as e:
+        log.error(f"SQLite error while counting embeddings for file ID {file_id}: {e}")
+        return 0
+
+
 def mark_embeddings_removed(vector_ids: List[str]) -> bool:
     """Marks an embedding as unavailable (deleted) in the database.
 
@@ -480,6 +664,17 @@ if __name__ == "__main__":
     f2 = add_file(user_id="test_user_2", filename="user2_file1.txt")
     f3 = add_file(user_id="test_user_1", filename="user1_file2.txt")
 
+    f4, f5 = add_files(user_id="test_user_2", filenames=["user2_file2.txt", "user2_file3.txt"])
+    print(f"\t - Files added in bulk: {f4}, {f5}")
+
+    f6 = add_file(user_id="test_user_2", filename="user2_file4.txt", sha256="ab" * 32, size=42)
+    assert get_file_by_hash("test_user_2", "ab" * 32) == "user2_file4.txt", "File hash lookup failed"
+    assert get_file_by_hash("test_user_1", "ab" * 32) is None, "File hash lookup crossed users"
+    assert touch_file("test_user_2", "user2_file4.txt"), "File not refreshed"
+    mark_file_removed("test_user_2", f6)
+    assert not touch_file("test_user_2", "user2_file4.txt"), "Removed file refreshed"
+    print(f"\t - File with hash added, looked up and refreshed: {f6}")
+
     # Add embeddings for the files
     # user_1
     add_embedding(file_id=f1, vector_id="user1_f1_e1")
@@ -487,7 +682,8 @@ if __name__ == "__main__":
     # user_2
     add_embedding(file_id=f2, vector_id="user2_f1_e1")
     add_embedding(file_id=f2, vector_id="user2_f1_e2")
-    print(f"\t - Embeddings added for files: {f1}, {f2}, {f3}")
+    add_embeddings(file_id=f4, vector_ids=["user2_f2_e1", "user2_f2_e2"])
+    print(f"\t - Embeddings added for files: {f1}, {f2}, {f3}, {f4}")
 
     # Wait for a while to simulate old files
     from time import sleep
@@ -513,8 +709,8 @@ if __name__ == "__main__":
     # Old Retrieval:
     assert old1["files"] == ["user1_file1.txt", "user1_file2.txt"], "User 1 old files mismatch"
     assert old1["embeddings"] == ["user1_f1_e1", "user1_f2_e1"], "User 1 old embeddings mismatch"
-    assert old2["files"] == ["user2_file1.txt"], "User 2 old files mismatch"
-    assert old2["embeddings"] == ["user2_f1_e1", "user2_f1_e2"], "User 2 old embeddings mismatch"
+    assert old2["files"] == ["user2_file1.txt", "user2_file2.txt", "user2_file3.txt"], "User 2 old files mismatch"
+    assert old2["embeddings"] == ["user2_f1_e1", "user2_f1_e2", "user2_f2_e1", "user2_f2_e2"], "User 2 old embeddings mismatch"
 
     # Removal:
     print("\nRemoving files:")
@@ -523,7 +719,7 @@ if __name__ == "__main__":
 
     # Check cascade delete:
     emb = get_old_files(user_id="test_user_2", time=1)["embeddings"]
-    assert emb == [], "Embeddings not deleted after file removal for user 2"
+    assert emb == ["user2_f2_e1", "user2_f2_e2"], "Embeddings not deleted after file removal for user 2"
     print("\t - Embeddings deleted after file removal for user 2")
 
     # Check USERs management:
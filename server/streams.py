@@ -0,0 +1,148 @@
+"""
+Module for the NDJSON streaming responses, watched for client disconnects.
+- The endpoint's event generator runs in its own (producer) task, the response only forwards its lines.
+- One watcher task per request waits for the `http.disconnect` message, instead of polling
+  `request.is_disconnected()` before every token.
+- On disconnect the producer task is cancelled at once, wherever it is awaiting (the LLM stream,
+  retrieval, the admission queue), so the upstream Ollama request is aborted and its slot freed.
+- Cancelled streams are counted, with their content events (tokens wasted on an abandoned answer).
+- The time to the first content event and the tokens / sec are recorded in `metrics`.
+- `primed` runs a generator up to its first line in the endpoint, so that its setup errors (e.g. admission
+  rejections) are still plain error responses, and its `finally` runs even if the response never starts.
+"""
+
+import asyncio
+from time import perf_counter
+from typing import Any, AsyncIterator, Dict, Optional, Union
+
+from fastapi import Request
+
+from metrics import TTFT_SECONDS, STREAM_TOKENS, TOKENS_PER_SECOND, STREAMS_CANCELLED, WASTED_TOKENS
+
+from logger import get_logger
+log = get_logger(name="streams")
+
+_DONE = object()
+# Lines are `json.dumps({"type": ..., "data": ...})`, so content events start with:
+_CONTENT_PREFIX = '{"type": "content"'
+
+
+async def primed(events: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Run `events` up to its first line, and return the iterator of all its lines (first one included).
+
+    Raises:
+        Any exception of `events` before its first line.
+    """
+
+    first = await events.__anext__()
+
+    async def _lines() -> AsyncIterator[str]:
+        yield first
+        async for line in events:
+            yield line
+
+    return _lines()
+
+
+class StreamWatcher:
+    """Runs the streaming endpoints' generators, cancelling them when their client disconnects.
+
+    ## Functions:
+        + `stream(request, events, endpoint, session_id)`: Returns the watched response iterator of the events.
+        + `get_stats()`: Returns the num of streams, cancellations and wasted tokens per endpoint.
+    """
+
+    def __init__(self):
+        self._stats: Dict[str, Dict[str, int]] = {}
+        log.info("Initialized StreamWatcher.")
+
+    def _record(self, endpoint: str, cancelled: bool, tokens: int, start: float,
+                first: Optional[float], last: Optional[float]):
+        STREAM_TOKENS.inc(tokens, endpoint=endpoint)
+        if first is not None:
+            TTFT_SECONDS.observe(first - start, endpoint=endpoint)
+            if tokens > 1 and last is not None and last > first:
+                TOKENS_PER_SECOND.observe((tokens - 1) / (last - first), endpoint=endpoint)
+        if cancelled:
+            STREAMS_CANCELLED.inc(endpoint=endpoint)
+            WASTED_TOKENS.inc(tokens, endpoint=endpoint)
+
+        stats = self._stats.setdefault(
+            endpoint, {"streams": 0, "completed": 0, "cancelled": 0, "tokens": 0, "wasted_tokens": 0})
+        stats["streams"] += 1
+        stats["tokens"] += tokens
+        if cancelled:
+            stats["cancelled"] += 1
+            stats["wasted_tokens"] += tokens
+        else:
+            stats["completed"] += 1
+
+    @staticmethod
+    async def _watch(request: Request, producer: "asyncio.Task[None]", queue: asyncio.Queue):
+        """Wait for the client to leave, then cancel the producer and end the response."""
+        while True:
+            message = await request.receive()
+            if message["type"] == "http.disconnect":
+                break
+        if not producer.done():
+            producer.cancel()
+        queue.put_nowait(_DONE)
+
+    async def stream(self, request: Request, events: AsyncIterator[str], endpoint: str,
+                     session_id: str) -> AsyncIterator[str]:
+        """Forward the NDJSON lines of `events`, until they end or the client disconnects.
+
+        Args:
+            request (Request): The request, whose `receive` channel is watched.
+            events (AsyncIterator[str]): The endpoint's NDJSON lines generator.
+            endpoint (str): Name of the endpoint, for logs and stats.
+            session_id (str): Session of the request, for logs.
+
+        Yields:
+            str: The NDJSON lines, as produced.
+        """
+
+        queue: "asyncio.Queue[Union[str, BaseException, object]]" = asyncio.Queue()
+        tokens, start = 0, perf_counter()
+        first: Optional[float] = None
+        last: Optional[float] = None
+
+        async def _produce():
+            nonlocal tokens, first, last
+            try:
+                async for line in events:
+                    if line.startswith(_CONTENT_PREFIX):
+                        tokens += 1
+                        last = perf_counter()
+                        if first is None:
+                            first = last
+                    queue.put_nowait(line)
+                queue.put_nowait(_DONE)
+            except Exception as e:
+                queue.put_nowait(e)
+
+        producer = asyncio.create_task(_produce(), name=f"{endpoint}:{session_id}")
+        watcher = asyncio.create_task(self._watch(request, producer, queue), name=f"{endpoint}:watch")
+        try:
+            while True:
+                item: Any = await queue.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+
+        finally:
+            watcher.cancel()
+            # Client gone (watcher) or response closed by the server: abort the generation.
+            cancelled = producer.cancelled() or not producer.done()
+            if not producer.done():
+                producer.cancel()
+            self._record(endpoint, cancelled, tokens, start, first, last)
+            if cancelled:
+                log.warning(f"{endpoint} client disconnected for '{session_id}', "
+                            f"cancelled generation after {tokens} content events.")
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Returns per endpoint `{"streams", "completed", "cancelled", "tokens", "wasted_tokens"}`."""
+        return {endpoint: dict(stats) for endpoint, stats in self._stats.items()}